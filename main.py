@@ -5,6 +5,7 @@ import os
 import signal
 
 from trader.logger import DEFAULT_LOGGER
+from trader.shard import RemoteTrader, TradeServer
 from trader.telegram import TeleTrader
 
 API_ID = int(os.getenv("API_ID"))
@@ -13,6 +14,13 @@ API_KEY = os.getenv("API_KEY")
 API_SECRET = os.getenv("API_SECRET")
 SESSION_PATH = os.getenv("SESSION_PATH")
 STATE_PATH = os.getenv("STATE_PATH")
+MESSAGES_PATH = os.getenv("MESSAGES_PATH")
+# Shard 0 trades, the others (own SESSION_PATH and STATE_PATH each) send it what they parse
+SHARD = int(os.getenv("SHARD", 0))
+SHARDS = int(os.getenv("SHARDS", 1))
+SHARD_SOCKET = os.getenv("SHARD_SOCKET")
+ALL_PRICES = os.getenv("ALL_PRICES") == "1"
+PRICE_SOURCE = os.getenv("PRICE_SOURCE", "aggTrade")  # aggTrade, bookTicker or markPrice
 
 # fine to use this logger in async - not looking for performance
 DEFAULT_LOGGER.setLevel(logging.INFO)
@@ -25,12 +33,26 @@ if STATE_PATH is not None and os.path.exists(STATE_PATH):
 
 
 async def main():
-    client = TeleTrader(API_ID, API_HASH, session=SESSION_PATH, state=state, loop=loop)
+    trader = RemoteTrader(SHARD_SOCKET) if SHARD > 0 else None
+    client = TeleTrader(API_ID, API_HASH, session=SESSION_PATH, state=state, loop=loop,
+                        messages_path=MESSAGES_PATH, trader=trader, shard=SHARD, shards=SHARDS)
+    if trader is None:
+        client.trader.all_prices = ALL_PRICES
+        client.trader.price_source = PRICE_SOURCE
+        if STATE_PATH is not None:
+            client.trader.exchange_info_path = os.path.join(os.path.dirname(STATE_PATH), "exchange_info.json")
     await client.init(API_KEY, API_SECRET)
+    server = None
+    if SHARD == 0 and SHARD_SOCKET is not None:
+        server = TradeServer(client.trader, client.config, SHARD_SOCKET)
+        await server.start()
     try:
         await client.run()
     except asyncio.CancelledError:
         pass
+    finally:
+        if server is not None:
+            await server.stop()
 
 try:
     task = asyncio.ensure_future(main())
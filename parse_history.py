@@ -0,0 +1,68 @@
+import argparse
+import collections
+import itertools
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from trader.history import parse_chunk, read_history
+from trader.logger import DEFAULT_LOGGER as logging
+
+
+def chunks(messages, size):
+    it = iter(messages)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run(paths, out, workers=None, chunk_size=500, chat_id=None):
+    # At most 2 chunks per worker are in flight, results are written in input order
+    workers = workers or os.cpu_count() or 1
+    messages = itertools.chain.from_iterable(read_history(path, chat_id) for path in paths)
+    summary = collections.Counter()
+    pending = collections.deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for chunk in chunks(messages, chunk_size):
+            pending.append(pool.submit(parse_chunk, chunk))
+            if len(pending) >= workers * 2:
+                _write(pending.popleft().result(), out, summary)
+        while pending:
+            _write(pending.popleft().result(), out, summary)
+    return summary
+
+
+def _write(records, out, summary):
+    for rec in records:
+        out.write(json.dumps(rec) + "\n")
+        summary[(rec["channel"], rec["status"])] += 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parse exported Telegram history (JSON export or JSONL)")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("-o", "--output", default="-", help="JSONL output, stdout by default")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--chat-id", type=int, default=None, help="channel id to use for all messages")
+    args = parser.parse_args(argv)
+
+    out = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        summary = run(args.paths, out, args.workers, args.chunk_size, args.chat_id)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    per_channel = collections.defaultdict(dict)
+    for (channel, status), count in summary.items():
+        per_channel[channel][status] = count
+    for channel, counts in sorted(per_channel.items(), key=lambda item: str(item[0])):
+        logging.info(f"{channel}: {', '.join(f'{k} {v}' for k, v in sorted(counts.items()))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,24 @@
 import asyncio
-import math
+import collections
 import json
 import uuid
 import time
 import traceback
+from typing import Dict
 
 from binance import AsyncClient, BinanceSocketManager
 from binance.exceptions import BinanceAPIException
 from cachetools import TTLCache
 
-from .errors import EntryCrossedException, InsufficientQuantityException, PriceUnavailableException
+from .config import ConfigStore
+from .errors import (EntryCrossedException, InsufficientQuantityException, InvalidOrderException,
+                     PriceUnavailableException)
 from .logger import DEFAULT_LOGGER as logging
+from .prices import PRICE_TIMEOUT, PriceFeed
 from .signal import Signal
+from .streams import AGG_TRADE, FUTURES_STREAM_URL, TESTNET_STREAM_URL, PriceStream, StreamManager
+from .symbols import (EXCHANGE_INFO_REFRESH, EXCHANGE_INFO_TTL, SymbolSpec, SymbolTable, load_exchange_info,
+                      save_exchange_info)
 from .user_stream import UserStream
 from .utils import NamedLock
 
@@ -20,6 +27,8 @@ NEW_ORDER_TIMEOUT = 5 * 60
 ORDER_WATCH_INTERVAL = 2 * 60
 ORDER_MAX_RETRIES = 10
 ORDER_RETRY_SLEEP = 5
+PRICE_FALLBACK_AFTER = 1  # seconds to wait for a streamed price before taking a snapshot
+MAX_PRICE_AGE = 30  # older prices aren't used for sizing
 PRICE_SLIPPAGE = 1.5  # skip order if funds allocated exceeds estimation by this much
 MAX_TARGETS = 10
 DEFAULT_RR = 1
@@ -124,9 +133,15 @@ class FuturesTrader:
     def __init__(self):
         self.client: AsyncClient = None
         self.state: dict = None
-        self.prices: dict = {}
-        self.symbols: dict = {}
-        self.price_streamer = None
+        self.config: ConfigStore = None  # shared with the telegram client when there's one
+        self.prices = PriceFeed()
+        self.price_timeout = PRICE_TIMEOUT
+        self.all_prices = False  # stream prices of every symbol instead of subscribing per coin
+        self.price_source = AGG_TRADE  # what the per coin streams are made of
+        self.symbols: Dict[str, SymbolSpec] = SymbolTable()
+        self.exchange_info_path = None  # cache of the exchange info when set
+        self.price_streamer = None  # all-market stream
+        self.streams: StreamManager = None  # per coin streams
         self.clocks = NamedLock()
         self.olock = asyncio.Lock()  # lock to place only one order at a time
         self.slock = asyncio.Lock()  # lock for stream subscriptions
@@ -134,15 +149,19 @@ class FuturesTrader:
         # cache to disallow orders with same symbol, entry and first TP for 10 mins
         self.sig_cache = TTLCache(maxsize=100, ttl=600)
         self.balance = 0
-        self.results_handler = None
+        self.results_handler = None  # takes a notification without blocking
         self.ocount = 0
 
     async def init(self, api_key, api_secret, state={}, test=False, loop=None):
         self.state = state
+        if self.config is None:
+            self.config = ConfigStore(state)
         self.client = await AsyncClient.create(
             api_key=api_key, api_secret=api_secret, testnet=test, loop=loop)
         self.manager = BinanceSocketManager(self.client, loop=loop)
         self.user_stream = UserStream(api_key, api_secret, test=test)
+        self.price_stream = PriceStream(self.prices, self.price_source)
+        self.streams = StreamManager(self.price_stream, url=TESTNET_STREAM_URL if test else FUTURES_STREAM_URL)
         if not self.state.get("streams"):
             self.state["streams"] = []
         if not self.state.get("orders"):
@@ -150,30 +169,38 @@ class FuturesTrader:
         await self._gather_orders()
         await self._watch_orders()
         await self._subscribe_futures_user()
-        resp = await self.client.futures_exchange_info()
-        for info in resp["symbols"]:
-            self.symbols[info["symbol"]] = info
+        await self._load_symbols()
+        if self.all_prices:
+            self.price_streamer = asyncio.ensure_future(self._stream_all_prices())
         resp = await self.client.futures_account_balance()
         for item in resp:
             if item["asset"] == "USDT":
                 self.balance = float(item["balance"])
         logging.info(f"Account balance: {self.balance} USDT", on="blue")
 
-    async def queue_signal(self, signal: Signal):
+    async def queue_signal(self, signal: Signal, origin=None):
+        # `origin` (chat id, message id, edit time) is for RemoteTrader, which dedups on it
+        # tagged right away so the caller knows which order the signal ends up as
+        if signal.tag:
+            signal.tag += f"-{self.ocount}"
+        else:
+            signal.tag = f"{signal.coin.lower()}-{self.ocount}"
+        self.ocount += 1
         await self.order_queue.put(signal)
 
-    async def close_trades(self, tag, coin=None):
+    async def close_trades(self, tag, coin=None, origin=None):
         if coin is None:
             logging.info(f"Attempting to close all trades tagged {tag}", color="yellow")
         else:
             logging.info(f"Attempting to close {coin} trades tagged {tag}", color="yellow")
+        tag = tag.lower()
         async with self.olock:
             removed = []
             for order_id, order in self.state["orders"].items():
-                otag = order.get("tag")
+                otag = (order.get("tag") or "").lower()
                 if not otag:
                     continue
-                if otag.split("-")[0] != tag:
+                if otag != tag and otag.split("-")[0] != tag:  # the order's own tag or its channel's
                     continue
                 if coin is not None and order["sym"] != f"{coin}USDT":
                     continue
@@ -210,21 +237,119 @@ class FuturesTrader:
             if not removed:
                 logging.info(f"Didn't find any matching positions for {tag} to close", color="yellow")
 
+    async def amend_trade(self, tag, signal: Signal, fields=("sl", "targets"), origin=None):
+        # Applies `fields` of an edited signal to the trade it opened, its prices are corrected
+        # against the trade's entry like the original ones were
+        async with self.olock:
+            order_id = self._find_order(tag)
+            if order_id is None:
+                logging.info(f"Didn't find an order tagged {tag} to amend", color="yellow")
+                return
+            odata = self.state["orders"][order_id]
+            signal.correct(odata["ent"], tick=self._tick_size(odata["sym"]))
+        await self.update_trade(tag, sl=signal.sl if "sl" in fields else None,
+                                targets=signal.targets.tolist() if "targets" in fields else None)
+
+    async def update_trade(self, tag, sl=None, targets=None, origin=None):
+        # Only the SL or TP orders whose price changed are replaced, the rest of the trade stays -
+        # unless the number of targets changed, then all the open TPs are
+        async with self.olock:
+            order_id = self._find_order(tag)
+            if order_id is None:
+                logging.info(f"Didn't find an order tagged {tag} to update", color="yellow")
+                return
+            odata = self.state["orders"][order_id]
+            symbol = odata["sym"]
+            move_sl = False
+            if sl is not None and sl != odata["sl"]:
+                logging.info(f"Changing SL of {tag} from {odata['sl']} to {sl}", color="yellow")
+                odata["sl"] = sl
+                # once a TP is hit the SL sits at entry, and stays there
+                move_sl = odata.get("s_ord") is not None and not any(
+                    self.state["orders"].get(tid, {}).get("filled") for tid in odata["t_ord"])
+            if targets is not None:
+                targets = targets[:MAX_TARGETS]
+                if not odata["t_ord"]:  # not placed yet
+                    odata["tgt"] = targets
+                elif len(targets) != len(odata["t_ord"]):
+                    logging.info(f"Changing TPs of {tag} from {odata['tgt']} to {targets}", color="yellow")
+                    await self._replace_targets(order_id, targets)
+                else:
+                    for i, tid in enumerate(odata["t_ord"]):
+                        if targets[i] == odata["tgt"][i] or self.state["orders"].get(tid, {}).get("filled"):
+                            continue
+                        logging.info(f"Changing TP {i + 1} of {tag} from {odata['tgt'][i]} to {targets[i]}",
+                                     color="yellow")
+                        odata["tgt"][i] = targets[i]
+                        await self._cancel_order(tid, symbol)
+                        self.state["orders"].pop(tid, None)
+                        new_id = await self._create_target_order(
+                            order_id, symbol, odata["side"], targets[i], odata["t_q"][i])
+                        if new_id is None:
+                            continue  # the watcher recreates missing TPs
+                        odata["t_ord"][i] = new_id
+                        self.state["orders"][new_id] = {
+                            "parent": order_id,
+                            "filled": False,
+                        }
+        if move_sl:
+            await self._place_sl_order(order_id)
+
+    async def _replace_targets(self, order_id, targets):
+        # For a different number of targets: the TPs which were hit stay, the open ones are
+        # cancelled and their quantity is split over the targets past the hit ones (TPs are hit
+        # in order). Called with the orders lock held.
+        orders = self.state["orders"]
+        odata = orders[order_id]
+        symbol = odata["sym"]
+        t_ord, t_q, tgt = [], [], []
+        quantity = 0
+        for tid, q, price in zip(odata["t_ord"], odata["t_q"], odata["tgt"]):
+            if orders.get(tid, {}).get("filled"):
+                t_ord.append(tid)
+                t_q.append(q)
+                tgt.append(price)
+                continue
+            quantity += q
+            await self._cancel_order(tid, symbol)
+            orders.pop(tid, None)
+        left = targets[len(t_ord):]
+        for price in left:
+            q = self._round_qty(symbol, quantity / len(left))
+            new_id = await self._create_target_order(order_id, symbol, odata["side"], price, q)
+            if new_id is None:
+                continue
+            t_ord.append(new_id)
+            t_q.append(q)
+            tgt.append(price)
+            orders[new_id] = {
+                "parent": order_id,
+                "filled": False,
+            }
+        odata["t_ord"], odata["t_q"], odata["tgt"] = t_ord, t_q, tgt
+
+    def _find_order(self, tag):
+        # by the order's own tag (e.g. "TCA-3"), or by its channel's for the newest order of it
+        tag = tag.lower()
+        found = None
+        for order_id, order in self.state["orders"].items():
+            otag = (order.get("tag") or "").lower()
+            if otag == tag:
+                return order_id
+            if otag.split("-")[0] == tag:
+                found = order_id
+        return found
+
     async def _gather_orders(self):
         async def _gatherer():
             logging.info("Waiting for orders to be queued...")
             while True:
                 signal = await self.order_queue.get()
-                if self.symbols.get(f"{signal.coin}USDT") is None:
+                spec = self.symbols.get(f"{signal.coin}USDT")
+                if spec is None or not spec.trading:
                     logging.info(f"Unknown symbol {signal.coin} in signal", color="yellow")
                     continue
 
-                if signal.tag:
-                    signal.tag += f"-{self.ocount}"
-                else:
-                    signal.tag = f"{signal.coin.lower()}-{self.ocount}"
-                self.ocount += 1
-
                 async def _process(signal):
                     if signal.is_partial:
                         await self._place_partial_order(signal)
@@ -250,13 +375,16 @@ class FuturesTrader:
                                     f"Allocated ${round(err.alloc_funds, 2)} for {err.alloc_q} {signal.coin} "
                                     f"but requires ${round(err.est_funds, 2)} for {err.est_q} {signal.coin}",
                                     color="red")
+                            except InvalidOrderException as err:
+                                logging.info(f"Invalid order for {err.symbol}: {err.reason}", color="red")
+                                break  # it won't be any different on a retry
                             except Exception as err:
                                 logging.error(f"Failed to place order: {traceback.format_exc()} {err}")
                                 break  # unknown error - don't block future signals
                             if i < ORDER_MAX_RETRIES - 1:
                                 await asyncio.sleep(ORDER_RETRY_SLEEP)
                         await self._unregister_order(signal)
-                        await self.results_handler(Trade.skipped(
+                        self.results_handler(Trade.skipped(
                             signal.tag, "BUY" if signal.is_long else "SELL", signal.coin))
 
                 asyncio.ensure_future(_process(signal))
@@ -271,25 +399,19 @@ class FuturesTrader:
 
     async def _place_order(self, signal: Signal):
         await self._subscribe_futures(signal.coin)
-        for _ in range(10):
-            if self.prices.get(signal.coin) is not None:
-                break
-            logging.info(f"Waiting for {signal.coin} price to be available")
-            await asyncio.sleep(1)
-        if self.prices.get(signal.coin) is None:
-            raise PriceUnavailableException()
-
-        price = self.prices[signal.coin]
-        signal.correct(price)
+        price = await self._price(signal.coin)
+        symbol = f"{signal.coin}USDT"
+        signal.correct(price, tick=self._tick_size(symbol))
         side = "BUY" if signal.is_long else "SELL"
-        if signal.risk_reward < self.state["config"].get("rr", DEFAULT_RR):
-            await self.results_handler(Trade.low_rr(signal.tag, side, signal.coin, signal.risk_reward))
+        rr = self.config.current.rr
+        if signal.risk_reward < (rr if rr is not None else DEFAULT_RR):
+            self.results_handler(Trade.low_rr(signal.tag, side, signal.coin, signal.risk_reward))
             return
 
-        symbol = f"{signal.coin}USDT"
         logging.info(f"Modifying leverage to {signal.leverage}x for {symbol}", color="green")
         f = self.client.futures_change_leverage(symbol=symbol, leverage=signal.leverage)
         asyncio.ensure_future(f)  # async change leverage
+        recent = self.prices.range(signal.coin)
         alloc_funds = self.balance * signal.fraction
         quantity = alloc_funds / (price / signal.leverage)
         logging.info(f"Corrected signal: {signal}", color="cyan")
@@ -321,8 +443,13 @@ class FuturesTrader:
             params["stopPrice"] = self._round_price(symbol, signal.entry)
             params["price"] = self._round_price(symbol, signal.max_entry)
         else:
+            if recent is not None and ((signal.is_long and recent[1] >= signal.targets[0]) or
+                                       (signal.is_short and recent[0] <= signal.targets[0])):
+                # the first target traded within RANGE_WINDOW, a market order would chase the move
+                raise EntryCrossedException(price)
             params["newClientOrderId"] = order_id = OrderID.market()
             logging.info(f"Placing market order for {signal.coin} (price @ {price}, entry @ {signal.entry}")
+        self._spec(symbol).validate(qty, params.get("price", price), market=params["type"] == OrderType.MARKET)
 
         async with self.olock:  # Lock only for interacting with orders
             try:
@@ -334,7 +461,7 @@ class FuturesTrader:
                     "side": params["side"],
                     "ent": signal.entry if (signal.force_limit_order or signal.wait_entry) else price,
                     "sl": signal.sl,
-                    "tgt": signal.targets,
+                    "tgt": signal.targets.tolist(),
                     "rr": signal.risk_reward,
                     "fnd": alloc_funds,
                     "lev": signal.leverage,
@@ -351,11 +478,32 @@ class FuturesTrader:
                 if isinstance(err, BinanceAPIException) and err.code == -2021:
                     raise EntryCrossedException(price)
 
+    async def _price(self, coin: str):
+        # Streamed price if there's a fresh one (or it comes shortly), else one from a bulk
+        # ticker snapshot - then the stream gets the rest of the timeout. Never older than
+        # MAX_PRICE_AGE, so orders aren't sized off a stale price.
+        wait = min(PRICE_FALLBACK_AFTER, self.price_timeout)
+        try:
+            return await self.prices.wait(coin, wait, max_age=MAX_PRICE_AGE)
+        except PriceUnavailableException:
+            pass
+        try:
+            await self.prices.refresh(self._fetch_prices)
+        except Exception as err:
+            logging.warning(f"Failed to fetch price snapshot: {err}")
+        price = await self.prices.wait(coin, self.price_timeout - wait, max_age=MAX_PRICE_AGE)
+        logging.info(f"Using {self.prices.source(coin)} price for {coin} ({round(self.prices.age(coin), 2)}s old)")
+        return price
+
+    async def _fetch_prices(self):
+        resp = await self.client.futures_symbol_ticker()
+        return [(t["symbol"][:-4], float(t["price"]), t["time"] / 1000) for t in resp if t["symbol"].endswith("USDT")]
+
     async def _place_collection_orders(self, order_id):
         await self._place_sl_order(order_id)
         async with self.olock:
             odata = self.state["orders"][order_id]
-            await self.results_handler(Trade.entry(
+            self.results_handler(Trade.entry(
                 odata["tag"], odata["sym"], odata["ent"], odata["qty"],
                 odata["lev"], odata["side"], odata["sl"], odata["rr"]))
             if odata.get("t_ord"):
@@ -395,6 +543,11 @@ class FuturesTrader:
             "price": self._round_price(symbol, tgt_price),
             "quantity": rounded_qty,
         }
+        try:
+            self._spec(symbol).validate(rounded_qty, params["price"], reduce=True)
+        except InvalidOrderException as err:
+            logging.error(f"Not creating target order for parent {order_id}: {err.reason}")
+            return
         try:
             resp = await self.client.futures_create_order(**params)
             logging.info(f"Created limit order {tgt_order_id} for parent {order_id}, "
@@ -453,7 +606,7 @@ class FuturesTrader:
                         for oid in parent["t_ord"]:
                             self.state["orders"].pop(oid, None)  # It might not exist
                             await self._cancel_order(oid, parent["sym"])
-                        await self.results_handler(
+                        self.results_handler(
                             Trade.target(parent["tag"], parent["sym"], parent["ent"], parent["qty"],
                                          parent["lev"], float(info["ap"]), float(info["q"]),
                                          is_long=parent["side"] == "BUY", is_sl=True))
@@ -476,7 +629,7 @@ class FuturesTrader:
                 return
 
             idx = targets.index(tp_id)
-            await self.results_handler(
+            self.results_handler(
                 Trade.target(parent["tag"], parent["sym"], parent["ent"], parent["qty"],
                              parent["lev"], parent["tgt"][idx], parent["t_q"][idx],
                              is_long=parent["side"] == "BUY"))
@@ -541,9 +694,11 @@ class FuturesTrader:
                     if redundant:
                         logging.warning(f"Resetting price streams to {open_symbols}", color="yellow")
                         self.state["streams"] = open_symbols
-                await self._subscribe_futures(resub=redundant)
-                for sym in redundant:
-                    self.prices.pop(f"{sym}USDT", None)
+                    if not self.all_prices:
+                        await self._sync_streams()
+                if not self.all_prices:  # the all-market stream keeps every price up to date
+                    for sym in redundant:
+                        self.prices.pop(sym)
 
                 now = time.time()
                 async with self.olock:
@@ -675,43 +830,48 @@ class FuturesTrader:
 
         return open_symbols
 
-    async def _subscribe_futures(self, coin: str = None, resub=False):
+    async def _subscribe_futures(self, coin: str):
+        if self.all_prices:
+            return  # every symbol is streamed already
+        coin = coin.upper()
         async with self.slock:
-            num_streams = len(set(self.state["streams"]))
-            resub = resub or (self.price_streamer is None)
-            if coin is not None:
-                coin = coin.upper()
-                # We should have duplicates because it should be possible to long/short
-                # on top of an existing long/short.
-                self.state["streams"].append(coin)
-
-            if num_streams != len(set(self.state["streams"])):
-                resub = True
-
-            if resub and self.price_streamer is not None:
-                logging.info("Cancelling ongoing ws stream for resubscribing")
-                self.price_streamer.cancel()
-
-            symbols = set(self.state["streams"])
-            if not resub or not symbols:
-                return
-
-        async def _streamer():
-            subs = list(map(lambda s: s.lower() + "usdt@aggTrade", symbols))
-            logging.info(f"Spawning listener for {len(symbols)} symbol(s): {symbols}", color="magenta")
-            async with self.manager.futures_multiplex_socket(subs) as stream:
-                while True:
-                    msg = await stream.recv()
-                    if msg is None:
-                        logging.warning("Received 'null' in price stream", color="red")
-                        continue
-                    try:
-                        symbol = msg["stream"].split("@")[0][:-4].upper()
-                        self.prices[symbol.upper()] = float(msg["data"]["p"])
-                    except Exception as err:
-                        logging.error(f"Failed to get price for {msg['stream']}: {err}")
-
-        self.price_streamer = asyncio.ensure_future(_streamer())
+            # We should have duplicates because it should be possible to long/short
+            # on top of an existing long/short.
+            self.state["streams"].append(coin)
+            await self.streams.subscribe(self.price_stream.stream(coin))
+
+    async def _sync_streams(self):
+        # subscriptions follow state["streams"], only the streams which changed cost a frame
+        counts = collections.Counter(self.price_stream.stream(coin) for coin in self.state["streams"])
+        await self.streams.reset(counts)
+
+    async def _stream_all_prices(self):
+        # Mark prices of every USDT-M symbol once a second from a single stream, so signals
+        # for a new coin find a price without subscribing first
+        coins = {sym: sym[:-4] for sym in self.symbols if sym.endswith("USDT")}
+        for coin in coins.values():
+            self.prices.slot(coin)
+        while True:
+            try:
+                async with self.manager.all_mark_price_socket(fast=True) as stream:
+                    logging.info(f"Streaming prices for {len(coins)} symbols", color="magenta")
+                    while True:
+                        msg = await stream.recv()
+                        if msg is None:
+                            logging.warning("Received 'null' in price stream", color="red")
+                            continue
+                        now = time.time()
+                        for item in (msg["data"] if isinstance(msg, dict) else msg):
+                            coin = coins.get(item["s"])
+                            if coin is None and item["s"].endswith("USDT") and item["s"] in self.symbols:
+                                coin = coins[item["s"]] = item["s"][:-4]  # listed since the start
+                            if coin is not None:
+                                self.prices.update(coin, float(item["p"]), now)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logging.error(f"All-market price stream failed: {err}")
+                await asyncio.sleep(ORDER_RETRY_SLEEP)
 
     async def _cancel_order(self, oid: str, symbol: str):
         try:
@@ -739,16 +899,46 @@ class FuturesTrader:
 
     # MARK: Rouding for min quantity and min price for symbols
 
+    async def _load_symbols(self):
+        # From the cache when there's one, then kept up to date in the background (right away
+        # if it's older than EXCHANGE_INFO_TTL). Only a missing cache holds up the start.
+        cached = load_exchange_info(self.exchange_info_path) if self.exchange_info_path else None
+        if cached is None:
+            await self._refresh_symbols()
+        else:
+            self.symbols.sync(cached[0])
+            logging.info(f"Loaded {len(self.symbols)} symbols cached {round(time.time() - cached[1])}s ago")
+
+        async def _refresher(stale):
+            while True:
+                if not stale:
+                    await asyncio.sleep(EXCHANGE_INFO_REFRESH)
+                stale = False
+                try:
+                    await self._refresh_symbols()
+                except Exception as err:
+                    logging.error(f"Failed to refresh exchange info: {err}")
+
+        asyncio.ensure_future(_refresher(cached is not None and time.time() - cached[1] > EXCHANGE_INFO_TTL))
+
+    async def _refresh_symbols(self):
+        resp = await self.client.futures_exchange_info()
+        added, changed, removed = self.symbols.sync(resp["symbols"])
+        if added or changed or removed:
+            logging.info(f"Exchange info: {len(added)} added {added[:10]}, {len(changed)} changed, "
+                         f"{len(removed)} removed {removed[:10]}", color="magenta")
+        if self.exchange_info_path:
+            save_exchange_info(self.exchange_info_path, resp["symbols"])
+
+    def _spec(self, symbol: str) -> SymbolSpec:
+        spec = self.symbols.get(symbol)
+        return spec if spec is not None else SymbolSpec(symbol)
+
+    def _tick_size(self, symbol: str):
+        return self._spec(symbol).tick or None
+
     def _round_price(self, symbol: str, price: float):
-        info = self.symbols[symbol]
-        for f in info["filters"]:
-            if f["filterType"] == "PRICE_FILTER":
-                return round(price, int(round(math.log(1 / float(f["tickSize"]), 10), 0)))
-        return price
+        return self._spec(symbol).price(price)
 
     def _round_qty(self, symbol: str, qty: float):
-        info = self.symbols[symbol]
-        for f in info["filters"]:
-            if f["filterType"] == "LOT_SIZE":
-                return round(qty, int(round(math.log(1 / float(f["minQty"]), 10), 0)))
-        return qty
+        return self._spec(symbol).qty(qty)
@@ -0,0 +1,341 @@
+import argparse
+import asyncio
+import ast
+import gc
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+
+from . import signal
+from .prices import PriceFeed
+from .signal import Signal
+from .streams import AGG_TRADE, BOOK_TICKER, SOURCES, PriceStream
+from .tokenizer import ParsedMessage, extract_numbers
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), "test_signal.py")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "bench_baseline.json")
+DEFAULT_REPEAT = 20
+MIN_SAMPLES = 30  # channels with fewer messages are reported but not gated on, their p50 is noise
+MIN_P50_US = 10  # nor are the ones faster than this, a few us either way is scheduling jitter
+
+ACCEPTED = "accepted"
+REJECTED = "rejected"
+
+
+def load_corpus(path=CORPUS_PATH):
+    # (channel, text) for every message given to `_assert_signal` in the test suite, either
+    # directly or through `assertRaises(exc, self._assert_signal, ...)`
+    with open(path) as fd:
+        tree = ast.parse(fd.read())
+    corpus = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Attribute):
+            continue
+        args = node.args
+        if node.func.attr == "assertRaises":
+            if len(args) < 2 or not (isinstance(args[1], ast.Attribute) and args[1].attr == "_assert_signal"):
+                continue
+            args = args[2:]
+        elif node.func.attr != "_assert_signal":
+            continue
+        if len(args) < 2 or not isinstance(args[0], ast.Name):
+            continue
+        try:
+            text = ast.literal_eval(args[1])  # ast.Str before 3.8, ast.Constant after
+        except ValueError:
+            continue
+        if isinstance(text, str):
+            corpus.append((args[0].id, text.lower()))
+    corpus.sort(key=lambda item: item[0])
+    return corpus
+
+
+def outcome(cls, text):
+    try:
+        res = cls.parse(text)
+    except AssertionError:
+        return REJECTED
+    except Exception:
+        return None
+    return ACCEPTED if isinstance(res, Signal) else None
+
+
+def samples(corpus):
+    # Every parser gets its own messages plus the other channels' messages, which it is
+    # expected to reject - that's what a parser sees for chatter and forwarded posts.
+    # Close/move commands are left out, they don't exercise the signal path.
+    res = {}
+    for name in sorted({name for name, _ in corpus}):
+        cls = getattr(signal, name)
+        for _, text in corpus:
+            kind = outcome(cls, text)
+            if kind is not None:
+                res.setdefault(name, {ACCEPTED: [], REJECTED: []})[kind].append(text)
+    return res
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[k]
+
+
+def measure(cls, texts, repeat):
+    # Best of `repeat` runs per message, collected with the GC off - keeps the per-channel
+    # percentiles stable enough to compare between runs
+    timings = [None] * len(texts)
+    clock = time.perf_counter_ns
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            for k, text in enumerate(texts):
+                start = clock()
+                try:
+                    cls.parse(text)
+                except Exception:
+                    pass
+                elapsed = clock() - start
+                if timings[k] is None or elapsed < timings[k]:
+                    timings[k] = elapsed
+    finally:
+        gc.enable()
+    return timings
+
+
+def calibrate(corpus, repeat):
+    # Fixed reference workload (plain number extraction over the corpus) timed in between the
+    # parsers - baselines are scaled by it so a slower or busier host isn't a regression
+    lines = [line for _, text in corpus for line in text.split("\n")]
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for line in lines:
+            extract_numbers(line)
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best / 1e3, 2)
+
+
+def _inline_tokens(text):
+    # How every parser split a message, and got the numbers of its lines, before ParsedMessage
+    # was shared between them
+    return [extract_numbers(line) for line in map(str.strip, text.lower().split("\n")) if line]
+
+
+def _parsed_tokens(text):
+    return [extract_numbers(line) for line in ParsedMessage(text).content]
+
+
+def tokenizer(corpus, repeat):
+    # ParsedMessage against the inline tokenizing it replaced, runs of the two alternate so a
+    # busy host slows both down - best run of each in us per message
+    texts = [text for _, text in corpus]
+    best = {}
+    for _ in range(repeat):
+        for name, split in (("inline_us", _inline_tokens), ("parsed_us", _parsed_tokens)):
+            start = time.perf_counter_ns()
+            for text in texts:
+                split(text)
+            elapsed = (time.perf_counter_ns() - start) / len(texts) / 1e3
+            best[name] = min(best.get(name, elapsed), elapsed)
+    return {name: round(us, 2) for name, us in best.items()}
+
+
+def stats(timings):
+    total = sum(timings)
+    return {
+        "count": len(timings),
+        "p50_us": round(percentile(timings, 50) / 1e3, 2),
+        "p99_us": round(percentile(timings, 99) / 1e3, 2),
+        "msgs_per_sec": round(len(timings) / total * 1e9) if total else 0,
+    }
+
+
+def run(corpus=None, repeat=DEFAULT_REPEAT):
+    # Every round times all the channels once, a host which gets busier halfway through the
+    # run slows all of them down rather than the ones measured last
+    corpus = load_corpus() if corpus is None else corpus
+    report = {"channels": {}}
+    jobs = []
+    for name, texts in samples(corpus).items():
+        cls = getattr(signal, name)
+        measure(cls, texts[ACCEPTED] + texts[REJECTED], 1)  # warm up the compiled rules
+        jobs += [(name, kind, cls, texts[kind]) for kind in (ACCEPTED, REJECTED) if texts[kind]]
+    best = {}
+    reference = []
+    for _ in range(repeat):
+        reference.append(calibrate(corpus, 1))
+        for name, kind, cls, texts in jobs:
+            timings = measure(cls, texts, 1)
+            prev = best.get((name, kind))
+            best[(name, kind)] = timings if prev is None else list(map(min, prev, timings))
+    overall = {ACCEPTED: [], REJECTED: []}
+    for (name, kind), timings in best.items():
+        report["channels"].setdefault(name, {})[kind] = stats(timings)
+        overall[kind].extend(timings)
+    report["total"] = {kind: stats(timings) for kind, timings in overall.items()}
+    report["calibration_us"] = min(reference)  # best run, as for the parsers
+    report["tokenizer"] = tokenizer(corpus, repeat * 4)
+    return report
+
+
+def compare(report, baseline, tolerance=0.3, min_samples=MIN_SAMPLES, min_us=MIN_P50_US):
+    # p50 is compared as p99 is too noisy to gate on, and only for the totals and the channels
+    # with `min_samples` messages or more on both sides and a p50 of at least `min_us`
+    regressions = []
+    scale = 1.0
+    if baseline.get("calibration_us") and report.get("calibration_us"):
+        scale = report["calibration_us"] / baseline["calibration_us"]
+    sections = [("total", report["total"], baseline.get("total", {}))]
+    sections += [(name, res, baseline.get("channels", {}).get(name, {}))
+                 for name, res in report["channels"].items()]
+    for name, res, base in sections:
+        for kind, cur in res.items():
+            ref = base.get(kind)
+            if not ref or not ref["p50_us"]:
+                continue
+            expected = ref["p50_us"] * scale
+            if name != "total" and (min(ref.get("count", 0), cur.get("count", 0)) < min_samples or expected < min_us):
+                continue
+            if cur["p50_us"] > expected * (1 + tolerance):
+                regressions.append((name, kind, round(expected, 2), cur["p50_us"]))
+    # the shared tokenizer has to be no slower than what the parsers did on their own
+    tok = report.get("tokenizer")
+    if tok and tok["parsed_us"] > tok["inline_us"] * (1 + tolerance):
+        regressions.append(("tokenizer", "parsed", tok["inline_us"], tok["parsed_us"]))
+    return regressions
+
+
+def signal_footprint(corpus=None, count=10000):
+    # Retained memory and allocated blocks per Signal, built from the corpus' accepted signals,
+    # and the cost of a dict/bytes round-trip
+    corpus = load_corpus() if corpus is None else corpus
+    parsed = []
+    for name, text in corpus:
+        try:
+            sig = getattr(signal, name).parse(text)
+        except Exception:
+            continue
+        if isinstance(sig, Signal) and not sig.is_partial:
+            parsed.append((sig.coin, list(sig.entries), list(sig.targets), sig.sl, sig.leverage, sig.tag))
+    args = [parsed[k % len(parsed)] for k in range(count)]
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    # fresh lists and floats for every signal, like the parsers hand them over
+    signals = [Signal(coin, [x + 0.0 for x in e], [x + 0.0 for x in t], sl, lev, tag=tag)
+               for coin, e, t, sl, lev, tag in args]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    diff = after.compare_to(before, "filename")
+    res = {
+        "bytes_per_signal": round(sum(d.size_diff for d in diff) / count, 1),
+        "blocks_per_signal": round(sum(d.count_diff for d in diff) / count, 2),
+    }
+    for kind, dump, load in (("dict", "to_dict", "from_dict"), ("bytes", "to_bytes", "from_bytes")):
+        if not hasattr(Signal, dump):
+            continue
+        start = time.perf_counter_ns()
+        for sig in signals:
+            getattr(Signal, load)(getattr(sig, dump)())
+        res[f"{kind}_roundtrip_us"] = round((time.perf_counter_ns() - start) / count / 1e3, 2)
+    return res
+
+
+def price_payload(source, coin, k):
+    # Binance-shaped stream payloads, the fields the parsers don't read are kept for the JSON cost
+    now = 1620000000000 + k
+    price = 100 + (k % 50) / 100
+    if source == AGG_TRADE:
+        return {"e": "aggTrade", "E": now, "s": f"{coin}USDT", "a": k, "p": f"{price:.2f}", "q": "1.5",
+                "f": k, "l": k, "T": now, "m": k % 2 == 0}
+    if source == BOOK_TICKER:
+        return {"e": "bookTicker", "u": k, "s": f"{coin}USDT", "b": f"{price:.2f}", "B": "10",
+                "a": f"{price + 0.01:.2f}", "A": "12", "T": now, "E": now}
+    return {"e": "markPriceUpdate", "E": now, "s": f"{coin}USDT", "p": f"{price:.2f}",
+            "i": f"{price:.2f}", "P": f"{price:.2f}", "r": "0.0001", "T": now}
+
+
+def price_streams(count=100000, coins=5, burst=50):
+    # Handler cost per message for every price source, with and without conflation. Messages
+    # come in bursts of `burst` per loop tick (round-robin over `coins` coins) and are decoded
+    # from JSON like the connection does, CPU time is the process time spent on all of it.
+    names = [f"C{k}" for k in range(coins)]
+
+    async def _feed(stream, raw):
+        for k in range(0, len(raw), burst):
+            for frame in raw[k:k + burst]:
+                msg = json.loads(frame)
+                stream(msg["stream"], msg["data"])
+            await asyncio.sleep(0)
+
+    res = {}
+    for source in SOURCES:
+        for conflate in (False, True):
+            stream = PriceStream(PriceFeed(names), source, conflate=conflate)
+            streams = [stream.stream(coin) for coin in names]
+            raw = [json.dumps({"stream": streams[k % coins], "data": price_payload(source, names[k % coins], k)})
+                   for k in range(count)]
+            start, cpu = time.perf_counter(), time.process_time()
+            asyncio.run(_feed(stream, raw))
+            elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+            res[f"{source}{'+conflated' if conflate else ''}"] = {
+                "callbacks_per_sec": round(stream.received / elapsed),
+                "cpu_us_per_msg": round(cpu / count * 1e6, 2),
+                "updates": stream.applied,
+            }
+    return res
+
+
+def print_report(report, out=sys.stdout):
+    out.write(f"{'channel':<10}{'kind':<10}{'count':>7}{'p50 us':>10}{'p99 us':>10}{'msgs/s':>10}\n")
+    rows = sorted(report["channels"].items()) + [("TOTAL", report["total"])]
+    for name, res in rows:
+        for kind, s in res.items():
+            out.write(f"{name:<10}{kind:<10}{s['count']:>7}{s['p50_us']:>10}{s['p99_us']:>10}{s['msgs_per_sec']:>10}\n")
+    if "tokenizer" in report:
+        tok = report["tokenizer"]
+        out.write(f"tokenizer: {tok['parsed_us']}us per message, {tok['inline_us']}us inline\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Signal parser benchmark")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed p50 slowdown (0.3 = 30%%)")
+    parser.add_argument("--signals", action="store_true", help="measure Signal memory and serialization instead")
+    parser.add_argument("--prices", action="store_true", help="measure the price stream handlers instead")
+    args = parser.parse_args(argv)
+
+    if args.signals:
+        print(json.dumps(signal_footprint(), indent=2))
+        return 0
+    if args.prices:
+        print(json.dumps(price_streams(), indent=2))
+        return 0
+
+    report = run(repeat=args.repeat)
+    print_report(report)
+    if args.save:
+        with open(args.baseline, "w") as fd:
+            json.dump(report, fd, indent=2)
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as fd:
+        baseline = json.load(fd)
+    regressions = compare(report, baseline, args.tolerance)
+    for name, kind, ref, cur in regressions:
+        print(f"REGRESSION {name} {kind}: p50 {ref}us (scaled baseline) -> {cur}us")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
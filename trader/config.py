@@ -0,0 +1,43 @@
+from typing import NamedTuple, Tuple
+
+
+class Config(NamedTuple):
+    rf: float = None  # risk factor
+    rr: float = None  # minimum risk-reward
+    routed: Tuple[int, ...] = ()  # unregistered chats parsed through the router
+    max_age: float = None  # seconds after which a signal is too old to trade
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(rf=data.get("rf"), rr=data.get("rr"), routed=tuple(data.get("routed", ())),
+                   max_age=data.get("max_age"))
+
+    def to_dict(self) -> dict:
+        res = {}
+        if self.rf is not None:
+            res["rf"] = self.rf
+        if self.rr is not None:
+            res["rr"] = self.rr
+        if self.routed:
+            res["routed"] = list(self.routed)
+        if self.max_age is not None:
+            res["max_age"] = self.max_age
+        return res
+
+
+class ConfigStore:
+    # Holds the current Config snapshot. Readers take `current` without any lock, updates build
+    # a new snapshot and swap it in (and into the persisted state) in one step.
+
+    def __init__(self, state: dict):
+        self.state = state
+        self.current = Config.from_dict(state.get("config") or {})
+        self.listeners = []  # called with every new snapshot
+
+    def update(self, **changes) -> Config:
+        config = self.current._replace(**changes)
+        self.state["config"] = config.to_dict()
+        self.current = config
+        for listener in self.listeners:
+            listener(config)
+        return config
@@ -32,3 +32,15 @@ class ModifyTargetsException(Exception):
     def __init__(self, tag, targets):
         self.tag = tag
         self.targets = targets
+
+
+class ParseBudgetException(Exception):
+    def __init__(self, reason, value):
+        self.reason = reason
+        self.value = value
+
+
+class InvalidOrderException(Exception):
+    def __init__(self, symbol, reason):
+        self.symbol = symbol
+        self.reason = reason
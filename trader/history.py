@@ -0,0 +1,132 @@
+import json
+import re
+import traceback
+
+from .errors import CloseTradeException, ModifyTargetsException, MoveStopLossException, ParseBudgetException
+from .signal import CHANNELS, Signal
+
+CHUNK_SIZE = 1 << 20
+MESSAGES_PATTERN = re.compile(r'"messages"\s*:\s*\[')
+ID_PATTERN = re.compile(r'"id"\s*:\s*(-?\d+)')
+WHITESPACE = " \t\r\n,"
+
+
+def chat_id_of(export_id):
+    # Telegram exports have bare channel ids, the client sees them as -100<id>
+    n = int(export_id)
+    return n if n < 0 else int(f"-100{n}")
+
+
+def text_of(text):
+    if isinstance(text, list):
+        return "".join(part if isinstance(part, str) else part.get("text", "") for part in text)
+    return text or ""
+
+
+def read_history(path, chat_id=None):
+    with open(path, encoding="utf-8") as fd:
+        reader = read_jsonl if path.endswith(".jsonl") else read_export
+        yield from reader(fd, chat_id)
+
+
+def read_jsonl(fd, chat_id=None):
+    # One message per line: {"chat_id": ..., "id": ..., "date": ..., "text": ...}
+    for line in fd:
+        if not line.strip():
+            continue
+        obj = json.loads(line)
+        cid = chat_id if chat_id is not None else obj.get("chat_id")
+        yield cid, obj.get("id"), obj.get("date"), text_of(obj.get("text"))
+
+
+def read_export(fd, chat_id=None):
+    # Streams messages out of a Telegram Desktop JSON export (single chat or a full account
+    # export) without loading it: messages are decoded one by one and the chat they belong
+    # to is the last "id" seen before the "messages" list.
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+    chat, in_list = chat_id, False
+    while True:
+        if not in_list:
+            m = MESSAGES_PATTERN.search(buf, pos)
+            end = m.start() if m else len(buf)
+            ids = ID_PATTERN.findall(buf, pos, end)
+            if ids and chat_id is None:
+                chat = chat_id_of(ids[-1])
+            if m is not None:
+                pos, in_list = m.end(), True
+                continue
+            if eof:
+                return
+            buf = buf[max(pos, len(buf) - 64):]  # marker or id might be split between chunks
+            pos = 0
+        else:
+            while pos < len(buf) and buf[pos] in WHITESPACE:
+                pos += 1
+            if pos < len(buf) and buf[pos] == "]":
+                pos, in_list = pos + 1, False
+                continue
+            if pos < len(buf):
+                try:
+                    obj, pos = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                else:
+                    if obj.get("type", "message") == "message":
+                        yield chat, obj.get("id"), obj.get("date"), text_of(obj.get("text"))
+                    continue
+            elif eof:
+                return
+            buf = buf[pos:]
+            pos = 0
+        chunk = fd.read(CHUNK_SIZE)
+        eof = not chunk
+        buf += chunk
+
+
+def signal_dict(sig: Signal) -> dict:
+    return {
+        "coin": sig.coin,
+        "is_long": sig.is_long if (sig.is_partial or sig.targets) else None,
+        "entries": sig.entries.tolist(),
+        "targets": sig.targets.tolist(),
+        "sl": sig.sl,
+        "leverage": sig.leverage,
+        "risk": sig.risk,
+        "force_limit": sig.force_limit_order,
+        "tag": sig.tag,
+    }
+
+
+def parse_message(chat_id, msg_id, date, text) -> dict:
+    ch = CHANNELS.get(chat_id)
+    res = {"chat_id": chat_id, "id": msg_id, "date": date, "channel": ch.__name__ if ch else None}
+    if ch is None:
+        res["status"] = "unknown_channel"
+        return res
+    try:
+        sig = Signal.parse(chat_id, text)
+    except CloseTradeException as err:
+        res.update(status="close", tag=err.tag, coin=err.coin)
+    except MoveStopLossException as err:
+        res.update(status="move_sl", tag=err.tag, price=err.price)
+    except ModifyTargetsException as err:
+        res.update(status="modify_targets", tag=err.tag, targets=err.targets)
+    except ParseBudgetException as err:
+        res.update(status="budget", reason=f"{err.reason}: {err.value}")
+    except AssertionError as err:
+        frame = traceback.extract_tb(err.__traceback__)[-1]
+        res.update(status="rejected", reason=f"{frame.name}: {frame.line}")
+    except Exception as err:
+        res.update(status="error", reason=f"{type(err).__name__}: {err}")
+    else:
+        if sig is None:
+            res["status"] = "filtered"
+        else:
+            res.update(status="signal", signal=signal_dict(sig))
+    return res
+
+
+def parse_chunk(messages) -> list:
+    return [parse_message(*msg) for msg in messages]
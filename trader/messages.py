@@ -0,0 +1,77 @@
+import collections
+import shelve
+
+from cachetools import LRUCache
+
+from .signal import Signal
+
+
+class MessageCache(LRUCache):
+    # Signals parsed from channel messages by (chat_id, message_id), kept with the signal that
+    # was queued so the order tag it ends up with can be looked up. Replies to these messages
+    # (close, move SL, ...) are resolved from here instead of fetching the parent. Evicted entries
+    # are spilled to `path` (at most `spill_size` of them) when it's given, which also keeps them
+    # across restarts.
+
+    def __init__(self, maxsize=2048, path=None, spill_size=50000):
+        super().__init__(maxsize)
+        self.spill = shelve.open(path) if path else None
+        self.spill_size = spill_size
+        self.spilled = collections.deque(self.spill.keys() if self.spill is not None else ())
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, chat_id: int, msg_id: int, sig: Signal):
+        # the original parse is copied as the queued signal gets corrected and tagged in place
+        self[(chat_id, msg_id)] = (sig.copy(), sig)
+
+    def parent(self, chat_id: int, msg_id: int):
+        # (signal as parsed, order tag) for a message or None if it's unknown
+        key = (chat_id, msg_id)
+        if key in self:
+            self.hits += 1
+            sig, queued = self[key]
+            return sig, queued.tag
+        if self.spill is not None:
+            data = self.spill.get(self._spill_key(key))
+            if data is not None:
+                self.hits += 1
+                return Signal.from_bytes(data[0]), data[1]
+        self.misses += 1
+
+    def replace(self, chat_id: int, msg_id: int, sig: Signal):
+        # new parse of an edited message, the order tag stays
+        key = (chat_id, msg_id)
+        if key in self:
+            self[key] = (sig.copy(), self[key][1])
+        elif self.spill is not None:
+            skey = self._spill_key(key)
+            data = self.spill.get(skey)
+            if data is not None:
+                self.spill[skey] = (sig.to_bytes(), data[1])
+
+    def popitem(self):
+        key, value = super().popitem()
+        if self.spill is not None:
+            self._spill(key, value)
+        return key, value
+
+    def close(self):
+        if self.spill is None:
+            return
+        for key, value in list(self.items()):
+            self._spill(key, value)
+        self.spill.close()
+        self.spill = None
+
+    def _spill(self, key, value):
+        skey = self._spill_key(key)
+        if skey not in self.spill:
+            self.spilled.append(skey)
+        self.spill[skey] = (value[0].to_bytes(), value[1].tag)
+        while len(self.spilled) > self.spill_size:
+            self.spill.pop(self.spilled.popleft(), None)
+
+    @staticmethod
+    def _spill_key(key):
+        return f"{key[0]}:{key[1]}"
@@ -0,0 +1,125 @@
+import asyncio
+import collections
+
+from telethon.errors import FloodWaitError
+
+from .logger import DEFAULT_LOGGER as logging
+
+MAX_PENDING = 1000
+MAX_MESSAGE_LENGTH = 4096  # Telegram's limit for a text message
+LINGER = 0.5  # wait for the rest of a burst before sending
+MAX_RETRIES = 3
+RETRY_SLEEP = 2
+SEPARATOR = "\n\n"
+STOP_TIMEOUT = 10  # seconds given to send what's pending when stopping
+
+
+class Outbox:
+    # Notifications are posted without blocking and sent by a task of their own. Whatever piles
+    # up while a message is being sent (or within LINGER of the first one) goes out as a single
+    # digest, and a FloodWait pauses the sender for as long as Telegram asks. When MAX_PENDING
+    # messages are waiting the oldest ones are dropped. Stopping sends what's left first, for
+    # up to STOP_TIMEOUT.
+
+    def __init__(self, send, max_pending=MAX_PENDING, linger=LINGER):
+        self.send = send
+        self.linger = linger
+        self.pending = collections.deque(maxlen=max_pending)
+        self.task = None
+        self._ready = None
+        self._busy = False
+        self.posted = 0
+        self.sent = 0
+        self.digests = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flood_waits = 0
+        self.max_depth = 0
+
+    def post(self, message: str):
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+            logging.warning(f"Outbox is full, dropping: {self.pending[0]}")
+        self.pending.append(message)
+        self.posted += 1
+        self.max_depth = max(self.max_depth, len(self.pending))
+        if self._ready is not None:
+            self._ready.set()
+
+    def start(self):
+        if self.task is None:
+            self._ready = asyncio.Event()
+            if self.pending:
+                self._ready.set()
+            self.task = asyncio.ensure_future(self._run())
+
+    async def stop(self, timeout=STOP_TIMEOUT):
+        if self.task is None:
+            return
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Outbox stopped with {len(self.pending)} message(s) unsent")
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        logging.info(f"Outbox: {self.metrics()}")
+
+    def metrics(self) -> dict:
+        return {
+            "depth": len(self.pending),
+            "max_depth": self.max_depth,
+            "posted": self.posted,
+            "sent": self.sent,
+            "digests": self.digests,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "flood_waits": self.flood_waits,
+        }
+
+    async def _drain(self):
+        while self.pending or self._busy:
+            await asyncio.sleep(0.05)
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            self._busy = True
+            if self.linger:
+                await asyncio.sleep(self.linger)
+            self._ready.clear()
+            while self.pending:
+                count, text = self._digest()
+                await self._send(text, count)
+            self._busy = False
+
+    def _digest(self):
+        parts = [self.pending.popleft()]
+        size = len(parts[0])
+        while self.pending and size + len(SEPARATOR) + len(self.pending[0]) <= MAX_MESSAGE_LENGTH:
+            size += len(SEPARATOR) + len(self.pending[0])
+            parts.append(self.pending.popleft())
+        return len(parts), SEPARATOR.join(parts)
+
+    async def _send(self, text, count):
+        attempt = 0
+        while True:
+            try:
+                await self.send(text)
+                self.sent += count
+                self.digests += count > 1
+                return
+            except FloodWaitError as err:
+                self.flood_waits += 1
+                logging.warning(f"Waiting {err.seconds}s before posting results as asked by Telegram")
+                await asyncio.sleep(err.seconds)
+            except Exception:
+                attempt += 1
+                if attempt >= MAX_RETRIES:
+                    self.failed += count
+                    logging.exception(f"Failed to send result: {text}")
+                    return
+                await asyncio.sleep(RETRY_SLEEP * 2 ** (attempt - 1))
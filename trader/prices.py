@@ -0,0 +1,197 @@
+import array
+import asyncio
+import math
+import time
+
+from .errors import PriceUnavailableException
+
+PRICE_TIMEOUT = 10  # seconds to wait for the first price of a coin
+SNAPSHOT_TTL = 2  # seconds a bulk (REST) snapshot is reused for
+RING_SIZE = 256  # trades kept per streamed coin, 8 KiB each
+RANGE_WINDOW = 60  # seconds of trades the recent low/high is taken over
+
+NONE = 0
+STREAM = 1
+SNAPSHOT = 2
+SOURCES = ("none", "stream", "snapshot")
+
+
+class TradeRing:
+    # Last `size` trades of a coin (price, quantity, exchange and receive time) in arrays which
+    # are allocated up front, the oldest trade is overwritten by the newest.
+    __slots__ = ("size", "prices", "qtys", "times", "received", "head", "count")
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self.prices = array.array("d", bytes(8 * size))
+        self.qtys = array.array("d", bytes(8 * size))
+        self.times = array.array("d", bytes(8 * size))
+        self.received = array.array("d", bytes(8 * size))
+        self.head = 0  # where the next trade goes
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, price: float, qty: float, at: float, received: float):
+        i = self.head
+        self.prices[i] = price
+        self.qtys[i] = qty
+        self.times[i] = at
+        self.received[i] = received
+        self.head = (i + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def last(self):
+        return self.prices[self.head - 1] if self.count else None
+
+    def age(self, now=None):
+        if not self.count:
+            return None
+        return (time.time() if now is None else now) - self.received[self.head - 1]
+
+    def latency(self):
+        # how late the last trade arrived after the exchange made it
+        return self.received[self.head - 1] - self.times[self.head - 1] if self.count else None
+
+    def range(self, window=RANGE_WINDOW, now=None):
+        # (low, high) of the trades received within `window` seconds, newest first
+        since = (time.time() if now is None else now) - window
+        low = high = None
+        i = self.head
+        for _ in range(self.count):
+            i -= 1  # negative indexes wrap around
+            if self.received[i] < since:
+                break
+            price = self.prices[i]
+            if low is None or price < low:
+                low = price
+            if high is None or price > high:
+                high = price
+        return None if low is None else (low, high)
+
+
+class PriceFeed:
+    # Latest price per coin as the streams deliver them, with the time and where it came from.
+    # Every coin gets a slot in flat arrays (NaN until there's a price), so a table of every
+    # symbol on the exchange stays small. Waiting for the first price of a coin is a future
+    # which the stream resolves, so waiters wake up on the tick itself. Missing prices can be
+    # filled from a bulk snapshot, which concurrent callers share. Coins streamed from trades also
+    # keep their recent trades in a TradeRing.
+
+    def __init__(self, coins=()):
+        self.slots = {}
+        self.values = array.array("d")
+        self.times = array.array("d")
+        self.sources = array.array("B")
+        self.waiters = {}
+        self.rings = {}
+        self.refreshed = 0.0
+        self.refreshing = None
+        self.snapshots = 0
+        for coin in coins:
+            self.slot(coin)
+
+    def slot(self, coin: str) -> int:
+        i = self.slots.get(coin)
+        if i is None:
+            i = self.slots[coin] = len(self.values)
+            self.values.append(math.nan)
+            self.times.append(0.0)
+            self.sources.append(NONE)
+        return i
+
+    def get(self, coin: str, max_age=None):
+        i = self.slots.get(coin)
+        if i is None:
+            return None
+        price = self.values[i]
+        if math.isnan(price) or (max_age is not None and time.time() - self.times[i] > max_age):
+            return None
+        return price
+
+    def age(self, coin: str):
+        i = self.slots.get(coin)
+        if i is None or math.isnan(self.values[i]):
+            return None
+        return time.time() - self.times[i]
+
+    def source(self, coin: str) -> str:
+        i = self.slots.get(coin)
+        return SOURCES[self.sources[i] if i is not None and not math.isnan(self.values[i]) else NONE]
+
+    def range(self, coin: str, window=RANGE_WINDOW):
+        ring = self.rings.get(coin)
+        return ring.range(window) if ring is not None else None
+
+    def update(self, coin: str, price: float, now=None, source=STREAM, qty=None, at=None):
+        # `qty` and `at` (exchange time) are given for trades, which go into the coin's ring too
+        i = self.slots.get(coin)
+        if i is None:
+            i = self.slot(coin)
+        if now is None:
+            now = time.time()
+        self.values[i] = price
+        self.times[i] = now
+        self.sources[i] = source
+        if qty is not None:
+            self.record(coin, price, qty, now if at is None else at, now)
+        if self.waiters:
+            waiter = self.waiters.pop(coin, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(price)
+
+    def record(self, coin: str, price: float, qty: float, at: float, received: float):
+        # a trade for the coin's ring only, the last price isn't touched
+        ring = self.rings.get(coin)
+        if ring is None:
+            ring = self.rings[coin] = TradeRing()
+        ring.append(price, qty, at, received)
+
+    def pop(self, coin: str):
+        price = self.get(coin)
+        if price is not None:
+            self.values[self.slots[coin]] = math.nan
+        self.rings.pop(coin, None)
+        return price
+
+    async def refresh(self, fetch):
+        # Fills prices from `fetch()` -> [(coin, price, time), ...] unless a snapshot was taken
+        # within SNAPSHOT_TTL. Callers arriving while one is being fetched wait for that one.
+        if self.refreshing is None:
+            if time.time() - self.refreshed < SNAPSHOT_TTL:
+                return
+            self.refreshing = asyncio.ensure_future(self._refresh(fetch))
+        await asyncio.shield(self.refreshing)
+
+    async def _refresh(self, fetch):
+        # `time` of an item is its last trade, which can be minutes ago on a quiet coin - the
+        # price is still current when the snapshot arrives, and is stamped with that
+        try:
+            items = await fetch()
+            received = time.time()
+            self.snapshots += 1
+            for coin, price, at in items:
+                i = self.slots.get(coin)
+                if i is None or math.isnan(self.values[i]) or self.times[i] < at:
+                    self.update(coin, price, received, SNAPSHOT)
+                else:  # streamed after that trade, and nothing traded since
+                    self.times[i] = received
+            self.refreshed = received
+        finally:
+            self.refreshing = None
+
+    async def wait(self, coin: str, timeout=PRICE_TIMEOUT, max_age=None) -> float:
+        # stale prices (older than `max_age`) count as missing
+        price = self.get(coin, max_age)
+        if price is not None:
+            return price
+        waiter = self.waiters.get(coin)
+        if waiter is None:
+            waiter = self.waiters[coin] = asyncio.get_event_loop().create_future()
+        try:
+            # shielded as other signals for the coin may be waiting on it too
+            return await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            raise PriceUnavailableException()
@@ -0,0 +1,438 @@
+import re
+import time
+
+from .errors import ParseBudgetException
+from .tokenizer import extract_numbers, extract_optional_number, extract_symbol, symbol_pattern, symbol_regex
+
+SET = "set"
+FIRST = "first"  # only assign when the field is still empty
+APPEND = "append"
+EXTEND = "extend"
+
+SKIP = object()  # returned by a take to leave the field untouched
+BUDGET_STRIDE = 50  # steps taken between two checks of the budget, a message can overrun it by that much
+
+
+class Pattern:
+    capture = False
+
+    def __init__(self, regex: str, gate=None):
+        self.regex = regex
+        self.gate = gate  # literal which must be in the line for the regex to match
+
+    def compiled(self):
+        return re.compile(self.regex)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.regex == other.regex
+
+    def __hash__(self):
+        return hash((type(self), self.regex))
+
+    def found_in(self, msg):
+        return msg.search(self.regex) is not None
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.regex!r})"
+
+
+class Keyword(Pattern):
+    def __init__(self, word: str):
+        super().__init__(re.escape(word))
+        self.word = word
+
+    def found_in(self, msg):
+        return self.word in msg
+
+
+class Symbol(Pattern):
+    capture = True
+
+    def __init__(self, prefix="#", suffix="usdt"):
+        gate = suffix or (re.sub(r"\\(.)", r"\1", prefix) if prefix else None)
+        super().__init__(symbol_regex(prefix, suffix), gate=gate)
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def compiled(self):
+        return symbol_pattern(self.prefix, self.suffix)
+
+
+def pattern(spec):
+    return spec if isinstance(spec, Pattern) else Keyword(spec)
+
+
+def any_of(spec):
+    # A condition is either a single pattern or a tuple of alternatives
+    return tuple(map(pattern, spec)) if isinstance(spec, tuple) else (pattern(spec),)
+
+
+def conditions(specs):
+    if specs is None:
+        return ()
+    if not isinstance(specs, tuple):
+        specs = (specs,)
+    return tuple(map(any_of, specs))
+
+
+# MARK: Takes - extract a value from line `i` of the scan
+
+
+def numbers(scan, i):
+    return extract_numbers(scan.lines[i])
+
+
+def number(scan, i):
+    return extract_optional_number(scan.lines[i])
+
+
+def first(scan, i):
+    return extract_numbers(scan.lines[i])[0]
+
+
+def second(scan, i):
+    return extract_numbers(scan.lines[i])[1]
+
+
+def last(scan, i):
+    return extract_numbers(scan.lines[i])[-1]
+
+
+def capture(scan, i):
+    return scan.capture
+
+
+def after_symbol(scan, i):
+    return extract_numbers(scan.lines[i], scan.fields.get("c"))
+
+
+def symbol(prefix="#", suffix="usdt"):
+    def _take(scan, i):
+        res = extract_symbol(scan.lines[i], prefix, suffix)
+        return res[1] if res else SKIP
+    return _take
+
+
+def head(n, take=numbers):
+    return lambda scan, i: take(scan, i)[:n]
+
+
+def integer(take=number, strict=True, default=None):
+    def _take(scan, i):
+        n = take(scan, i)
+        if not strict and not n:
+            return default
+        return int(n)
+    return _take
+
+
+def optional(take):
+    def _take(scan, i):
+        try:
+            return take(scan, i)
+        except IndexError:
+            return None
+    return _take
+
+
+def next_line(take=numbers, offset=1):
+    return lambda scan, i: take(scan, i + offset)
+
+
+def either(*takes):
+    def _take(scan, i):
+        for take in takes:
+            res = take(scan, i)
+            if res:
+                break
+        return res
+    return _take
+
+
+def without(mark, take=numbers):
+    def _take(scan, i):
+        assert mark not in scan.lines[i]
+        return take(scan, i)
+    return _take
+
+
+def listing(column, guard=None):
+    # Numbered lists ("1) 23.5", "2) 24.1", ...) on the lines following the keyword
+    def _take(scan, i):
+        res = []
+        for line in scan.lines[i + 1:]:
+            assert guard is None or guard not in line
+            n = extract_numbers(line)
+            if len(n) < 2:
+                break
+            res.append(n[column])
+        return res
+    return _take
+
+
+class Rule:
+    def __init__(self, match, field, take=None, mode=SET, when=None, unless=None, orelse=None):
+        self.match = any_of(match) if match is not None else None
+        self.field = field
+        if take is None:
+            take = capture if self.match and self.match[0].capture else numbers
+        self.take = take
+        self.mode = mode
+        self.when = conditions(when)
+        self.unless = tuple(p for alts in conditions(unless) for p in alts)
+        self.orelse = orelse
+
+    def patterns(self):
+        for alts in ((self.match or ()),) + self.when + (self.unless,):
+            yield from alts
+        if self.orelse is not None:
+            yield from self.orelse.patterns()
+
+
+class CompiledRule:
+    __slots__ = ("triggers", "match", "when", "unless", "conditional", "field", "take", "mode", "orelse")
+
+    def __init__(self, rule: Rule, ids: dict):
+        self.match = tuple(ids[p] for p in rule.match) if rule.match is not None else None
+        self.when = tuple(tuple(ids[p] for p in alts) for alts in rule.when)
+        self.unless = tuple(ids[p] for p in rule.unless)
+        self.field = rule.field
+        self.take = rule.take
+        self.mode = rule.mode
+        self.conditional = bool(self.when or self.unless) or self.mode == FIRST  # else `_holds` is always true
+        self.orelse = CompiledRule(rule.orelse, ids) if rule.orelse is not None else None
+        # patterns which can make this rule (or its fallback) fire - None if it runs on every line
+        self.triggers = None
+        if self.match is not None and (self.orelse is None or self.orelse.triggers is not None):
+            self.triggers = frozenset(self.match).union(self.orelse.triggers if self.orelse else ())
+
+    def apply(self, scan, i):
+        hits = scan.hits
+        hit = None
+        if self.match is None:
+            hit = True
+        else:
+            for k in self.match:
+                if k in hits:
+                    hit = hits[k]
+                    break
+        if hit is None or (self.conditional and not self._holds(scan)):
+            if self.orelse is not None:
+                self.orelse.apply(scan, i)
+            return
+
+        scan.capture = hit
+        value = self.take(scan, i)
+        if value is SKIP:
+            return
+        fields = scan.fields
+        if self.mode == APPEND:
+            fields.setdefault(self.field, []).append(value)
+        elif self.mode == EXTEND:
+            fields.setdefault(self.field, []).extend(value)
+        else:
+            fields[self.field] = value
+
+    def _holds(self, scan):
+        hits = scan.hits
+        if self.mode == FIRST and scan.fields.get(self.field):
+            return False
+        for alts in self.when:
+            for k in alts:
+                if k in hits:
+                    break
+            else:
+                return False
+        for k in self.unless:
+            if k in hits:
+                return False
+        return True
+
+
+class Matcher:
+    # Keywords of a channel are looked up in the line one by one - a substring test is cheaper
+    # than walking an alternation of them, and overlapping keywords (e.g. "lev" and "leverage")
+    # are all found. Regex rules are searched only when their literal anchor (e.g. "usdt" for
+    # symbols) is present in the line.
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.words = tuple((p.word, k) for k, p in enumerate(self.patterns) if isinstance(p, Keyword))
+        self.regexes = [(k, p.compiled().search, p.gate, p.capture)
+                        for k, p in enumerate(self.patterns) if not isinstance(p, Keyword)]
+
+    def hits(self, line: str) -> dict:
+        # Pattern ids are inserted in a fixed order, the same patterns give the same keys
+        found = {k: True for word, k in self.words if word in line}
+        for k, search, gate, cap in self.regexes:
+            if gate is not None and gate not in line:
+                continue
+            m = search(line)
+            if m is not None:
+                found[k] = m[1] if cap else True
+        return found
+
+
+class Budget:
+    # Limits for parsing one message, shared by the channel parser and its fallbacks. Steps
+    # are lines scanned plus rules applied, charged every BUDGET_STRIDE steps and at the end
+    # of each scan.
+
+    def __init__(self, seconds, steps, lines):
+        self.deadline = time.perf_counter() + seconds
+        self.steps = steps
+        self.lines = lines
+
+    def check_lines(self, n):
+        if n > self.lines:
+            raise ParseBudgetException("lines", n)
+
+    def spend(self, steps):
+        self.steps -= steps
+        if self.steps < 0:
+            raise ParseBudgetException("steps", self.steps)
+        now = time.perf_counter()
+        if now > self.deadline:
+            raise ParseBudgetException("time", now - self.deadline)
+
+
+class Scan:
+    def __init__(self, lines):
+        self.lines = lines
+        self.fields = {}
+        self.hits = {}
+        self.capture = None
+
+
+class RuleSet:
+    def __init__(self, rules, requires=()):
+        self.rules = tuple(rules)
+        self.requires = conditions(requires)
+        patterns = []
+        for rule in self.rules:
+            for p in rule.patterns():
+                if p not in patterns:
+                    patterns.append(p)
+        ids = {p: k for k, p in enumerate(patterns)}
+        self.matcher = Matcher(patterns)
+        self._rules = tuple(CompiledRule(rule, ids) for rule in self.rules)
+        self.always = any(rule.triggers is None for rule in self._rules)
+        self._firing = {}  # pattern ids found in a line -> rules to apply, at most 2^len(patterns)
+
+    def anchors(self, field):
+        # Literals one of which has to be in the text for `field` to be set, None if there's a
+        # rule which can set it without one
+        res = set()
+        for rule in self.rules:
+            while rule is not None:
+                if rule.field == field:
+                    if rule.match is None:
+                        return None
+                    for p in rule.match:
+                        literal = p.word if isinstance(p, Keyword) else p.gate
+                        if literal is None:
+                            return None
+                        res.add(literal)
+                rule = rule.orelse
+        return tuple(sorted(res))
+
+    def accepts(self, msg) -> bool:
+        for alts in self.requires:
+            for p in alts:
+                if p.found_in(msg):
+                    break
+            else:
+                return False
+        return True
+
+    def scan(self, lines, budget: Budget = None) -> dict:
+        scan = Scan(lines)
+        words, regexes = self.matcher.words, self.matcher.regexes
+        firing, always = self._firing, self.always
+        if budget is not None:
+            budget.check_lines(len(lines))
+        steps = 0  # not yet charged to the budget
+        for i, line in enumerate(lines):
+            steps += 1
+            hits = {}  # Matcher.hits, inlined
+            for word, k in words:
+                if word in line:
+                    hits[k] = True
+            for k, search, gate, cap in regexes:
+                if gate is None or gate in line:
+                    m = search(line)
+                    if m is not None:
+                        hits[k] = m[1] if cap else True
+            if hits or always:
+                scan.hits = hits
+                key = tuple(hits)
+                rules = firing.get(key)
+                if rules is None:
+                    rules = firing[key] = self._fired_by(hits)
+                for rule in rules:
+                    rule.apply(scan, i)
+                steps += len(rules)
+            if steps >= BUDGET_STRIDE and budget is not None:
+                budget.spend(steps)
+                steps = 0
+        if steps and budget is not None:
+            budget.spend(steps)
+        return scan.fields
+
+    def _fired_by(self, hits) -> tuple:
+        return tuple(rule for rule in self._rules if rule.triggers is None or not rule.triggers.isdisjoint(hits))
+
+
+class Prefilter:
+    # Cheap test of a message against what the channel's rules need before it's parsed: the
+    # required keywords, a literal anchor for the coin and enough digits for the numeric
+    # fields. Messages with one of the commands (closes etc) are always let through. Literals
+    # are plain substring tests on the text which stop at the first miss, digits are counted
+    # last - an accepted signal pays for little more than its keywords.
+
+    def __init__(self, rules: RuleSet, anchors=None, digits=0, commands=(), alternatives=()):
+        self.commands = tuple(commands)
+        self.anchors = tuple(anchors) if anchors is not None else None
+        # alternatives of each required condition: (keyword, None) or (None, regex search)
+        self.requires = tuple(tuple((p.word, None) if isinstance(p, Keyword) else (None, p.compiled().search)
+                                    for p in alts) for alts in rules.requires)
+        self.digits = None
+        if digits:
+            self.digits = re.compile(r"(?:\D*\d){%d}" % digits).match  # anchored, not retried from every position
+        self.alternatives = tuple(alternatives)
+        self.passed = 0
+        self.dropped = 0
+
+    def admits(self, msg) -> bool:
+        if self.matches(msg):
+            self.passed += 1
+            return True
+        self.dropped += 1
+        return False
+
+    def matches(self, msg) -> bool:
+        text = msg.text
+        for word in self.commands:
+            if word in text:
+                return True
+        if self._plausible(text):
+            return True
+        for alt in self.alternatives:
+            if alt.matches(msg):
+                return True
+        return False
+
+    def _plausible(self, text):
+        if self.anchors is not None:
+            for word in self.anchors:
+                if word in text:
+                    break
+            else:
+                return False
+        for alts in self.requires:
+            for word, search in alts:
+                if (word in text) if search is None else (search(text) is not None):
+                    break
+            else:
+                return False
+        return self.digits is None or self.digits(text) is not None
@@ -0,0 +1,208 @@
+import asyncio
+import collections
+import json
+import struct
+
+from cachetools import TTLCache
+
+from .config import Config, ConfigStore
+from .logger import DEFAULT_LOGGER as logging
+from .signal import RESULTS_CHANNEL, Signal
+
+FRAME = struct.Struct(">I")  # length of the JSON payload which follows
+DEDUP_TTL = 10 * 60
+REPLY_TIMEOUT = 10
+RECONNECT_SLEEP = 2
+
+
+def owner(chat_id: int, shards: int) -> int:
+    # Shard which handles a chat, commands in the results channel go to the trading process
+    return 0 if chat_id == RESULTS_CHANNEL else abs(chat_id) % shards
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    header = await reader.readexactly(FRAME.size)
+    return json.loads(await reader.readexactly(FRAME.unpack(header)[0]))
+
+
+def write_frame(writer: asyncio.StreamWriter, obj):
+    data = json.dumps(obj, sort_keys=True).encode()
+    writer.write(FRAME.pack(len(data)) + data)
+
+
+class TradeServer:
+    # Runs in the process with the FuturesTrader (shard 0) and takes what the other shards parsed
+    # over a Unix socket. Requests are deduplicated by the message they come from (chat id, message
+    # id and edit time) for DEDUP_TTL so a message seen by two sessions (e.g. while channels are
+    # being moved between shards) only trades once, while a repeat in a new message still does.
+    # Config changes are pushed to every connected shard.
+
+    def __init__(self, trader, config: ConfigStore, path: str):
+        self.trader = trader
+        self.config = config
+        self.path = path
+        self.server = None
+        self.writers = set()
+        self.seen = TTLCache(maxsize=4096, ttl=DEDUP_TTL)
+        self.received = collections.Counter()
+        self.duplicates = 0
+        config.listeners.append(self._push_config)
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self._serve, path=self.path)
+        logging.info(f"Listening for shards on {self.path}", color="magenta")
+
+    async def stop(self):
+        if self.server is None:
+            return
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await self.server.wait_closed()
+        self.server = None
+        logging.info(f"Shards sent {dict(self.received)}, {self.duplicates} duplicate(s)")
+
+    def _push_config(self, config: Config):
+        for writer in self.writers:
+            write_frame(writer, {"op": "config", "config": config.to_dict()})
+
+    async def _serve(self, reader, writer):
+        self.writers.add(writer)
+        lock = asyncio.Lock()  # drain() can't be awaited by two replies at once
+        write_frame(writer, {"op": "config", "config": self.config.current.to_dict()})
+        try:
+            while True:
+                req = await read_frame(reader)
+                # a request waiting on the trader (e.g. the orders lock) doesn't hold up the ones
+                # behind it, replies go back by request id as they're done
+                asyncio.ensure_future(self._reply(req, writer, lock))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def _reply(self, req, writer, lock):
+        try:
+            tag = await self._handle(req["op"], req["args"], req.get("origin"))
+            res = {"op": "reply", "id": req["id"], "tag": tag}
+        except Exception as err:
+            logging.exception(f"Failed to handle {req} from shard")
+            res = {"op": "reply", "id": req["id"], "error": str(err)}
+        if writer.is_closing():  # the shard is gone, the request was still handled
+            return
+        write_frame(writer, res)
+        async with lock:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def _handle(self, op, args, origin=None):
+        if origin is None:  # nothing to tell a duplicate by
+            self.received[op] += 1
+            return await self._apply(op, args)
+        key = (op,) + tuple(origin)
+        future = self.seen.get(key)
+        if future is not None:  # handled or still being handled, the duplicate gets the same tag
+            self.duplicates += 1
+            return await asyncio.shield(future)
+        future = self.seen[key] = asyncio.get_event_loop().create_future()
+        self.received[op] += 1
+        try:
+            tag = await self._apply(op, args)
+        except Exception as err:
+            self.seen.pop(key, None)
+            future.set_exception(err)
+            future.exception()  # duplicates waiting on it raise it, nobody else has to
+            raise
+        future.set_result(tag)
+        return tag
+
+    async def _apply(self, op, args):
+        if op == "signal":
+            sig = Signal.from_dict(args["signal"])
+            await self.trader.queue_signal(sig)
+            return sig.tag
+        if op == "close":
+            await self.trader.close_trades(args["tag"], args["coin"])
+        elif op == "update":
+            await self.trader.update_trade(args["tag"], sl=args["sl"], targets=args["targets"])
+        elif op == "amend":
+            await self.trader.amend_trade(args["tag"], Signal.from_dict(args["signal"]), tuple(args["fields"]))
+        else:
+            raise ValueError(f"Unknown request {op}")
+
+
+class RemoteTrader:
+    # Stands in for the FuturesTrader in the other shards: the calls TeleTrader makes are sent to
+    # the TradeServer, and its config follows the one pushed from there.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.config: ConfigStore = None
+        self.results_handler = None
+        self.writer = None
+        self.pending = {}
+        self.count = 0
+        self.connected = None
+
+    async def init(self, api_key=None, api_secret=None, state={}, test=False, loop=None):
+        if self.config is None:
+            self.config = ConfigStore(state)
+        self.connected = asyncio.Event()
+        asyncio.ensure_future(self._connection())
+        await self.connected.wait()
+
+    async def queue_signal(self, signal: Signal, origin=None):
+        signal.tag = await self._request("signal", origin, signal=signal.to_dict())
+
+    async def close_trades(self, tag, coin=None, origin=None):
+        await self._request("close", origin, tag=tag, coin=coin)
+
+    async def update_trade(self, tag, sl=None, targets=None, origin=None):
+        await self._request("update", origin, tag=tag, sl=sl, targets=targets)
+
+    async def amend_trade(self, tag, signal: Signal, fields=("sl", "targets"), origin=None):
+        await self._request("amend", origin, tag=tag, signal=signal.to_dict(), fields=list(fields))
+
+    async def _request(self, op, origin, **args):
+        await self.connected.wait()
+        self.count += 1
+        future = asyncio.get_event_loop().create_future()
+        self.pending[self.count] = future
+        write_frame(self.writer, {"op": op, "id": self.count, "args": args,
+                                  "origin": list(origin) if origin is not None else None})
+        await self.writer.drain()
+        res = await asyncio.wait_for(future, REPLY_TIMEOUT)
+        if "error" in res:
+            raise RuntimeError(f"Trader failed to handle {op}: {res['error']}")
+        return res["tag"]
+
+    async def _connection(self):
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path)
+                self.connected.set()
+                logging.info(f"Connected to trader at {self.path}", color="magenta")
+                while True:
+                    frame = await read_frame(reader)
+                    if frame["op"] == "config":
+                        self.config.update(**Config.from_dict(frame["config"])._asdict())
+                    elif frame["op"] == "reply":
+                        future = self.pending.pop(frame["id"], None)
+                        if future is not None and not future.done():
+                            future.set_result(frame)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:  # a malformed frame too, the connection starts over
+                logging.warning(f"Lost connection to trader at {self.path}: {err!r}", color="red")
+            self.connected.clear()
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost connection to trader"))
+            self.pending.clear()
+            await asyncio.sleep(RECONNECT_SLEEP)
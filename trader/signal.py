@@ -1,27 +1,63 @@
+import array
+import collections
+import hashlib
 import math
 import re
+import struct
+import traceback
 
-from .errors import CloseTradeException, MoveStopLossException, ModifyTargetsException
+from cachetools import TTLCache
+
+from .errors import CloseTradeException, MoveStopLossException, ModifyTargetsException, ParseBudgetException
 from .logger import DEFAULT_LOGGER as logging
+from .rules import (APPEND, EXTEND, FIRST, SKIP, Budget, Keyword, Matcher, Pattern, Prefilter, Rule, RuleSet, Symbol, after_symbol, either,
+                    first, head, integer, last, listing, next_line, number, numbers, optional, second, symbol, without)
+from .symbols import snap
+from .tokenizer import ParsedMessage, extract_numbers, extract_optional_number, extract_symbol  # noqa: F401
 
 
 RESULTS_CHANNEL = -1001271281417
 
+# Limits for a single message, a spam or malformed one can't hold up the event loop for longer
+MAX_MESSAGE_LENGTH = 4096  # telegram's own limit for a message
+MAX_LINES = 200
+PARSE_TIME_BUDGET = 2  # wall clock, only a backstop as GC pauses and loop stalls count too
+PARSE_STEP_BUDGET = 5000  # lines scanned plus rules applied, what actually bounds the work
+
+BUDGET_VIOLATIONS = collections.Counter()  # (channel, reason) -> count
+
+STOP_PATTERN = re.compile(r"\bstop|\bsl\b")
+
+
+class Prices(array.array):
+    # Compact float64 list for entries and targets, compares equal to plain lists of the same
+    # values and prints like one
 
-def extract_numbers(line: str, symbol=""):
-    res = list(map(float, re.findall(r'(\.?\d+(?:\.\d+)?)', line.replace(",", "."))))
-    if re.search(r"\d+", symbol):
-        res.pop(0)
-    return res
+    def __new__(cls, values=()):
+        return super().__new__(cls, "d", values)
 
+    def scale(self, factor):
+        for i in range(len(self)):
+            self[i] *= factor
 
-def extract_symbol(line: str, prefix="#", suffix="usdt"):
-    return re.search((prefix if prefix else "") + r"([a-z0-9]+)[ ]*(\/|\|)?[ ]*?" + (suffix if suffix else ""), line)
+    def __copy__(self):
+        return Prices(self)
 
+    def __deepcopy__(self, memo):
+        return Prices(self)
 
-def extract_optional_number(line: str):
-    res = re.search(r"(\d+(?:\.\d+)?)", line.replace(",", "."))
-    return float(res[1]) if res else None
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.tolist())
 
 
 class Signal:
@@ -31,39 +67,110 @@ class Signal:
     DEFAULT_STOP = 0.08
     DEFAULT_RISK = 0.01
     DEFAULT_RISK_FACTOR = 1
+    SCALES = {}  # coin -> exponent of its last price scale, see `factor`
+    FIELDS = ("coin", "entries", "targets", "sl", "leverage", "force_limit_order")  # compared by `diff`
+
+    __slots__ = ("coin", "_entries", "sl", "stop_pct", "_targets", "leverage", "tag", "fraction", "risk",
+                 "force_limit_order", "_is_long", "entry", "wait_entry")
+
+    # version, sl, stop_pct, risk, fraction, entry, leverage, flags, len(coin), len(tag), len(entries), len(targets)
+    HEADER = struct.Struct("<BddddddBHHHH")
+    VERSION = 1
+    NONE = 0xFFFF
 
     def __init__(self, coin, entries=[], targets=[], sl=None, leverage=None, risk_factor=None,
                  is_long=None, force_limit=False, stop_percent=False, tag=None):
+        entries = sorted(entries)
+        if is_long is None:
+            # checked on the plain lists, they're packed into Prices once
+            prev = entries[0]
+            for t in targets:
+                assert (t > prev if targets[0] > entries[0] else t < prev)
+                prev = t
+            if sl:
+                assert sl < entries[0] if targets[0] > entries[0] else sl > entries[-1]
         self.coin = coin.upper()
-        self.entries = sorted(entries)
+        self._entries = Prices(entries)
         self.sl = sl
         self.stop_pct = stop_percent if stop_percent else self.DEFAULT_STOP
-        self.targets = targets
+        self._targets = Prices(targets)
         self.leverage = max(leverage if leverage else self.DEFAULT_LEVERAGE, self.MIN_LEVERAGE)
         self.tag = tag
         self.fraction = 0
         self.risk = self.DEFAULT_RISK * (risk_factor if risk_factor else self.DEFAULT_RISK_FACTOR)
         self.force_limit_order = force_limit
         self._is_long = is_long
-        if self.is_partial:
-            return
-        prev = self.entries[0]
-        for t in self.targets:
-            assert (t > prev if self.is_long else t < prev)
-            prev = t
-        if self.sl:
-            assert self.sl < self.entries[0] if self.is_long else self.sl > self.entries[-1]
+
+    @property
+    def entries(self):
+        return self._entries
+
+    @entries.setter
+    def entries(self, values):
+        self._entries = values if isinstance(values, Prices) else Prices(values)
+
+    @property
+    def targets(self):
+        return self._targets
+
+    @targets.setter
+    def targets(self, values):
+        self._targets = values if isinstance(values, Prices) else Prices(values)
 
     @classmethod
-    def parse(cls, chat_id: int, text: str, risk_factor=None):
+    def parse(cls, chat_id: int, text: str, risk_factor=None, routed=()):
+        # Chats in `routed` aren't registered in CHANNELS, their parser is picked by the router
         ch = CHANNELS.get(chat_id)
-        if not ch:
+        if not ch and chat_id not in routed:
+            return
+        name = ch.__name__ if ch else str(chat_id)
+        if len(text) > MAX_MESSAGE_LENGTH:
+            BUDGET_VIOLATIONS[(name, "length")] += 1
+            raise ParseBudgetException("length", len(text))
+        msg = ParsedMessage(text)
+        if ch is None:
+            sig = cls._parse_routed(chat_id, msg)
+        elif ch.prefilter().admits(msg):
+            msg.budget = Budget(PARSE_TIME_BUDGET, PARSE_STEP_BUDGET, MAX_LINES)
+            try:
+                sig = PARSE_CACHE.parse(ch, msg)
+            except ParseBudgetException as err:
+                BUDGET_VIOLATIONS[(name, err.reason)] += 1
+                raise
+        else:
+            return
+        if sig is None:
             return
-        sig = ch.parse(text.lower())
         if risk_factor is not None and risk_factor > 0:
             sig.risk_factor = (sig.risk / cls.DEFAULT_RISK) * risk_factor  # maintain per-channel risk bias
         return sig
 
+    @classmethod
+    def _parse_routed(cls, chat_id: int, msg: ParsedMessage):
+        # Only new signals are taken from routed chats, closes need the channel to be registered
+        rt = router()
+        msg.budget = Budget(PARSE_TIME_BUDGET, PARSE_STEP_BUDGET, MAX_LINES)
+        parsed = []
+        for score, ch in rt.candidates(msg):
+            try:
+                sig = PARSE_CACHE.parse(ch, msg)
+            except ParseBudgetException as err:
+                BUDGET_VIOLATIONS[(str(chat_id), err.reason)] += 1
+                raise
+            except Exception:
+                continue
+            if sig is None or sig.is_partial or not rt.stop_agrees(msg, sig):
+                continue
+            parsed.append((score, ch, sig))
+        best = rt.choose(parsed)
+        if best is None:
+            rt.routed[None] += 1
+            return None
+        ch, sig = best
+        rt.routed[ch.__name__] += 1
+        sig.tag = f"{ch.__name__}@{abs(chat_id)}"  # keep its trades apart from the registered channel's
+        return sig
+
     @property
     def is_partial(self):
         return self._is_long is not None
@@ -95,11 +202,12 @@ class Signal:
         # 20% offset b/w entry and first target
         return self.entry + (self.targets[0] - self.entry) * 0.2
 
-    def correct(self, price):
+    def correct(self, price, tick=None):
         factor = self.factor(self.entries[0], price)
-        self.entries = list(map(lambda i: i * factor, self.entries))
-        self.entries.sort()
-        self.targets = list(map(lambda i: i * factor, self.targets))
+        self.entries.scale(factor)  # factor is positive, entries stay sorted
+        self.targets.scale(factor)
+        if tick:
+            self.entries = [snap(p, tick) for p in self.entries]
         self.wait_entry = (self.is_long and price < self.entries[0]) or (self.is_short and price > self.entries[-1])
         if self.wait_entry:
             self.entry = self.entries[0] if self.is_long else self.entries[-1]
@@ -112,282 +220,472 @@ class Signal:
                             f"{self.entry} - {self.stop_pct * 100}%")
         else:
             self.sl *= factor
+        if tick:
+            # away from the entry, and never on it
+            self.sl = snap(self.sl, tick, math.floor if self.is_long else math.ceil)
+            if self.sl == self.entry:
+                self.sl = snap(self.sl - tick if self.is_long else self.sl + tick, tick)
+            # targets too, the other way
+            away, step = (math.ceil, tick) if self.is_long else (math.floor, -tick)
+            targets = [snap(p, tick, away) for p in self.targets]
+            self.targets = [snap(p + step, tick) if p == self.entry else p for p in targets]
         percent = self.entry / self.sl
         percent = percent - 1 if self.is_long else 1 - percent
         self.fraction = self.risk / (percent * self.leverage)
 
+    def copy(self):
+        sig = object.__new__(type(self))
+        sig.coin = self.coin
+        sig._entries = Prices(self._entries)
+        sig._targets = Prices(self._targets)
+        sig.sl = self.sl
+        sig.stop_pct = self.stop_pct
+        sig.leverage = self.leverage
+        sig.tag = self.tag
+        sig.fraction = self.fraction
+        sig.risk = self.risk
+        sig.force_limit_order = self.force_limit_order
+        sig._is_long = self._is_long
+        if hasattr(self, "entry"):  # only set by `correct`
+            sig.entry = self.entry
+            sig.wait_entry = self.wait_entry
+        return sig
+
+    def diff(self, other) -> dict:
+        # Fields of `other` (e.g. the parse of an edited message) which differ from this one
+        return {name: getattr(other, name) for name in self.FIELDS if getattr(self, name) != getattr(other, name)}
+
+    def to_dict(self) -> dict:
+        res = {
+            "coin": self.coin,
+            "entries": self.entries.tolist(),
+            "targets": self.targets.tolist(),
+            "sl": self.sl,
+            "stop_pct": self.stop_pct,
+            "leverage": self.leverage,
+            "tag": self.tag,
+            "fraction": self.fraction,
+            "risk": self.risk,
+            "force_limit": self.force_limit_order,
+            "is_long": self._is_long,
+        }
+        if hasattr(self, "entry"):
+            res["entry"] = self.entry
+            res["wait_entry"] = self.wait_entry
+        return res
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        # Restores a signal as it was, without validating it again
+        sig = object.__new__(cls)
+        sig.coin = d["coin"]
+        sig._entries = Prices(d["entries"])
+        sig._targets = Prices(d["targets"])
+        sig.sl = d["sl"]
+        sig.stop_pct = d["stop_pct"]
+        sig.leverage = d["leverage"]
+        sig.tag = d["tag"]
+        sig.fraction = d["fraction"]
+        sig.risk = d["risk"]
+        sig.force_limit_order = d["force_limit"]
+        sig._is_long = d["is_long"]
+        if "entry" in d:
+            sig.entry = d["entry"]
+            sig.wait_entry = d["wait_entry"]
+        return sig
+
+    def to_bytes(self) -> bytes:
+        coin = self.coin.encode()
+        tag = self.tag.encode() if self.tag is not None else b""
+        corrected = hasattr(self, "entry")
+        flags = (bool(self.force_limit_order) | (self._is_long is not None) << 1 | bool(self._is_long) << 2 |
+                 corrected << 3 | (corrected and bool(self.wait_entry)) << 4 | isinstance(self.leverage, int) << 5)
+        header = self.HEADER.pack(
+            self.VERSION, math.nan if self.sl is None else self.sl, self.stop_pct, self.risk, self.fraction,
+            self.entry if corrected else math.nan, self.leverage, flags, len(coin),
+            len(tag) if self.tag is not None else self.NONE, len(self.entries), len(self.targets))
+        return b"".join((header, coin, tag, self.entries.tobytes(), self.targets.tobytes()))
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        (version, sl, stop_pct, risk, fraction, entry, leverage, flags,
+         n_coin, n_tag, n_entries, n_targets) = cls.HEADER.unpack_from(data)
+        assert version == cls.VERSION
+        pos = cls.HEADER.size
+        sig = object.__new__(cls)
+        sig.coin = data[pos:pos + n_coin].decode()
+        pos += n_coin
+        if n_tag == cls.NONE:
+            sig.tag = None
+        else:
+            sig.tag = data[pos:pos + n_tag].decode()
+            pos += n_tag
+        sig._entries = Prices()
+        sig._entries.frombytes(data[pos:pos + 8 * n_entries])
+        pos += 8 * n_entries
+        sig._targets = Prices()
+        sig._targets.frombytes(data[pos:pos + 8 * n_targets])
+        sig.sl = None if math.isnan(sl) else sl
+        sig.stop_pct = stop_pct
+        sig.risk = risk
+        sig.fraction = fraction
+        sig.leverage = int(leverage) if flags & 32 else leverage
+        sig.force_limit_order = bool(flags & 1)
+        sig._is_long = bool(flags & 4) if flags & 2 else None
+        if flags & 8:
+            sig.entry = entry
+            sig.wait_entry = bool(flags & 16)
+        return sig
+
     def factor(self, sig_p, mark_p):
-        # Fix for prices which are human-readable at times when we'll find lack of some precision
-        minima = math.inf
-        factor = 1
-        for i in range(self.MIN_PRECISION * 2):
-            f = 1 / (10 ** (self.MIN_PRECISION - i))
-            dist = abs(sig_p * f - mark_p) / mark_p
-            if dist < minima:
-                minima = dist
-                factor = f
-            else:
+        # Fix for prices which are human-readable at times when we'll find lack of some precision.
+        # Scale is the power of ten (10^-MIN_PRECISION .. 10^(MIN_PRECISION - 1)) which brings the
+        # signal price closest to the mark price: the coin's last scale (or log10 of the ratio) is
+        # the starting point, and a neighbour is only taken if it's strictly closer (lower on ties).
+        last = self.MIN_PRECISION * 2 - 1
+        i = self.SCALES.get(self.coin)
+        if i is None:
+            i = min(max(round(math.log10(mark_p / sig_p)) + self.MIN_PRECISION, 0), last)
+        dist = self._scale_distance(sig_p, mark_p, i)
+        moved = False
+        while i > 0:
+            lower = self._scale_distance(sig_p, mark_p, i - 1)
+            if lower > dist:
+                break
+            i, dist, moved = i - 1, lower, True
+        while not moved and i < last:
+            upper = self._scale_distance(sig_p, mark_p, i + 1)
+            if upper >= dist:
                 break
-        return factor
+            i, dist = i + 1, upper
+        self.SCALES[self.coin] = i
+        return 1 / (10 ** (self.MIN_PRECISION - i))
+
+    @classmethod
+    def _scale_distance(cls, sig_p, mark_p, i):
+        return abs(sig_p * (1 / (10 ** (cls.MIN_PRECISION - i))) - mark_p) / mark_p
 
     def __repr__(self):
         return (f"{self.tag}: {self.coin} x{self.leverage} ({round(self.fraction * 100, 2)}%, "
                 f"e: {self.entries}, sl: {self.sl}, targets: {self.targets})")
 
 
-class RESULTS:
+class ParseCache:
+    # Same text often comes in more than once (edits, reposts, linked channels sharing a parser)
+    # so results are kept per (parser, text) - rejections included. Signals are handed out as
+    # copies as the trader corrects them in place.
+    MISSING = object()
+
+    def __init__(self, maxsize=1024, ttl=6 * 3600, timer=None):
+        kwargs = {"timer": timer} if timer is not None else {}
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl, **kwargs)
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, ch, msg: ParsedMessage):
+        key = (ch, hashlib.blake2b(msg.text.encode(), digest_size=16).digest())
+        res = self.cache.get(key, self.MISSING)
+        if res is self.MISSING:
+            self.misses += 1
+            try:
+                res = ch.parse(msg)
+            except AssertionError as err:
+                traceback.clear_frames(err.__traceback__)  # keep where it failed, not the locals
+                self.cache[key] = err
+                raise
+            self.cache[key] = res.copy() if res is not None else None
+            return res
+        self.hits += 1
+        if isinstance(res, AssertionError):
+            raise AssertionError(*res.args).with_traceback(res.__traceback__)
+        return res.copy() if res is not None else None
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self.cache), "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0}
+
+
+PARSE_CACHE = ParseCache()
+
+
+class RuleParser:
+    # Channels are described by a table of rules (keyword/regex -> field) which is compiled once
+    # into a matcher per channel. Lines are scanned once, in order, and rules fire in the order
+    # they're declared, so a later line overrides an earlier one unless the rule says otherwise.
+    REQUIRES = ()  # keywords (or tuples of alternatives) that must appear in the text
+    RULES = ()
+    REQUIRED = ("c", "er", "t", "sl")
+    SKIP_BLANK = True
+    FALLBACKS = ()  # parsers tried (in order) before this channel's own rules
+    COMMANDS = ()  # keywords of messages handled by `check`, they bypass the prefilter
+    LEVERAGE = None
+    STOP_PERCENT = False
+
     @classmethod
     def parse(cls, text: str) -> Signal:
-        if "cancel " in text or "close " in text:
-            raise CloseTradeException(tag=text.split(" ")[1].lower())
-
-        if "\n" not in text:
-            sig, tag, parts = [None] * 3
-            if text.startswith("long") or text.startswith("short"):
-                parts = text.split(" ")
-                is_long = parts.pop(0) == "long"
-                sig = Signal(parts.pop(0), is_long=is_long)
-                res = extract_optional_number(parts[0])
-                if res:
-                    parts.pop(0)
-                    sig.entries = [res]
-            if text.startswith("change"):
-                parts = text.split(" ")[1:]
-                tag = parts.pop(0)
-            assert parts
-            if parts[0] == "sl":
-                parts.pop(0)
-                res = extract_optional_number(parts.pop(0))
-                if sig is None:
-                    raise MoveStopLossException(tag, res)
-                assert res
-                sig.sl = res
-            if parts and parts[0] == "tp":
-                parts.pop(0)
-                targets = []
-                while parts:
-                    res = extract_optional_number(parts[0])
-                    if not res:
-                        break
-                    parts.pop(0)
-                    targets.append(res)
-                if sig is None:
-                    raise ModifyTargetsException(tag, targets)
-                assert targets
-                sig.targets = sorted(targets)
+        msg = ParsedMessage.of(text)
+        cls.check(msg)
+        sig = cls.delegate(msg)
+        if sig is not None:
             return sig
+        return cls.extract(msg)
 
-        p, force = None, False
-        c, er, sl, t, lv, r = [None] * 6
-        for line in map(str.strip, text.split("\n")):
-            if line.startswith("c "):
-                res = extract_symbol(line, prefix="c ", suffix=None)
-                c = res[1]
-            if line.startswith("e "):
-                er = extract_numbers(line)
-            if line.startswith("t "):
-                t = extract_numbers(line)
-            if line.startswith("sl "):
-                sl = extract_numbers(line)[-1]
-            if line.startswith("l "):
-                lv = extract_optional_number(line)
-                lv = int(lv) if lv else None
-            if line.startswith("r "):
-                r = extract_optional_number(line)
-            if line.startswith("p "):
-                res = extract_symbol(line, prefix="p ", suffix=None)
-                p = res[1]
-        assert c and er and t
-        if p:
-            p = p.lower()
-        if "force" in line:
-            force = True
-        return Signal(c, er, t, sl, leverage=lv, risk_factor=r, force_limit=force, tag=p)
-
-
-class AS:
     @classmethod
-    def parse(cls, text: str) -> Signal:
-        t, er = [], []
-        c, sl, lv = [None] * 3
-        lines = [line for line in map(str.strip, text.split("\n")) if line]
-        for i, line in enumerate(lines):
-            res = extract_symbol(line, prefix=None)
-            if res:
-                c = res[1]
-            if "entry" in line:
-                er = extract_numbers(line)
-                if not er:
-                    j = i + 1
-                    while True:
-                        n = extract_numbers(lines[j])
-                        if len(n) < 2:
-                            break
-                        er.append(n[1])
-                        j += 1
-            if re.search("take.profit", line) or line.startswith("targets"):
-                t = extract_numbers(line)
-                if not t:
-                    j = i + 1
-                    while True:
-                        assert "✅" not in lines[j]
-                        n = extract_numbers(lines[j])
-                        if len(n) < 2:
-                            break
-                        t.append(n[1])
-                        j += 1
-            if "stop" in line or "sl" in line:
-                sl = extract_optional_number(line)
-                if not sl:
-                    res = extract_numbers(lines[i + 1])
-                    sl = res[1]
-            if "leverage" in line:
-                lv = extract_optional_number(line)
-        assert c and er and sl and t
-        return Signal(c, er, t, sl, lv, tag=cls.__name__)
-
-
-class BAW:
+    def check(cls, msg: ParsedMessage):
+        # Hook for close commands and other early exits
+        pass
+
     @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "binance futures" in text
-        c, er, sl, t, lv = [None] * 5
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line, prefix=None)
-            if res:
-                c = res[1]
-            if "entry" in line:
-                er = extract_numbers(line)
-            if "targets" in line:
-                t = extract_numbers(line)
-            if "stop loss" in line:
-                sl = extract_numbers(line)[-1]
-            if "leverage" in line:
-                lv = extract_optional_number(line)
-                lv = int(lv) if lv else None
-        assert c and er and sl and t
-        return Signal(c, er, t, sl, leverage=lv, tag=cls.__name__)
-
-
-class BFP:
+    def fallbacks(cls):
+        return cls.FALLBACKS
+
     @classmethod
-    def parse(cls, text: str) -> Signal:
-        c, e, sl, t = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line)
-            if res:
-                c = res[1]
-                e = extract_optional_number(line.split("usdt")[-1])
-            if "entry point" in line:
-                e = extract_optional_number(line)
-            if "targets" in line:
-                t = extract_numbers(line)
-            if re.search(r"^stop.*(loss)", line):
-                sl = extract_optional_number(line)
-        assert c and e and sl and t
-        return Signal(c, [e], t, sl, tag=cls.__name__)
-
-
-class BFP2:
+    def delegate(cls, msg: ParsedMessage):
+        for ch in cls.fallbacks():
+            try:
+                sig = ch.parse(msg)
+                sig.tag = cls.__name__
+                return sig
+            except CloseTradeException as err:
+                err.tag = cls.__name__
+                raise err
+            except ParseBudgetException:
+                raise
+            except Exception:
+                pass
+
     @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "leverage" in text
-        c, er, sl, t, lv = [None] * 5
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line, suffix="usdt" if "usdt" in line else None)
-            if res:
-                c = res[1]
-                er = extract_numbers(line, c)
-            if "buy" in line:
-                er = extract_numbers(line, c)
-            if "target" in line:
-                t = extract_numbers(line)
-            if "stop loss" in line:
-                sl = extract_optional_number(line)
-            if "leverage" in line:
-                lv = extract_numbers(line) or None
-                if lv:
-                    lv = int(lv[-1])
-        assert c and er and sl and t
-        return Signal(c, er, t, sl, leverage=lv, tag=cls.__name__)
-
-
-class BK:
+    def extract(cls, msg: ParsedMessage) -> Signal:
+        rules = cls.rules()
+        assert rules.accepts(msg)
+        fields = rules.scan(msg.content if cls.SKIP_BLANK else msg.lines, msg.budget)
+        assert all(fields.get(f) for f in cls.REQUIRED)
+        return cls.build(fields)
+
+    @classmethod
+    def build(cls, f: dict) -> Signal:
+        entries = f["er"] if "er" in f else [f["e"]]
+        return Signal(f["c"], entries, f["t"], f.get("sl"), leverage=f.get("lv") or cls.LEVERAGE,
+                      stop_percent=cls.STOP_PERCENT, tag=cls.__name__)
+
+    @classmethod
+    def rules(cls) -> RuleSet:
+        rs = cls.__dict__.get("_rules")
+        if rs is None:
+            rs = RuleSet(cls.RULES, cls.REQUIRES)
+            cls._rules = rs
+        return rs
+
+    @classmethod
+    def signature(cls) -> frozenset:
+        # Literals the channel's messages are recognized by, see `Router`
+        words = set()
+        for rule in cls.RULES:
+            for p in rule.patterns():
+                literal = p.word if isinstance(p, Keyword) else p.gate
+                if literal:
+                    words.add(literal)
+        for alts in cls.rules().requires:
+            words.update(p.word for p in alts if isinstance(p, Keyword))
+        return frozenset(words)
+
+    @classmethod
+    def prefilter(cls) -> Prefilter:
+        pf = cls.__dict__.get("_prefilter")
+        if pf is None:
+            rules = cls.rules()
+            anchors = rules.anchors("c") if "c" in cls.REQUIRED else None
+            digits = len([f for f in cls.REQUIRED if f != "c"])
+            pf = Prefilter(rules, anchors, digits, cls.COMMANDS, [ch.prefilter() for ch in cls.fallbacks()])
+            cls._prefilter = pf
+        return pf
+
+
+class RESULTS(RuleParser):
+    REQUIRED = ("c", "er", "t")
+    COMMANDS = ("cancel", "close", "long", "short", "change")
+    RULES = (
+        Rule(Symbol("c ", None), "c", when=Pattern("^c ")),
+        Rule(Pattern("^e "), "er"),
+        Rule(Pattern("^t "), "t"),
+        Rule(Pattern("^sl "), "sl", last),
+        Rule(Pattern("^l "), "lv", integer(strict=False)),
+        Rule(Pattern("^r "), "r", number),
+        Rule(Symbol("p ", None), "p", when=Pattern("^p ")),
+    )
+
+    @classmethod
+    def check(cls, msg: ParsedMessage):
+        if msg.text in ("cancel", "close"):  # a reply, it's about the trade of the message replied to
+            raise CloseTradeException(tag=None)
+        if "cancel " in msg or "close " in msg:
+            raise CloseTradeException(tag=msg.text.split(" ")[1].lower())
+
     @classmethod
     def parse(cls, text: str) -> Signal:
-        assert "direction" in text and "targets" in text and "stop loss" in text
-        t = []
-        c, er, sl = [None] * 3
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line, prefix=r"\$")
+        msg = ParsedMessage.of(text)
+        cls.check(msg)
+        if "\n" in msg.text:
+            return cls.extract(msg)
+        return cls.command(msg)
+
+    @classmethod
+    def command(cls, msg: ParsedMessage) -> Signal:
+        text = msg.text
+        sig, tag, parts = [None] * 3
+        if text.startswith("long") or text.startswith("short"):
+            parts = text.split(" ")
+            is_long = parts.pop(0) == "long"
+            sig = Signal(parts.pop(0), is_long=is_long)
+            res = extract_optional_number(parts[0])
             if res:
-                c = res[1]
-            if "entry" in line:
-                er = extract_numbers(line)
-            if "term" in line:
-                t.extend(extract_numbers(line))
-            if "stop loss" in line:
-                sl = extract_optional_number(line)
-        assert c and er and t and sl
-        return Signal(c, er, t, sl, tag=cls.__name__)
+                parts.pop(0)
+                sig.entries = [res]
+        if text.startswith("change"):
+            parts = text.split(" ")[1:]
+            if parts and parts[0] not in ("sl", "tp"):  # else a reply, the tag is the parent's
+                tag = parts.pop(0)
+        assert parts
+        if parts[0] == "sl":
+            parts.pop(0)
+            res = extract_optional_number(parts.pop(0))
+            if sig is None:
+                raise MoveStopLossException(tag, res)
+            assert res
+            sig.sl = res
+        if parts and parts[0] == "tp":
+            parts.pop(0)
+            targets = []
+            while parts:
+                res = extract_optional_number(parts[0])
+                if not res:
+                    break
+                parts.pop(0)
+                targets.append(res)
+            if sig is None:
+                raise ModifyTargetsException(tag, targets)
+            assert targets
+            sig.targets = sorted(targets)
+        return sig
 
+    @classmethod
+    def extract(cls, msg: ParsedMessage) -> Signal:
+        sig = super().extract(msg)
+        sig.force_limit_order = "force" in msg.lines[-1]
+        return sig
 
-class BPS:
     @classmethod
-    def parse(cls, text: str) -> Signal:
-        if "exit trade" in text:
+    def build(cls, f: dict) -> Signal:
+        return Signal(f["c"], f["er"], f["t"], f.get("sl"), leverage=f.get("lv"), risk_factor=f.get("r"),
+                      tag=f.get("p"))
+
+
+class AS(RuleParser):
+    RULES = (
+        Rule(Symbol(None), "c"),
+        Rule("entry", "er", either(numbers, listing(1))),
+        Rule((Pattern("take.profit"), Pattern("^targets")), "t", either(numbers, listing(1, guard="✅"))),
+        Rule(("stop", "sl"), "sl", either(number, next_line(second))),
+        Rule("leverage", "lv", number),
+    )
+
+
+class BAW(RuleParser):
+    REQUIRES = ("binance futures",)
+    RULES = (
+        Rule(Symbol(None), "c"),
+        Rule("entry", "er"),
+        Rule("targets", "t"),
+        Rule("stop loss", "sl", last),
+        Rule("leverage", "lv", integer(strict=False)),
+    )
+
+
+class BFP(RuleParser):
+    REQUIRED = ("c", "e", "sl", "t")
+    RULES = (
+        Rule(Symbol(), "c"),
+        Rule(Symbol(), "e", lambda scan, i: extract_optional_number(scan.lines[i].split("usdt")[-1])),
+        Rule("entry point", "e", number),
+        Rule("targets", "t"),
+        Rule(Pattern(r"^stop.*(loss)"), "sl", number),
+    )
+
+
+class BFP2(RuleParser):
+    REQUIRES = ("leverage",)
+    RULES = (
+        Rule(Symbol(), "c"),
+        Rule(Symbol(), "er", after_symbol),
+        Rule(Symbol(suffix=None), "c", unless="usdt"),
+        Rule(Symbol(suffix=None), "er", after_symbol, unless="usdt"),
+        Rule("buy", "er", after_symbol),
+        Rule("target", "t"),
+        Rule("stop loss", "sl", number),
+        Rule("leverage", "lv", integer(optional(last), strict=False)),
+    )
+
+
+class BK(RuleParser):
+    REQUIRES = ("direction", "targets", "stop loss")
+    RULES = (
+        Rule(Symbol(prefix=r"\$"), "c"),
+        Rule("entry", "er"),
+        Rule("term", "t", mode=EXTEND),
+        Rule("stop loss", "sl", number),
+    )
+
+
+class BPS(RuleParser):
+    REQUIRES = ("binance futures", "leverage")
+    COMMANDS = ("exit trade",)
+    RULES = (
+        Rule(Symbol(), "c"),
+        Rule(Symbol(), "er", after_symbol),
+        Rule("target", "t"),
+        Rule("stop loss", "sl", number),
+    )
+
+    @classmethod
+    def check(cls, msg: ParsedMessage):
+        if "exit trade" in msg:
             c = None
-            for line in text.split("\n"):
+            for line in msg.lines:
                 res = extract_symbol(line)
                 if res:
                     c = res[1]
             raise CloseTradeException(cls.__name__, c)
 
-        assert "binance futures" in text
-        assert "leverage" in text
-        c, er, t, sl = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line)
-            if res:
-                c = res[1]
-                er = extract_numbers(line, symbol=c)
-            if "target" in line:
-                t = extract_numbers(line)
-            if "stop loss" in line:
-                sl = extract_optional_number(line)
-        assert c and er and t and sl
-        return Signal(c, er, t, sl, tag=cls.__name__)
 
+class BVIP(RuleParser):
+    REQUIRES = (("leverage", "long", "short"),)
+    RULES = (
+        Rule(Symbol(None), "c"),
+        Rule(Symbol(None), "er", after_symbol),
+        Rule(("entry", "buy"), "er"),
+        Rule("target", "t"),
+        Rule("leverage", "lv", integer()),
+        Rule("stop", "sl", number),
+    )
+
+
+class C(RuleParser):
+    REQUIRES = ("leverage",)
+    COMMANDS = ("close ",)
+    RULES = (
+        Rule(Symbol(None), "c"),
+        Rule(Symbol(None), "er", after_symbol),
+        Rule("buy", "er"),
+        Rule("target", "t"),
+        Rule("stop", "sl", lambda scan, i: float(scan.lines[i].split(" ")[-1])),
+    )
 
-class BVIP:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "leverage" in text or ("long" in text or "short" in text)
-        t = []
-        c, er, sl, lev = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line, prefix=None)
-            if res:
-                c = res[1]
-                er = extract_numbers(line, symbol=c)
-            if "entry" in line or "buy" in line:
-                er = extract_numbers(line)
-            if "target" in line:
-                t = extract_numbers(line)
-            if "leverage" in line:
-                lev = int(extract_optional_number(line))
-            if "stop" in line:
-                sl = extract_optional_number(line)
-        assert c and er and t and sl
-        return Signal(c, er, t, sl, leverage=lev, tag=cls.__name__)
-
-
-class C:
     @classmethod
-    def parse(cls, text: str) -> Signal:
-        if "close " in text:
+    def check(cls, msg: ParsedMessage):
+        if "close " in msg:
             c = None
-            res = extract_symbol(text, prefix="close ", suffix=None)
+            res = extract_symbol(msg.text, prefix="close ", suffix=None)
             if res:
                 c = res[1]
                 if c.endswith("usdt"):
@@ -396,819 +694,576 @@ class C:
                     raise AssertionError
             raise CloseTradeException(cls.__name__, c)
 
-        assert "leverage" in text
-        c, er, sl, t = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line, prefix=None)
-            if res:
-                c = res[1]
-                er = extract_numbers(line, symbol=c)
-            if "buy" in line:
-                er = extract_numbers(line)
-            if "target" in line:
-                t = extract_numbers(line)
-            if "stop" in line:
-                sl = float(line.split(" ")[-1])
-        assert c and er and sl and t
-        return Signal(c, er, t, sl, tag=cls.__name__)
-
-
-class CC:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert ("long" in text or "short" in text) and re.search(r"\dx", text)
-        t = []
-        c, er, sl, lv = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line)
-            if res:
-                c = res[1]
-                lv = int(extract_numbers(line)[-1])
-            if "entry" in line:
-                er = extract_numbers(line)
-            if "tp" in line:
-                t.append(extract_numbers(line)[-1])
-            if "s/l" in line:
-                sl = extract_optional_number(line)
-        assert c and er and t and sl
-        return Signal(c, er, t, sl, leverage=lv, tag=cls.__name__)
-
-
-class CCC:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "leverage" in text
-        er = []
-        c, t, sl, lv = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            if not c and re.search(r"^#[a-z0-9]", line):
-                suffix = "usdt" if "usdt" in line else None
-                res = extract_symbol(line, suffix=suffix)
-                if res:
-                    c = res[1]
-            elif "short" in line or "long" in line:
-                res = extract_symbol(line, prefix=None, suffix=None)
-                c = res[1]
-            if "entry" in line:
-                if re.search(r"entry [0-9][^0-9]", line):
-                    er.append(extract_numbers(line)[1])
-                else:
-                    er = extract_numbers(line)
-            if "target" in line:
-                t = extract_numbers(line)[:5]
-            if "stop" in line:
-                sl = extract_numbers(line)[-1]
-            if "leverage" in line:
-                lv = int(extract_numbers(line)[-1])
-        assert er and c and t and sl
-        return Signal(c, er, t, sl, leverage=lv, tag=cls.__name__)
-
-
-class CCS:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "futures" in text
-        c, er, t, sl = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line)
-            if res:
-                c = res[1]
-            if "long" in line or "short" in line:
-                er = extract_numbers(line)
-            if "take profit" in line:
-                t = extract_numbers(line)
-            if "sl" in line:
-                sl = extract_optional_number(line)
-        assert c and er and t  # It's fine if SL is not there
-        return Signal(c, er, t, sl, stop_percent=0.07, tag=cls.__name__)
-
-
-class CEP:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "leverage" in text
-        c, er, sl, t = [None] * 4
-        lines = [line for line in map(str.strip, text.split("\n")) if line]
-        for i, line in enumerate(lines):
-            res = extract_symbol(line)
-            if res:
-                c = res[1]
-            if ("buy" in line or "entry" in line) and not er:
-                er = extract_numbers(line)
-            if "targets" in line:
-                t = extract_numbers(lines[i + 1])
-            if "stoploss" in line:
-                sl = extract_optional_number(line)
-        assert c and er and sl and t
-        return Signal(c, er, t[:5], sl, leverage=20, tag=cls.__name__)
 
+class CC(RuleParser):
+    REQUIRES = (("long", "short"), Pattern(r"\dx"))
+    RULES = (
+        Rule(Symbol(), "c"),
+        Rule(Symbol(), "lv", integer(last)),
+        Rule("entry", "er"),
+        Rule("tp", "t", last, mode=APPEND),
+        Rule("s/l", "sl", number),
+    )
+
+
+def _ccc_symbol(scan, i):
+    line = scan.lines[i]
+    res = extract_symbol(line, suffix="usdt" if "usdt" in line else None)
+    return res[1] if res else SKIP
+
+
+class CCC(RuleParser):
+    REQUIRES = ("leverage",)
+    RULES = (
+        Rule(Pattern("^#[a-z0-9]"), "c", _ccc_symbol, mode=FIRST,
+             orelse=Rule(("short", "long"), "c", symbol(None, None))),
+        Rule(Pattern("entry [0-9][^0-9]"), "er", second, mode=APPEND, orelse=Rule("entry", "er")),
+        Rule("target", "t", head(5)),
+        Rule("stop", "sl", last),
+        Rule("leverage", "lv", integer(last)),
+    )
+
+
+class CCS(RuleParser):
+    REQUIRES = ("futures",)
+    REQUIRED = ("c", "er", "t")  # It's fine if SL is not there
+    STOP_PERCENT = 0.07
+    RULES = (
+        Rule(Symbol(), "c"),
+        Rule(("long", "short"), "er"),
+        Rule("take profit", "t"),
+        Rule("sl", "sl", number),
+    )
+
+
+class CEP(RuleParser):
+    REQUIRES = ("leverage",)
+    LEVERAGE = 20
+    RULES = (
+        Rule(Symbol(), "c"),
+        Rule(("buy", "entry"), "er", mode=FIRST),
+        Rule("targets", "t", head(5, next_line())),
+        Rule("stoploss", "sl", number),
+    )
+
+
+def _cy_target(scan, i):
+    res = extract_numbers(scan.lines[i])
+    return res[-1] if len(res) > 1 else SKIP
+
+
+class CY(RuleParser):
+    REQUIRES = ("leverage",)
+    COMMANDS = ("stop ",)
+    RULES = (
+        Rule(Symbol(None), "c"),
+        Rule("buy", "er", mode=FIRST, orelse=Rule("buy", "t")),
+        Rule("sell", "er", mode=FIRST, orelse=Rule("sell", "t")),
+        Rule("target", "t", _cy_target, mode=APPEND),
+        Rule("stop", "sl", number),
+        Rule("leverage", "lv", integer(strict=False)),
+    )
 
-class CY:
     @classmethod
-    def parse(cls, text: str) -> Signal:
-        if "stop " in text.split("\n")[0]:
-            res = extract_symbol(text, prefix=None)
+    def check(cls, msg: ParsedMessage):
+        if "stop " in msg.text.split("\n")[0]:
+            res = extract_symbol(msg.text, prefix=None)
             raise CloseTradeException(cls.__name__, res[1])
 
-        assert "leverage" in text
-        t = []
-        c, er, sl = [None] * 3
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line, prefix=None)
-            if res:
-                c = res[1]
-            if "buy" in line:
-                if not er:
-                    er = extract_numbers(line)
-                else:
-                    t = extract_numbers(line)
-            if "sell" in line:
-                if not er:
-                    er = extract_numbers(line)
-                else:
-                    t = extract_numbers(line)
-            if "target" in line:
-                res = extract_numbers(line)
-                if len(res) > 1:
-                    t.append(res[-1])
-            if "stop" in line:
-                sl = extract_optional_number(line)
-            if "leverage" in line:
-                lv = extract_optional_number(line)
-                lv = int(lv) if lv else None
-        assert c and er and sl and t
-        return Signal(c, er, t, sl, leverage=lv, tag=cls.__name__)
-
-
-class E:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "lev" in text
-        c, er, t, sl = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line)
-            if res:
-                c = res[1]
-            if "zone" in line:
-                er = extract_numbers(line)
-            if "target" in line:
-                t = extract_numbers(line)
-            if "sl" in line:
-                sl = extract_optional_number(line)
-        assert c and er and t and sl
-        return Signal(c, er, t, sl, tag=cls.__name__)
 
+class E(RuleParser):
+    REQUIRES = ("lev",)
+    RULES = (
+        Rule(Symbol(), "c"),
+        Rule("zone", "er"),
+        Rule("target", "t"),
+        Rule("sl", "sl", number),
+    )
+
+
+class EBS(RuleParser):
+    REQUIRES = ("leverage",)
+    REQUIRED = ("c", "e", "t", "lv")
+    STOP_PERCENT = 0.025
+    RULES = (
+        Rule(Symbol(), "c"),
+        Rule("leverage", "lv", integer()),
+        Rule("entry", "e", next_line(last)),
+        Rule("target", "t", last, mode=APPEND),
+    )
+
+
+class FWP(RuleParser):
+    REQUIRES = (("leverage", "futures"),)
+    RULES = (
+        Rule(Symbol(), "c"),
+        Rule("buy", "er", mode=FIRST),
+        Rule("target ", "t", last, mode=APPEND),
+        Rule(Pattern(r"sto..loss"), "sl", number),
+    )
+
+
+class FXVIP(RuleParser):
+    REQUIRES = ("leverage",)
+    RULES = (
+        Rule(Symbol(None), "c"),
+        Rule("entry", "er"),
+        Rule("target ", "t"),
+        Rule("stop loss", "sl", number),
+        Rule("leverage", "lv", integer(last)),
+    )
 
-class EBS:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "leverage" in text
-        t = []
-        c, e, lev = [None] * 3
-        lines = [line for line in map(str.strip, text.split("\n")) if line]
-        for i, line in enumerate(lines):
-            res = extract_symbol(line)
-            if res:
-                c = res[1]
-            if "leverage" in line:
-                lev = int(extract_optional_number(line))
-            if "entry" in line:
-                e = extract_numbers(lines[i + 1])[-1]
-            if "target" in line:
-                t.append(extract_numbers(line)[-1])
-        assert c and e and t and lev
-        c = c.upper()
-        return Signal(c, [e], t, leverage=lev, stop_percent=0.025, tag=cls.__name__)
-
-
-class FWP:
     @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "leverage" in text or "futures" in text
-        t = []
-        c, er, sl = [None] * 3
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line)
-            if res:
-                c = res[1]
-            if "buy" in line and not er:
-                er = extract_numbers(line)
-            if "target " in line:
-                t.append(extract_numbers(line)[-1])
-            if re.search(r"sto..loss", line):
-                sl = extract_optional_number(line)
-        assert c and er and sl and t
-        return Signal(c, er, t, sl, tag=cls.__name__)
-
+    def fallbacks(cls):
+        return (CCS, FWP, MCVIP, PBF)  # some of them are defined further down
+
+
+def _hbtcv_entries(scan, i):
+    line = scan.lines[i + 1]
+    er = extract_numbers(line)
+    if "1)" in line:
+        er.pop(0)
+    if "%" in line:
+        er.pop()
+    return er
+
+
+class HBTCV(RuleParser):
+    REQUIRES = ("binance futures",)
+    FALLBACKS = (CEP,)
+    RULES = (
+        Rule(Symbol(), "c"),
+        Rule(Pattern(r"entry \d"), "er", second, mode=APPEND, orelse=Rule("entry", "er", _hbtcv_entries)),
+        Rule("profit target", "t", listing(1, guard="✅"), mode=FIRST,
+             orelse=Rule("targets", "t", without("✅"), mode=FIRST)),
+        Rule("stop target", "sl", next_line(second)),
+        Rule("stoploss", "sl", number),
+        Rule("leverage", "lv", integer(last, strict=False)),
+    )
 
-class FXVIP:
     @classmethod
-    def parse(cls, text: str) -> Signal:
-        for ch in [CCS, FWP, MCVIP, PBF]:
-            try:
-                sig = ch.parse(text)
-                sig.tag = cls.__name__
-                return sig
-            except CloseTradeException as err:
-                err.tag = cls.__name__
-                raise err
-            except Exception:
-                pass
-
-        c, er, sl, lv = [None] * 4
-        assert "leverage" in text
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line, prefix=None)
-            if res:
-                c = res[1]
-            if "entry" in line:
-                er = extract_numbers(line)
-            if "target " in line:
-                t = extract_numbers(line)
-            if "stop loss" in line:
-                sl = extract_optional_number(line)
-            if "leverage" in line:
-                lv = int(extract_numbers(line)[-1])
-        assert c and er and sl and t
-        return Signal(c, er, t, sl, leverage=lv, tag=cls.__name__)
-
-
-class HBTCV:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        try:
-            sig = CEP.parse(text)
-            assert "✅" not in text
-            sig.tag = cls.__name__
-            return sig
-        except CloseTradeException as err:
-            err.tag = cls.__name__
-            raise err
-        except Exception:
-            pass
-
-        assert "binance futures" in text
-        t, er = [], []
-        c, sl, lv = [None] * 3
-        lines = [line for line in map(str.strip, text.split("\n")) if line]
-        for i, line in enumerate(lines):
-            res = extract_symbol(line)
-            if res:
-                c = res[1]
-            if "entry" in line:
-                if re.search(r"entry \d", line):
-                    er.append(extract_numbers(line)[1])
-                else:
-                    er = extract_numbers(lines[i + 1])
-                    if "1)" in lines[i + 1]:
-                        er.pop(0)
-                    if "%" in lines[i + 1]:
-                        er.pop()
-            if not t and "profit target" in line:
-                j = i + 1
-                while True:
-                    assert "✅" not in lines[j]
-                    n = extract_numbers(lines[j])
-                    if len(n) < 2:
-                        break
-                    t.append(n[1])
-                    j += 1
-            elif not t and "targets" in line:
-                assert "✅" not in line
-                t = extract_numbers(line)
-            if "stop target" in line:
-                sl = extract_numbers(lines[i + 1])[1]
-            if "stoploss" in line:
-                sl = extract_optional_number(line)
-            if "leverage" in line:
-                lv = extract_numbers(line)[-1]
-                lv = int(lv) if lv else None
-        assert c and er and t and sl
-        return Signal(c, er, t, sl, leverage=lv, tag=cls.__name__)
-
-
-class JMP:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "lev" in text and "buy" in text and "sell" in text
-        c, er, t, sl = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line, prefix=r"\$")
-            if res:
-                c = res[1]
-            if "buy" in line:
-                er = extract_numbers(line)
-            if "sell" in line:
-                t = extract_numbers(line)
-            if "sl" in line:
-                sl = extract_optional_number(line)
-        assert c and er and sl and t
-        return Signal(c, er, t, sl, tag=cls.__name__)
-
-
-class JPC:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        t = []
-        c, er, sl = [None] * 3
-        lines = [line for line in map(str.strip, text.split("\n")) if line]
-        for i, line in enumerate(lines):
-            res = extract_symbol(line)
-            if res:
-                c = res[1]
-            if "long" in line or "short" in line or "entry" in line:
-                er = extract_numbers(line)
-                if not er and "entry" in line:
-                    er = extract_numbers(lines[i + 1])
-            if re.search(r"tp\d", line):
-                t.append(extract_numbers(line)[-1])
-            if "target" in line:
-                t = extract_numbers(line)
-            if re.search(r"stop.?loss", line):
-                sl = extract_optional_number(line)
-        assert c and er and t and sl
-        return Signal(c, er, t, sl, tag=cls.__name__)
-
-
-class KBV:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "lev" in text
-        t = []
-        c, er, sl, lv = [None] * 4
-        lines = list(map(str.strip, text.split("\n")))
-        for i, line in enumerate(lines):
-            res = extract_symbol(line)
-            if res:
-                c = res[1]
-            if "entry" in line or "buy" in line:
-                er = extract_numbers(line)
-            if "sell" in line or "targets" in line or re.search(r"take.profit", line):
-                t = extract_numbers(lines[i + 1])
-            if re.search(r"stop.?loss", line):
-                sl = extract_optional_number(line)
-            if "lev" in line:
-                lv = int(extract_numbers(line)[-1])
-        assert c and er and t and sl
-        return Signal(c, er, t, sl, leverage=lv, tag=cls.__name__)
-
-
-class KCE:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert re.search(r"/usdt.*((x[0-9]+)|([0-9]+x))", text)
-        t, er = [], []
-        c, sl = [None] * 2
-        lines = list(map(str.strip, text.split("\n")))
-        for i, line in enumerate(lines):
-            res = extract_symbol(line, prefix=None)
-            if res:
-                c = res[1]
-                if "buy" in line or "now" in line:
-                    er = extract_numbers(line, symbol=c)
-                    if f"x{int(er[-1])}" in line:
-                        er.pop()
-            if "entry" in line or "now" in line:
-                er.extend(extract_numbers(line))
-            if "target" in line:
-                res = extract_numbers(line)
-                if re.search(r"target \d", line):
-                    res.pop(0)
-                t.extend(res)
-            if "sl" in line or "stop" in line:
-                sl = extract_optional_number(line)
-        assert c and er and t
-        return Signal(c, er, t, sl, tag=cls.__name__)
+    def delegate(cls, msg: ParsedMessage):
+        if "✅" in msg:
+            return
+        return super().delegate(msg)
+
+
+class JMP(RuleParser):
+    REQUIRES = ("lev", "buy", "sell")
+    RULES = (
+        Rule(Symbol(prefix=r"\$"), "c"),
+        Rule("buy", "er"),
+        Rule("sell", "t"),
+        Rule("sl", "sl", number),
+    )
+
+
+class JPC(RuleParser):
+    RULES = (
+        Rule(Symbol(), "c"),
+        Rule(("long", "short", "entry"), "er"),
+        Rule("entry", "er", next_line(), mode=FIRST),
+        Rule(Pattern(r"tp\d"), "t", last, mode=APPEND),
+        Rule("target", "t"),
+        Rule(Pattern(r"stop.?loss"), "sl", number),
+    )
+
+
+class KBV(RuleParser):
+    REQUIRES = ("lev",)
+    SKIP_BLANK = False
+    RULES = (
+        Rule(Symbol(), "c"),
+        Rule(("entry", "buy"), "er"),
+        Rule(("sell", "targets", Pattern(r"take.profit")), "t", next_line()),
+        Rule(Pattern(r"stop.?loss"), "sl", number),
+        Rule("lev", "lv", integer(last)),
+    )
+
+
+def _kce_entries(scan, i):
+    line = scan.lines[i]
+    er = extract_numbers(line, scan.fields.get("c"))
+    if f"x{int(er[-1])}" in line:
+        er.pop()
+    return er
+
+
+class KCE(RuleParser):
+    REQUIRES = (Pattern(r"/usdt.*((x[0-9]+)|([0-9]+x))"),)
+    REQUIRED = ("c", "er", "t")
+    RULES = (
+        Rule(Symbol(None), "c"),
+        Rule(("buy", "now"), "er", _kce_entries, when=Symbol(None)),
+        Rule(("entry", "now"), "er", mode=EXTEND),
+        Rule(Pattern(r"target \d"), "t", lambda scan, i: extract_numbers(scan.lines[i])[1:], mode=EXTEND,
+             orelse=Rule("target", "t", mode=EXTEND)),
+        Rule(("sl", "stop"), "sl", number),
+    )
 
 
 class KSP(HBTCV):
     pass
 
 
-class KVIP:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "binance futures" in text
-        c, er, t, sl = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line)
-            if res:
-                c = res[1]
-            if "entry" in line:
-                er = extract_numbers(line)
-            if "tp" in line:
-                t = extract_numbers(line)
-            if "stop" in line:
-                sl = extract_optional_number(line)
-        assert c and er and sl and t
-        return Signal(c, er, t, sl, tag=cls.__name__)
+class KVIP(RuleParser):
+    REQUIRES = ("binance futures",)
+    RULES = (
+        Rule(Symbol(), "c"),
+        Rule("entry", "er"),
+        Rule("tp", "t"),
+        Rule("stop", "sl", number),
+    )
 
 
-class LVIP:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "lev" in text or "future" in text
-        c, er, t, sl, lv = [None] * 5
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line)
-            if res:
-                c = res[1]
-            elif "usdt" in line:
-                res = extract_symbol(line, prefix="#" if "#" in line else None)
-                if res:
-                    c = res[1]
-            if ("buy" in line or "long" in line or "short" in line) and "fund" not in line:
-                er = extract_numbers(line, symbol=c)
-            if "target" in line:
-                t = extract_numbers(line)
-                t = t[:5]
-            if "stop" in line or "sl" in line:
-                sl = extract_optional_number(line)
-            if "lev" in line:
-                lv = int(extract_numbers(line)[-1])
-        assert c and er and t and sl
-        return Signal(c, er, t, sl, leverage=lv, tag=cls.__name__)
+class LVIP(RuleParser):
+    REQUIRES = (("lev", "future"),)
+    RULES = (
+        Rule(Symbol(), "c", orelse=Rule(Symbol(None), "c", unless="#")),
+        Rule(("buy", "long", "short"), "er", after_symbol, unless="fund"),
+        Rule("target", "t", head(5)),
+        Rule(("stop", "sl"), "sl", number),
+        Rule("lev", "lv", integer(last)),
+    )
 
 
 class MCVIP(C):
     pass
 
 
-class MVIP:
+class MVIP(RuleParser):
+    REQUIRES = (("levrage", "leverage"),)
+    REQUIRED = ("c", "er", "sl", "lv", "t")
+    COMMANDS = ("close ",)
+    RULES = (
+        Rule("⚡️", "c", lambda scan, i: extract_symbol(scan.lines[i].replace(" ", ""))[1]),
+        Rule("entry", "er", next_line()),
+        Rule("take-profit", "t", listing(-1), mode=EXTEND),
+        Rule("rage", "lv", integer()),
+        Rule("stop", "sl", next_line(last)),
+    )
+
     @classmethod
-    def parse(cls, text: str) -> Signal:
-        if "close " in text and " when " not in text:
-            if "/usdt" in text:
-                coin = text.split("/")[0].split(" ")[-1]
+    def check(cls, msg: ParsedMessage):
+        if "close " in msg and " when " not in msg:
+            if "/usdt" in msg:
+                coin = msg.text.split("/")[0].split(" ")[-1]
                 if coin.startswith("#"):
                     coin = coin.replace("#", "")
                 raise CloseTradeException(cls.__name__, coin)
             raise CloseTradeException(cls.__name__)
 
-        assert "levrage" in text or "leverage" in text
-        t = []
-        c, er, sl, lv = [None] * 4
-        lines = [line for line in map(str.strip, text.split("\n")) if line]
-        for i, line in enumerate(lines):
-            if "⚡️" in line:
-                line = line.replace(" ", "")
-                res = extract_symbol(line)
-                c = res[1]
-            if "entry" in line:
-                er = extract_numbers(lines[i + 1])
-            if "take-profit" in line:
-                j = i + 1
-                while True:
-                    n = extract_numbers(lines[j])
-                    if len(n) < 2:
-                        break
-                    t.append(n[-1])
-                    j += 1
-            if "rage" in line:
-                lv = int(extract_optional_number(line))
-            if "stop" in line:
-                n = extract_numbers(lines[i + 1])
-                sl = float(n[-1])
-        assert c and er and sl and lv and t
-        return Signal(c, er, t, sl, leverage=lv, tag=cls.__name__)
-
-
-class PBF:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "binance future" in text
-        assert "leverage" in text
-        c, er, t, sl = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line, prefix=None)
-            if res:
-                c = res[1]
-            if "entry" in line:
-                er = extract_numbers(line)
-            if "target" in line:
-                t = extract_numbers(line)
-            if "stop loss" in line:
-                sl = extract_optional_number(line)
-        assert c and er and t
-        return Signal(c, er, t, sl, leverage=20, tag=cls.__name__)
+
+class PBF(RuleParser):
+    REQUIRES = ("binance future", "leverage")
+    REQUIRED = ("c", "er", "t")
+    LEVERAGE = 20
+    RULES = (
+        Rule(Symbol(None), "c"),
+        Rule("entry", "er"),
+        Rule("target", "t"),
+        Rule("stop loss", "sl", number),
+    )
 
 
 class PHVIP(KSP):
     pass
 
 
-class PVIP:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "leverage" in text
-        t = []
-        c, er, sl, lv = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line, prefix=None, suffix="-usdt")
-            if res:
-                c = res[1]
-            if "buy" in line:
-                er = extract_numbers(line)
-            if "target" in line:
-                t.append(extract_numbers(line)[-1])
-            if "leverage" in line:
-                lv = int(extract_numbers(line)[-1])
-            if "stop" in line:
-                sl = extract_optional_number(line)
-        assert c and er and sl and t
-        return Signal(c, er, t, sl, leverage=lv, tag=cls.__name__)
+class PVIP(RuleParser):
+    REQUIRES = ("leverage",)
+    RULES = (
+        Rule(Symbol(None, "-usdt"), "c"),
+        Rule("buy", "er"),
+        Rule("target", "t", last, mode=APPEND),
+        Rule("leverage", "lv", integer(last)),
+        Rule("stop", "sl", number),
+    )
 
 
 class RM(HBTCV):
     pass
 
 
-class RWS:
+class RWS(RuleParser):
+    FALLBACKS = (RM,)
+    COMMANDS = ("close ",)
+    RULES = (
+        Rule(Symbol(None), "c"),
+        Rule(Symbol(None), "er", after_symbol),
+        Rule("🎯", "t", last, mode=APPEND),
+        Rule("stop loss", "sl", number),
+        Rule("leverage", "lv", integer(strict=False)),
+    )
+
     @classmethod
-    def parse(cls, text: str) -> Signal:
-        if "close " in text:
-            res = extract_symbol(text, prefix=None)
+    def check(cls, msg: ParsedMessage):
+        if "close " in msg:
+            res = extract_symbol(msg.text, prefix=None)
             raise CloseTradeException(cls.__name__, res[1] if res else None)
+        assert "leverage" in msg
+
+
+class SLVIP(RuleParser):
+    REQUIRES = (("binance futures", "open short", "open long"),)
+    REQUIRED = ("c", "er", "t", "sl", "lv")
+    RULES = (
+        Rule(Symbol(suffix="_usdt"), "c", orelse=Rule(Symbol(suffix="/usdt"), "c", unless="_usdt")),
+        Rule(("entry zone", "open short", "open long"), "er"),
+        Rule(("sell zone", "target"), "t"),
+        Rule("stop", "sl", last),
+        Rule("lev", "lv", integer(last)),
+    )
+
+
+class SPP(RuleParser):
+    REQUIRES = ("lev",)
+    COMMANDS = ("close",)
+    RULES = (
+        Rule(Symbol(None), "c"),
+        Rule("entry", "er"),
+        Rule("target", "t"),
+        Rule("stop", "sl", number),
+    )
 
-        assert "leverage" in text
-        try:
-            sig = RM.parse(text)
-            sig.tag = cls.__name__
-            return sig
-        except CloseTradeException as err:
-            err.tag = cls.__name__
-            raise err
-        except Exception:
-            pass
-
-        t = []
-        c, er, sl, lev = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line, prefix=None)
-            if res:
-                c = res[1]
-                er = extract_numbers(line, symbol=c)
-            if "🎯" in line:
-                t.append(extract_numbers(line)[-1])
-            if "stop loss" in line:
-                sl = extract_optional_number(line)
-            if "leverage" in line:
-                lev = extract_optional_number(line)
-                lev = int(lev) if lev else None
-        assert c and er and t and sl
-        return Signal(c, er, t, sl, leverage=lev, tag=cls.__name__)
-
-
-class SLVIP:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "binance futures" in text or "open short" in text or "open long" in text
-        c, er, t, sl, lv = [None] * 5
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line, suffix="_usdt" if "_usdt" in line else "/usdt")
-            if res:
-                c = res[1]
-            if "entry zone" in line or "open short" in line or "open long" in line:
-                er = extract_numbers(line)
-            if "sell zone" in line or "target" in line:
-                t = extract_numbers(line)
-            if "stop" in line:
-                sl = extract_numbers(line)[-1]
-            if "lev" in line:
-                lv = int(extract_numbers(line)[-1])
-        assert c and er and t and sl and lv
-        return Signal(c, er, t, sl, leverage=lv, tag=cls.__name__)
-
-
-class SPP:
     @classmethod
-    def parse(cls, text: str) -> Signal:
-        if text.startswith("close"):
+    def check(cls, msg: ParsedMessage):
+        if msg.text.startswith("close"):
             raise CloseTradeException(cls.__name__)
 
-        assert "lev" in text
-        c, er, t, sl = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line, prefix=None)
-            if res:
-                c = res[1]
-            if "entry" in line:
-                er = extract_numbers(line)
-            if "target" in line:
-                t = extract_numbers(line)
-            if "stop" in line:
-                sl = extract_optional_number(line)
-        assert c and er and sl and t
-        return Signal(c, er, t, sl, tag=cls.__name__)
-
-
-class SS:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert ("#short" in text or "#long" in text) and "lev" in text
-        c, er, t, sl = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line)
-            if res:
-                c = res[1]
-            if "#short" in line or "#long" in line:
-                er = extract_numbers(line)
-            if "close" in line:
-                t = extract_numbers(line)
-            if "stop" in line:
-                sl = extract_numbers(line)[-1]
-        assert c and er and t and sl
-        return Signal(c, er, t, sl, tag=cls.__name__)
 
+class SS(RuleParser):
+    REQUIRES = (("#short", "#long"), "lev")
+    RULES = (
+        Rule(Symbol(), "c"),
+        Rule(("#short", "#long"), "er"),
+        Rule("close", "t"),
+        Rule("stop", "sl", last),
+    )
+
+
+class TCA(RuleParser):
+    REQUIRES = ("leverage",)
+    REQUIRED = ("c", "er", "t", "sl", "lv")
+    COMMANDS = ("clos",)
+    RULES = (
+        Rule(Symbol(None), "c"),
+        Rule("entry", "er"),
+        Rule("targets", "t"),
+        Rule(("stop loss", "sl"), "sl", number),
+        Rule("leverage", "lv", integer(strict=False, default=SKIP)),
+    )
 
-class TCA:
     @classmethod
-    def parse(cls, text: str) -> Signal:
-        if "close position" in text:
-            coin = text.split("\n")[1].split(" ")[0]
+    def check(cls, msg: ParsedMessage):
+        if "close position" in msg:
+            coin = msg.lines[1].split(" ")[0]
             raise CloseTradeException(cls.__name__, coin)
-        elif "closing all position" in text:
+        elif "closing all position" in msg:
             raise CloseTradeException(cls.__name__)
-        close_match = re.search(r"(?:close|closing) ([a-z0-9]+)", text)
+        close_match = msg.search(r"(?:close|closing) ([a-z0-9]+)")
         if close_match:
             coin = close_match[1]
             raise CloseTradeException(cls.__name__, coin)
 
-        assert "leverage" in text
-        c, er, t, sl, lev = [None] * 5
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line, prefix=None)
-            if res:
-                c = res[1]
-            if "entry" in line:
-                er = extract_numbers(line)
-            if "targets" in line:
-                t = extract_numbers(line)
-            if "stop loss" in line or "sl" in line:
-                sl = extract_optional_number(line)
-            if "leverage" in line:
-                n = extract_optional_number(line)
-                if n:
-                    lev = int(n)
-        assert c and er and t and sl and lev
-        return Signal(c, er, t, sl, leverage=lev, tag=cls.__name__)
-
-
-class TVIPAW:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "leverage" in text
-        t = []
-        c, er, sl = [None] * 3
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line, prefix=None)
-            if res:
-                c = res[1]
-            if "entries" in line:
-                er = extract_numbers(line)
-            if "target" in line:
-                t.append(extract_numbers(line)[-1])
-            if "sl" in line:
-                sl = extract_optional_number(line)
-        assert c and er and t
-        return Signal(c, er, t, sl, stop_percent=0.05, tag=cls.__name__)
+
+class TVIPAW(RuleParser):
+    REQUIRES = ("leverage",)
+    REQUIRED = ("c", "er", "t")
+    STOP_PERCENT = 0.05
+    RULES = (
+        Rule(Symbol(None), "c"),
+        Rule("entries", "er"),
+        Rule("target", "t", last, mode=APPEND),
+        Rule("sl", "sl", number),
+    )
 
 
 class VIPBB(KBV):
     pass
 
 
-class VIPBS:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        try:
-            sig = CCS.parse(text)
-            sig.tag = cls.__name__
-            return sig
-        except Exception:
-            pass
-
-        assert "lev" in text and ("long" in text or "short" in text)
-        c, er, sl, t = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line, suffix=None)
-            if res:
-                c = res[1]
-            if "buy" in line:
-                er = extract_numbers(line)
-            if "sell" in line:
-                t = extract_numbers(line)
-            if "sl" in line:
-                sl = extract_optional_number(line)
-        assert c and er and sl and t
-        return Signal(c, er, t, sl, tag=cls.__name__)
-
+class VIPBS(RuleParser):
+    REQUIRES = ("lev", ("long", "short"))
+    FALLBACKS = (CCS,)
+    RULES = (
+        Rule(Symbol(suffix=None), "c"),
+        Rule("buy", "er"),
+        Rule("sell", "t"),
+        Rule("sl", "sl", number),
+    )
+
+
+class VIPCC(RuleParser):
+    REQUIRES = ("leverage",)
+    REQUIRED = ("c", "e", "sl", "t")
+    COMMANDS = ("close",)
+    RULES = (
+        Rule(Symbol(), "c"),
+        Rule(("short", "long"), "e", number),
+        Rule("take profit", "t", either(numbers, next_line())),
+        Rule("stoploss", "sl", number),
+    )
 
-class VIPCC:
     @classmethod
-    def parse(cls, text: str) -> Signal:
-        if text.strip() == "close":
+    def check(cls, msg: ParsedMessage):
+        if msg.text.strip() == "close":
             raise CloseTradeException(cls.__name__)
 
-        assert "leverage" in text
-        c, e, sl, t = [None] * 4
-        lines = [line for line in map(str.strip, text.split("\n")) if line]
-        for i, line in enumerate(lines):
-            res = extract_symbol(line)
-            if res:
-                c = res[1]
-            if "short" in line or "long" in line:
-                e = extract_optional_number(line)
-            if "take profit" in line:
-                t = extract_numbers(line)
-                if not t:
-                    t = extract_numbers(lines[i + 1])
-            if "stoploss" in line:
-                sl = extract_optional_number(line)
-        assert c and e and sl and t
-        return Signal(c, [e], t, sl, tag=cls.__name__)
-
-
-class VIPCS:
+
+class VIPCS(RuleParser):
+    REQUIRES = ("leverage",)
+    REQUIRED = ("c", "e", "t", "sl")
+    COMMANDS = ("close ",)
+    SKIP_BLANK = False
+    RULES = (
+        Rule(Symbol(), "c", when="⚡"),
+        Rule(Symbol(None), "c", unless="⚡"),
+        Rule(("buy", "entry"), "e", number),
+        Rule("entry target", "e", next_line(last)),
+        Rule("take-profit target", "t", listing(-1), mode=EXTEND,
+             orelse=Rule("target ", "t", second, mode=APPEND)),
+        Rule("stoploss", "sl", number, orelse=Rule("stop target", "sl", next_line(last))),
+    )
+
     @classmethod
-    def parse(cls, text: str) -> Signal:
-        if "close " in text:
-            coin = text.split("\n")[-1].split(" ")[-1]
+    def check(cls, msg: ParsedMessage):
+        if "close " in msg:
+            coin = msg.lines[-1].split(" ")[-1]
             raise CloseTradeException(cls.__name__, coin)
 
-        t = []
-        c, e, sl = [None] * 3
-        assert "leverage" in text
-        lines = list(map(str.strip, text.split("\n")))
-        for i, line in enumerate(lines):
-            res = extract_symbol(line, prefix=("#" if "⚡" in line else None))
-            if res:
-                c = res[1]
-            if "buy" in line or "entry" in line:
-                e = extract_optional_number(line)
-            if "entry target" in line:
-                e = extract_numbers(lines[i + 1])[-1]
-            if "take-profit target" in line:
-                j = i + 1
-                while True:
-                    n = extract_numbers(lines[j])
-                    if len(n) < 2:
-                        break
-                    t.append(n[-1])
-                    j += 1
-            elif "target " in line:
-                res = extract_numbers(line)
-                t.append(res[1])
-            if "stoploss" in line:
-                sl = extract_optional_number(line)
-            elif "stop target" in line:
-                sl = extract_numbers(lines[i + 1])[-1]
-        assert c and e and t and sl
-        return Signal(c, [e], t, sl, tag=cls.__name__)
-
-
-class W:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "long" in text or "short" in text
-        c, er, t, sl = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            prefix, suffix = None, None
-            if "$" in line:
-                prefix = r"\$"
-            elif "- usdt" in line:
-                suffix = " - usdt"
-            if not c:
-                res = extract_symbol(line, prefix=prefix, suffix=suffix)
-                if res:
-                    c = res[1]
-            if "sell" in line or "buy" in line or "long" in line or "short" in line:
-                er = extract_numbers(line)
-            if "target" in line:
-                t = extract_numbers(line)
-            if "stop" in line:
-                sl = extract_numbers(line)[-1]
-        assert c and er and t and sl
-        return Signal(c, er, t, sl, tag=cls.__name__)
 
+class W(RuleParser):
+    REQUIRES = (("long", "short"),)
+    RULES = (
+        Rule(Symbol(r"\$", None), "c", mode=FIRST),
+        Rule(Symbol(None, " - usdt"), "c", mode=FIRST, unless="$"),
+        Rule(None, "c", symbol(None, None), mode=FIRST, unless=("$", "- usdt")),
+        Rule(("sell", "buy", "long", "short"), "er"),
+        Rule("target", "t"),
+        Rule("stop", "sl", last),
+    )
+
+
+class YCP(RuleParser):
+    REQUIRES = ("leverage",)
+    RULES = (
+        Rule(Symbol(), "c"),
+        Rule("entry zone", "er"),
+        Rule("targets", "t"),
+        Rule("stop-loss", "sl", first),
+    )
+
+
+class Router:
+    # Picks parsers for messages from chats which aren't in CHANNELS. Keywords of all parsers
+    # are matched in one pass over the text and each parser is scored by the cosine of its
+    # signature and the keywords found (idf weighted). Parsers that can't fill a required
+    # field (none of its anchors are in the text) are left out, and the best few above the
+    # threshold are the candidates. Their signals are compared and the reading most of the
+    # score backs wins if it's clearly ahead - the message is dropped otherwise.
+    MIN_CONFIDENCE = 0.2
+    MIN_MARGIN = 0.1
+    MAX_CANDIDATES = 6
+    AGREE_ON = ("coin", "entries", "targets", "sl")
+
+    def __init__(self, parsers):
+        signatures = {}
+        for ch in parsers:
+            words = ch.signature()
+            if words and words not in signatures.values():  # subclasses share signatures
+                signatures[ch] = words
+        vocabulary = sorted(set().union(*signatures.values()))
+        ids = {w: k for k, w in enumerate(vocabulary)}
+        df = collections.Counter(w for words in signatures.values() for w in words)
+        self.matcher = Matcher([Keyword(w) for w in vocabulary])
+        self.weights = [math.log(1 + len(signatures) / df[w]) ** 2 for w in vocabulary]
+        self.owners = [[] for _ in vocabulary]
+        self.totals = {}
+        self.anchors = {}
+        for ch, words in signatures.items():
+            for w in words:
+                self.owners[ids[w]].append(ch)
+            self.totals[ch] = sum(self.weights[ids[w]] for w in words)
+            rules = ch.rules()
+            self.anchors[ch] = [a for a in map(rules.anchors, ch.REQUIRED) if a is not None]
+        self.routed = collections.Counter()
+
+    def scores(self, msg: ParsedMessage) -> list:
+        res = collections.defaultdict(float)
+        norm = 0
+        for k in self.matcher.hits(msg.text):
+            w = self.weights[k]
+            norm += w
+            for ch in self.owners[k]:
+                res[ch] += w
+        return sorted(((score / math.sqrt(self.totals[ch] * norm), ch) for ch, score in res.items()),
+                      key=lambda item: item[0], reverse=True)
+
+    def candidates(self, msg: ParsedMessage) -> list:
+        res = []
+        for score, ch in self.scores(msg):
+            if score < self.MIN_CONFIDENCE:
+                break
+            if self._fillable(ch, msg) and ch.prefilter().matches(msg):
+                res.append((score, ch))
+                if len(res) == self.MAX_CANDIDATES:
+                    break
+        return res
+
+    def choose(self, parsed: list):
+        # (parser, signal) from [(score, parser, signal), ...] in score order. Parsers that read
+        # the message the same way pool their scores, the best reading has to lead the next one
+        # by MIN_MARGIN or the message is dropped.
+        readings = []  # [total score, parser, signal] of the best parser of each reading
+        for score, ch, sig in parsed:
+            for reading in readings:
+                if not any(name in self.AGREE_ON for name in reading[2].diff(sig)):
+                    reading[0] += score
+                    break
+            else:
+                readings.append([score, ch, sig])
+        if not readings:
+            return None
+        readings.sort(key=lambda reading: reading[0], reverse=True)
+        if len(readings) > 1 and readings[0][0] - readings[1][0] < self.MIN_MARGIN:
+            return None
+        return readings[0][1], readings[0][2]
+
+    @staticmethod
+    def stop_agrees(msg: ParsedMessage, sig) -> bool:
+        # The SL has to be one of the numbers on the first line about the stop (if it has any),
+        # a parser made for another channel tends to take it from somewhere else
+        for line in msg.content:
+            if STOP_PATTERN.search(line):
+                numbers = extract_numbers(line)
+                if numbers:
+                    return sig.sl in numbers
+        return True
+
+    def _fillable(self, ch, msg):
+        for anchors in self.anchors[ch]:
+            for literal in anchors:
+                if literal in msg:
+                    break
+            else:
+                return False
+        return True
 
-class YCP:
-    @classmethod
-    def parse(cls, text: str) -> Signal:
-        assert "leverage" in text
-        c, er, t, sl = [None] * 4
-        for line in map(str.strip, text.split("\n")):
-            res = extract_symbol(line)
-            if res:
-                c = res[1]
-            if "entry zone" in line:
-                er = extract_numbers(line)
-            if "targets" in line:
-                t = extract_numbers(line)
-            if "stop-loss" in line:
-                sl = extract_numbers(line)[0]
-        assert c and er and t and sl
-        return Signal(c, er, t, sl, tag=cls.__name__)
+
+_router = None
+
+
+def router() -> Router:
+    global _router
+    if _router is None:
+        _router = Router(ch for ch in CHANNELS.values() if ch is not RESULTS)
+    return _router
+
+
+def prefilter_stats() -> dict:
+    return {ch.__name__: {"passed": ch.prefilter().passed, "dropped": ch.prefilter().dropped}
+            for ch in set(CHANNELS.values())}
 
 
 CHANNELS = {
@@ -0,0 +1,227 @@
+import asyncio
+import collections
+import json
+import time
+
+import websockets
+
+from .logger import DEFAULT_LOGGER as logging
+
+FUTURES_STREAM_URL = "wss://fstream.binance.com/stream"
+TESTNET_STREAM_URL = "wss://stream.binancefuture.com/stream"
+MAX_STREAMS_PER_CONNECTION = 200  # Binance allows 200 per connection
+RECONNECT_SLEEP = 2
+
+AGG_TRADE = "aggTrade"
+BOOK_TICKER = "bookTicker"
+MARK_PRICE = "markPrice"
+
+
+def _agg_trade(data):
+    return float(data["p"]), float(data["q"]), data["T"] / 1000
+
+
+def _book_ticker(data):
+    return (float(data["b"]) + float(data["a"])) / 2, None, data["T"] / 1000
+
+
+def _mark_price(data):
+    return float(data["p"]), None, data["E"] / 1000
+
+
+# source -> (stream name suffix, payload -> (price, trade quantity or None, exchange time))
+SOURCES = {
+    AGG_TRADE: ("aggTrade", _agg_trade),  # every trade, the only one which fills the trade rings
+    BOOK_TICKER: ("bookTicker", _book_ticker),  # mid of the best bid/ask, on every book change
+    MARK_PRICE: ("markPrice@1s", _mark_price),  # once a second
+}
+
+
+class StreamConnection:
+    # One combined-stream websocket. Streams are added and removed with SUBSCRIBE/UNSUBSCRIBE
+    # frames while it stays open, and all of them are subscribed again after a reconnect.
+
+    def __init__(self, url, handler):
+        self.url = url
+        self.handler = handler  # called with (stream, data) for every message
+        self.streams = set()
+        self.ws = None
+        self.task = None
+        self.count = 0
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def subscribe(self, streams):
+        self.streams.update(streams)
+        await self._send("SUBSCRIBE", streams)
+
+    async def unsubscribe(self, streams):
+        self.streams.difference_update(streams)
+        await self._send("UNSUBSCRIBE", streams)
+
+    async def _send(self, method, streams):
+        if self.ws is None or not streams:
+            return  # subscribed once connected
+        self.count += 1
+        try:
+            await self.ws.send(json.dumps({"method": method, "params": sorted(streams), "id": self.count}))
+        except (websockets.ConnectionClosed, OSError) as err:
+            # `streams` are sent again when the connection is back
+            logging.warning(f"Unable to {method} {len(streams)} stream(s) on a closed connection: {err}")
+
+    async def _run(self):
+        while True:
+            try:
+                async with websockets.connect(self.url) as ws:
+                    self.ws = ws
+                    await self._send("SUBSCRIBE", self.streams)
+                    async for raw in ws:
+                        msg = json.loads(raw)
+                        stream = msg.get("stream")
+                        if stream is not None:
+                            self.handler(stream, msg["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logging.error(f"Price stream connection failed: {err}")
+            finally:
+                self.ws = None
+            await asyncio.sleep(RECONNECT_SLEEP)
+
+
+class StreamManager:
+    # Streams shared by everything that needs them: the first subscriber of a stream costs a
+    # SUBSCRIBE frame on a connection with room left (a new connection once they're all full),
+    # the last one leaving an UNSUBSCRIBE. Streams added or removed together share the frame of
+    # their connection, Binance takes no more than 10 messages a second. Connections are never
+    # torn down to change streams.
+
+    def __init__(self, handler, url=FUTURES_STREAM_URL, max_streams=MAX_STREAMS_PER_CONNECTION):
+        self.handler = handler
+        self.url = url
+        self.max_streams = max_streams
+        self.refs = collections.Counter()
+        self.owners = {}
+        self.connections = []
+
+    async def subscribe(self, stream: str):
+        self.refs[stream] += 1
+        if self.refs[stream] == 1:
+            await self._add([stream])
+
+    async def unsubscribe(self, stream: str):
+        if not self.refs.get(stream):
+            return
+        self.refs[stream] -= 1
+        if self.refs[stream]:
+            return
+        del self.refs[stream]
+        await self._remove([stream])
+
+    async def reset(self, counts: dict):
+        # Brings the subscriptions to `counts` (stream -> subscribers) with as few frames as it
+        # takes: the streams which go and the ones which come take one frame per connection
+        removed = [stream for stream in self.refs if not counts.get(stream)]
+        for stream in removed:
+            del self.refs[stream]
+        await self._remove(removed)
+        added = []
+        for stream, n in counts.items():
+            if n <= 0:
+                continue
+            if stream not in self.refs:
+                added.append(stream)
+            self.refs[stream] = n
+        await self._add(added)
+
+    async def _add(self, streams):
+        batches = {}  # connection -> streams to subscribe on it
+        for stream in streams:
+            for conn in self.connections:
+                if len(conn.streams) + len(batches.get(conn, ())) < self.max_streams:
+                    break
+            else:
+                conn = self._connection()
+                self.connections.append(conn)
+                conn.start()
+            batches.setdefault(conn, []).append(stream)
+            self.owners[stream] = conn
+        for conn, batch in batches.items():
+            await conn.subscribe(batch)
+
+    async def _remove(self, streams):
+        batches = {}
+        for stream in streams:
+            batches.setdefault(self.owners.pop(stream), []).append(stream)
+        for conn, batch in batches.items():
+            await conn.unsubscribe(batch)
+
+    async def close(self):
+        for conn in self.connections:
+            await conn.close()
+        self.connections = []
+        self.owners.clear()
+        self.refs.clear()
+
+    def _connection(self):
+        return StreamConnection(self.url, self.handler)
+
+
+class PriceStream:
+    # Handler of the per-coin price streams which feeds a PriceFeed. Stream names map to their
+    # coin through a table filled when they're named. Every trade goes into the coin's ring, and
+    # with `conflate` only the latest price per coin is published once the event loop gets to it -
+    # a burst of trades costs one update.
+
+    def __init__(self, prices, source=AGG_TRADE, conflate=True):
+        self.prices = prices
+        self.source = source
+        self.suffix, self.parse = SOURCES[source]
+        self.conflate = conflate
+        self.coins = {}  # stream name -> coin
+        self.pending = {}  # coin -> (price, time received)
+        self.scheduled = False
+        self.received = 0
+        self.applied = 0
+
+    def stream(self, coin: str) -> str:
+        name = f"{coin.lower()}usdt@{self.suffix}"
+        self.coins[name] = coin.upper()
+        return name
+
+    def __call__(self, stream: str, data: dict):
+        self.received += 1
+        coin = self.coins.get(stream)
+        if coin is None:
+            return
+        try:
+            price, qty, at = self.parse(data)
+        except (KeyError, TypeError, ValueError) as err:
+            logging.error(f"Failed to get price for {stream}: {err}")
+            return
+        now = time.time()
+        if qty is not None:
+            self.prices.record(coin, price, qty, at, now)
+        if not self.conflate:
+            self._publish(coin, price, now)
+            return
+        self.pending[coin] = (price, now)
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_event_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        pending, self.pending = self.pending, {}
+        for coin, (price, now) in pending.items():
+            self._publish(coin, price, now)
+
+    def _publish(self, coin, price, now):
+        self.prices.update(coin, price, now)
+        self.applied += 1
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import math
+import os
+import time
+from typing import NamedTuple
+
+from .errors import InvalidOrderException
+
+EXCHANGE_INFO_TTL = 60 * 60  # a cached exchange info younger than this is used as it is
+EXCHANGE_INFO_REFRESH = 30 * 60  # seconds between refreshes while running
+
+
+def decimals(value) -> int:
+    # digits after the point of a filter value, "0.00100000" (or 0.001) has 3
+    return len(f"{float(value):.12f}".partition(".")[2].rstrip("0"))
+
+
+def nearest(steps):
+    # halves go up, round() takes them to the even neighbour (2.5 -> 2, 3.5 -> 4)
+    return math.floor(steps + 0.5)
+
+
+def snap(price, tick, rounding=nearest, places=None):
+    # Multiple of the tick nearest to the price (or below/above it with math.floor/ceil),
+    # `places` are the tick's decimals when they're known already
+    steps = round(price / tick, 6)  # 0.3 / 0.1 is 2.9999999999999996 ticks
+    return round(rounding(steps) * tick, decimals(tick) if places is None else places)
+
+
+class SymbolSpec(NamedTuple):
+    # What orders of a symbol must look like, taken from its exchange info filters once
+    symbol: str
+    tick: float = 0.0
+    step: float = 0.0
+    min_qty: float = 0.0
+    max_qty: float = 0.0  # 0 when there's no limit
+    min_notional: float = 0.0
+    price_precision: int = 8
+    qty_precision: int = 8
+    trading: bool = True
+
+    @classmethod
+    def from_info(cls, info: dict):
+        filters = {f["filterType"]: f for f in info.get("filters", ())}
+        price = filters.get("PRICE_FILTER", {})
+        lot = filters.get("LOT_SIZE", {})
+        notional = filters.get("MIN_NOTIONAL", {})
+        tick, step = price.get("tickSize", "0"), lot.get("stepSize", "0")
+        return cls(
+            symbol=info["symbol"],
+            tick=float(tick),
+            step=float(step),
+            min_qty=float(lot.get("minQty", 0)),
+            max_qty=float(lot.get("maxQty", 0)),
+            # "notional" for futures, "minNotional" for spot
+            min_notional=float(notional.get("notional", notional.get("minNotional", 0))),
+            price_precision=decimals(tick) if float(tick) else info.get("pricePrecision", 8),
+            qty_precision=decimals(step) if float(step) else info.get("quantityPrecision", 8),
+            trading=info.get("status", "TRADING") == "TRADING",
+        )
+
+    def price(self, price: float, rounding=nearest) -> float:
+        if not self.tick:
+            return round(price, self.price_precision)
+        return snap(price, self.tick, rounding, self.price_precision)
+
+    def qty(self, qty: float, rounding=nearest) -> float:
+        if not self.step:
+            return round(qty, self.qty_precision)
+        return snap(qty, self.step, rounding, self.qty_precision)
+
+    def validate(self, qty: float, price: float, market=False, reduce=False):
+        # Raises for orders the exchange would reject (-1111 for precision, -4164 for a notional
+        # below the minimum, which doesn't apply to orders reducing a position). `price` is the
+        # current one for market orders, it's only used for the notional then.
+        if qty != self.qty(qty):
+            raise InvalidOrderException(self.symbol, f"quantity {qty} is not a multiple of {self.step}")
+        if not market and price != self.price(price):
+            raise InvalidOrderException(self.symbol, f"price {price} is not a multiple of {self.tick}")
+        if qty < self.min_qty or qty <= 0:
+            raise InvalidOrderException(self.symbol, f"quantity {qty} is below the minimum of {self.min_qty}")
+        if self.max_qty and qty > self.max_qty:
+            raise InvalidOrderException(self.symbol, f"quantity {qty} is above the maximum of {self.max_qty}")
+        if not reduce and qty * price < self.min_notional:
+            raise InvalidOrderException(
+                self.symbol, f"notional {round(qty * price, 4)} is below the minimum of {self.min_notional}")
+
+
+def _digest(info: dict) -> bytes:
+    return hashlib.blake2b(json.dumps(info, sort_keys=True).encode(), digest_size=16).digest()
+
+
+class SymbolTable(dict):
+    # SymbolSpec by symbol, kept in sync with fresh exchange info in place: only the specs of
+    # symbols whose info changed are rebuilt, the ones no longer listed are dropped.
+
+    def __init__(self):
+        super().__init__()
+        self.digests = {}
+
+    def sync(self, symbols):
+        # (added, changed, removed) symbols
+        added, changed = [], []
+        seen = set()
+        for info in symbols:
+            symbol = info["symbol"]
+            seen.add(symbol)
+            digest = _digest(info)
+            if self.digests.get(symbol) == digest:
+                continue
+            (changed if symbol in self else added).append(symbol)
+            self.digests[symbol] = digest
+            self[symbol] = SymbolSpec.from_info(info)
+        removed = [symbol for symbol in self if symbol not in seen]
+        for symbol in removed:
+            del self[symbol]
+            self.digests.pop(symbol, None)
+        return added, changed, removed
+
+
+def load_exchange_info(path: str):
+    # (symbols, time fetched) from the cache or None
+    try:
+        with open(path) as fd:
+            data = json.load(fd)
+        return data["symbols"], data["fetched"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_exchange_info(path: str, symbols, fetched=None):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as fd:
+        json.dump({"fetched": time.time() if fetched is None else fetched, "symbols": symbols}, fd)
+    os.replace(tmp, path)
@@ -1,26 +1,74 @@
 import asyncio
+import collections
+import time
 
-from telethon import TelegramClient, events
-from telethon.tl.custom import Message
+from cachetools import LRUCache
+from telethon import TelegramClient, events, types, utils
 
 from . import FuturesTrader
-from .errors import CloseTradeException, MoveStopLossException, ModifyTargetsException
+from .config import ConfigStore
+from .errors import CloseTradeException, MoveStopLossException, ModifyTargetsException, ParseBudgetException
 from .logger import DEFAULT_LOGGER as logging
-from .signal import CHANNELS, Signal, RESULTS_CHANNEL
+from .messages import MessageCache
+from .outbox import Outbox
+from .shard import owner
+from .signal import BUDGET_VIOLATIONS, CHANNELS, PARSE_CACHE, Signal, RESULTS_CHANNEL, prefilter_stats
+
+NEW_MESSAGE_UPDATES = (types.UpdateNewMessage, types.UpdateNewChannelMessage)
+EDIT_MESSAGE_UPDATES = (types.UpdateEditMessage, types.UpdateEditChannelMessage)
+STALE_SIGNAL_AGE = 30  # older signals only enter at their price (limit orders)
+MAX_SIGNAL_AGE = 5 * 60  # older signals are dropped, unless set otherwise in config
+CATCH_UP_LIMIT = 50  # missed messages fetched per chat, the most recent ones
+STATS_INTERVAL = 60 * 60  # seconds between logging the stats, they're logged on shutdown too
+
+
+class Update:
+    # The parts of a message the handlers use, taken straight from the raw update. The text is
+    # formatted with the client's parse mode (markdown) like `event.text` is, which raw updates
+    # don't do as their messages aren't bound to the client.
+    __slots__ = ("chat_id", "id", "date", "edit_date", "text", "reply_to_msg_id")
+
+    def __init__(self, chat_id: int, message: types.Message, parse_mode=None):
+        self.chat_id = chat_id
+        self.id = message.id
+        self.date = message.date
+        self.edit_date = message.edit_date
+        self.text = message.message or ""
+        if parse_mode is not None and message.entities:
+            self.text = parse_mode.unparse(self.text, message.entities)
+        self.reply_to_msg_id = message.reply_to.reply_to_msg_id if message.reply_to is not None else None
+
+    @property
+    def origin(self):
+        # what a request to the trader is deduplicated by, an edit is a message of its own
+        return self.chat_id, self.id, int(self.edit_date.timestamp()) if self.edit_date is not None else 0
 
 
 class TeleTrader(TelegramClient):
-    def __init__(self, api_id, api_hash, session=None, state={}, loop=None):
+    def __init__(self, api_id, api_hash, session=None, state={}, loop=None, messages_path=None,
+                 trader=None, shard=0, shards=1):
         self.state = state
-        self.trader = FuturesTrader()
-        self.trader.results_handler = self._post_result
+        self.messages = MessageCache(path=messages_path)
+        self.trader = trader if trader is not None else FuturesTrader()
+        self.outbox = Outbox(self._send_result)
+        self.trader.results_handler = self.outbox.post
         super().__init__(session, api_id, api_hash, loop=loop)
         if session is None:
             logging.info("Setting test server")
             self.session.set_dc(2, "149.154.167.40", 443)
-        if not self.state.get("config"):
-            self.state["config"] = {}
-        self.lock = asyncio.Lock()
+        self.config = ConfigStore(self.state)
+        self.trader.config = self.config
+        self.shard = shard
+        self.shards = shards
+        self.chats = frozenset(c for c in set(CHANNELS).union((RESULTS_CHANNEL,)) if owner(c, shards) == shard)
+        self.peers = {}
+        self.dispatched = collections.Counter()  # chat id -> updates handled
+        self.ignored = 0
+        self.handled = LRUCache(maxsize=4096)  # (chat id, message id) of new messages, live or caught up
+        self.caught_up = 0
+        self.lags = collections.deque(maxlen=1000)  # seconds from posting to handling, per signal
+        if not self.state.get("last_seen"):
+            self.state["last_seen"] = {}
 
     async def init(self, api_key, api_secret):
         logging.info("Initializing telegram client")
@@ -29,24 +77,127 @@ class TeleTrader(TelegramClient):
         if not user_auth:
             logging.info("User is not authorized")
         await self.start()
+        await self._resolve_peers()
+        self.outbox.start()
         logging.info("Initializing binance trader")
         await self.trader.init(api_key, api_secret, state=self.state, loop=self.loop)
 
     async def run(self):
-        self.add_event_handler(self._handler, events.NewMessage)
+        self.add_event_handler(self._raw_handler, events.Raw(types=NEW_MESSAGE_UPDATES + EDIT_MESSAGE_UPDATES))
+        asyncio.ensure_future(self._catch_up_all())
+        stats = asyncio.ensure_future(self._log_stats_periodically())
         try:
             await self.run_until_disconnected()
         finally:
+            stats.cancel()
+            await self.outbox.stop()
             await self.disconnect()
+            self.messages.close()
+            self._log_stats()
+
+    async def _log_stats_periodically(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            self._log_stats()
+
+    def _log_stats(self):
+        logging.info(f"Ignored {self.ignored} updates, caught up on {self.caught_up} messages, "
+                     f"dispatched: {dict(self.dispatched)}")
+        if self.lags:
+            lags = sorted(self.lags)
+            logging.info(f"Signal lag: p50 {round(lags[len(lags) // 2], 2)}s, max {round(lags[-1], 2)}s")
+        prefilter = prefilter_stats()
+        logging.info(f"Prefilter: {sum(s['passed'] for s in prefilter.values())} passed, "
+                     f"{sum(s['dropped'] for s in prefilter.values())} dropped, per parser: {prefilter}")
+        logging.info(f"Parse cache: {PARSE_CACHE.stats()}, messages: {self.messages.hits} hits, "
+                     f"{self.messages.misses} misses")
+        logging.info(f"Outbox: {self.outbox.metrics()}")
+        if BUDGET_VIOLATIONS:
+            logging.info(f"Messages over the parse limits: {dict(BUDGET_VIOLATIONS)}", color="yellow")
+
+    async def _resolve_peers(self):
+        # Resolved once so sends and lookups don't go through the entity cache every time
+        missing = []
+        for chat_id in self.chats:
+            try:
+                self.peers[chat_id] = await self.get_input_entity(chat_id)
+            except Exception:
+                missing.append(chat_id)
+        if missing:
+            logging.info(f"Unable to resolve {len(missing)} chat(s): {missing}", color="yellow")
+
+    async def _raw_handler(self, update):
+        # Only messages from chats we parse are handled, and without building Message/events
+        message = update.message
+        if type(message) is not types.Message and type(message) is not types.MessageService:
+            return
+        chat_id = utils.get_peer_id(message.peer_id)
+        if chat_id not in self.chats and not (chat_id in self.config.current.routed and
+                                              owner(chat_id, self.shards) == self.shard):
+            self.ignored += 1
+            return
+        if type(message) is types.MessageService:
+            # pins, title changes etc take an id too, they aren't a gap to catch up on
+            if isinstance(update, NEW_MESSAGE_UPDATES):
+                self._advance(chat_id, message.id)
+            return
+        self.dispatched[chat_id] += 1
+        if isinstance(update, NEW_MESSAGE_UPDATES):
+            last = self.state["last_seen"].get(str(chat_id))
+            await self._handle_new(chat_id, message)
+            if chat_id != RESULTS_CHANNEL and last is not None and message.id > last + 1:
+                # a gap in the ids - posted while we were disconnected (or deleted since). The
+                # live message goes first, missed ones are fetched in the background and go
+                # through the same age limits (an old close/move is dropped).
+                asyncio.ensure_future(self._catch_up(chat_id, last, message.id))
+        else:
+            await self._edit_handler(Update(chat_id, message, self.parse_mode))
+
+    async def _handle_new(self, chat_id, message):
+        key = (chat_id, message.id)
+        if key in self.handled:  # already seen live or through a catch-up
+            return
+        self.handled[key] = True
+        self._advance(chat_id, message.id)
+        await self._handler(Update(chat_id, message, self.parse_mode))
+
+    def _advance(self, chat_id, message_id):
+        last_seen = self.state["last_seen"]
+        if message_id > last_seen.get(str(chat_id), 0):
+            last_seen[str(chat_id)] = message_id
+
+    async def _catch_up_all(self):
+        routed = self.config.current.routed
+        for key, last in list(self.state["last_seen"].items()):
+            chat_id = int(key)
+            if chat_id == RESULTS_CHANNEL:  # commands aren't replayed
+                continue
+            if (chat_id in CHANNELS or chat_id in routed) and owner(chat_id, self.shards) == self.shard:
+                await self._catch_up(chat_id, last)
 
-    async def _post_result(self, message: str):
+    async def _catch_up(self, chat_id, min_id, max_id=0):
+        # Messages after `min_id` (and before `max_id`) which never came as updates. Only the
+        # last CATCH_UP_LIMIT are fetched, older ones would be too stale to trade anyway.
         try:
-            await self.send_message(RESULTS_CHANNEL, message)
-        except Exception:
-            logging.exception("Failed to send result")
+            messages = [m async for m in self.iter_messages(
+                self.peers.get(chat_id, chat_id), min_id=min_id, max_id=max_id, limit=CATCH_UP_LIMIT)]
+        except Exception as err:
+            logging.warning(f"Unable to catch up on messages from {chat_id}: {err}")
+            return
+        for message in reversed(messages):
+            if not isinstance(message, types.Message) or not message.message:
+                continue
+            self.caught_up += 1
+            await self._handle_new(chat_id, message)
+
+    async def _send_result(self, message: str):
+        await self.send_message(self.peers.get(RESULTS_CHANNEL, RESULTS_CHANNEL), message)
 
-    async def _handler(self, event: Message):
+    async def _handler(self, event: Update):
         sig, tag = None, None
+        config = self.config.current
+        age = time.time() - event.date.timestamp()
+        max_age = config.max_age if config.max_age is not None else MAX_SIGNAL_AGE
         if event.chat_id == RESULTS_CHANNEL:
             try:
                 await self._handle_command(event.text)
@@ -57,39 +208,136 @@ class TeleTrader(TelegramClient):
         try:
             if CHANNELS.get(event.chat_id):
                 tag = CHANNELS[event.chat_id].__name__
-            async with self.lock:
-                sig = Signal.parse(event.chat_id, event.text,
-                                   risk_factor=self.state["config"].get("rf"))
-        # except MoveStopLossException as err:
-        #     pass
-        # except ModifyTargetsException as err:
-        #     pass
+            sig = Signal.parse(event.chat_id, event.text, risk_factor=config.rf, routed=config.routed)
         except CloseTradeException as err:
-            coin = err.coin
-            reply = await event.get_reply_message()
-            if reply is not None:
-                try:
-                    parent = Signal.parse(event.chat_id, reply.text)
-                    coin = parent.coin
-                except AssertionError:
-                    logging.info(f"Ignoring previous message from {tag} as requirements are not met", color="white")
+            if age > max_age:  # e.g. caught up on, it may be about an older trade than the open one
+                logging.info(f"Ignoring close from {err.tag} posted {round(age)}s ago", color="yellow")
+                return
+            target = await self._command_target(event, err.tag, err.coin, tag)
+            if target is None:
+                return
+            otag, coin = target
+            logging.info(f"Received message for closing {coin if coin else 'all'} "
+                         f"trades from {otag}: {event.text}", color="red")
+            await self.trader.close_trades(otag, coin, origin=event.origin)
+        except MoveStopLossException as err:
+            if age > max_age:
+                logging.info(f"Ignoring SL move from {err.tag} posted {round(age)}s ago", color="yellow")
+                return
+            otag = err.tag
+            if otag is None:  # e.g. "change sl 5.6" in reply to a signal
+                target = await self._command_target(event, None, None, tag)
+                if target is None:
                     return
-                except Exception:
-                    logging.exception(f"Unable to parse previous message >>> {reply.text} <<< as signal")
+                otag = target[0]
+            logging.info(f"Received message for moving SL of {otag} to {err.price}", color="yellow")
+            await self.trader.update_trade(otag, sl=err.price, origin=event.origin)
+        except ModifyTargetsException as err:
+            if age > max_age:
+                logging.info(f"Ignoring new targets from {err.tag} posted {round(age)}s ago", color="yellow")
+                return
+            otag = err.tag
+            if otag is None:
+                target = await self._command_target(event, None, None, tag)
+                if target is None:
                     return
-            logging.info(f"Received message for closing {coin if coin else 'all'} "
-                         f"trades from {err.tag}: {event.text}", color="red")
-            await self.trader.close_trades(err.tag, coin)
+                otag = target[0]
+            logging.info(f"Received message for changing targets of {otag} to {err.targets}", color="yellow")
+            await self.trader.update_trade(otag, targets=err.targets, origin=event.origin)
         except AssertionError:
             logging.info(f"Ignoring message from {tag} as requirements are not met", color="white")
+        except ParseBudgetException as err:
+            logging.warning(f"Ignoring message from {tag} as it exceeds parse {err.reason} limit ({err.value})")
         except Exception:
             logging.exception(f"Ignoring message from {tag} due to parse failure: {event.text}")
 
         if sig is None:
             return
 
-        logging.info(f"Received signal {sig}", color="cyan")
-        await self.trader.queue_signal(sig)
+        self.lags.append(age)
+        if age > max_age:
+            logging.info(f"Ignoring signal from {tag} posted {round(age)}s ago: {sig}", color="yellow")
+            return
+        if age > STALE_SIGNAL_AGE and not sig.force_limit_order:
+            logging.info(f"Signal from {tag} posted {round(age)}s ago, using a limit order", color="yellow")
+            sig.force_limit_order = True
+
+        logging.info(f"Received signal {sig} ({round(age, 2)}s after posting)", color="cyan")
+        self.messages.put(event.chat_id, event.id, sig)
+        await self.trader.queue_signal(sig, origin=event.origin)
+
+    async def _edit_handler(self, event: Update):
+        if event.chat_id == RESULTS_CHANNEL:
+            return
+        cached = self.messages.parent(event.chat_id, event.id)
+        if cached is None:
+            await self._handler(event)  # wasn't a signal before the edit
+            return
+        original, tag = cached
+        try:
+            sig = Signal.parse(event.chat_id, event.text, routed=self.config.current.routed)
+        except CloseTradeException as err:
+            logging.info(f"Received edit for closing {tag}: {event.text}", color="red")
+            await self.trader.close_trades(err.tag, original.coin, origin=event.origin)
+            return
+        except AssertionError:
+            logging.info(f"Ignoring edit of {tag} as requirements are not met", color="white")
+            return
+        except Exception:
+            logging.exception(f"Ignoring edit of {tag} due to parse failure: {event.text}")
+            return
+        if sig is None:
+            return
+
+        changes = original.diff(sig)
+        if not changes:
+            return
+        fields = [name for name in ("sl", "targets") if name in changes]
+        ignored = [name for name in changes if name not in fields]
+        if ignored:
+            logging.info(f"Ignoring changed {', '.join(ignored)} in edit of {tag}", color="yellow")
+        if fields:
+            logging.info(f"Received edit of {tag}: {', '.join(f'{k} {changes[k]}' for k in fields)}", color="cyan")
+            await self.trader.amend_trade(tag, sig.copy(), fields, origin=event.origin)
+            # the next edit is compared against what the trade has, not what was ignored
+            applied = original.copy()
+            for name in fields:
+                setattr(applied, name, getattr(sig, name))
+            self.messages.replace(event.chat_id, event.id, applied)
+
+    async def _command_target(self, event: Update, otag, coin, tag):
+        # (order tag, coin) a command is about: a reply is about the trade opened by the message
+        # replied to, with the tag the order got (cached) - else what the command says. None when
+        # the replied message can't be parsed or there's no tag at all. SL moves and new targets
+        # naming a tag (e.g. "change tca-3 sl 5.6") don't look at what they reply to.
+        try:
+            parent = await self._parent_of(event)
+        except AssertionError:
+            logging.info(f"Ignoring previous message from {tag} as requirements are not met", color="white")
+            return None
+        except Exception:
+            logging.exception(f"Unable to parse previous message of {event.id} from {tag} as signal")
+            return None
+        if parent is not None:
+            return parent[1], parent[0].coin
+        if otag is None:
+            logging.info(f"Ignoring command from {tag} which isn't a reply to a trade: {event.text}", color="yellow")
+            return None
+        return otag, coin
+
+    async def _parent_of(self, event: Update):
+        # (signal, order tag) of the message replied to - only fetched when it isn't cached
+        if event.reply_to_msg_id is None:
+            return None
+        parent = self.messages.parent(event.chat_id, event.reply_to_msg_id)
+        if parent is not None:
+            return parent
+        reply = await self.get_messages(self.peers.get(event.chat_id, event.chat_id), ids=event.reply_to_msg_id)
+        if reply is None:
+            return None
+        sig = Signal.parse(event.chat_id, reply.text or "", routed=self.config.current.routed)
+        assert sig is not None
+        return sig, sig.tag
 
     async def _handle_command(self, text: str):
         assert text.startswith("set ")
@@ -97,19 +345,34 @@ class TeleTrader(TelegramClient):
         if args[0] == "set":
             if args[1] == "risk":
                 factor = float(args[2])
-                async with self.lock:
-                    if factor > 0:
-                        self.state["config"]["rf"] = factor
-                        await self._post_result(f"Risk is now set to {factor * Signal.DEFAULT_RISK * 100}%")
-                    else:
-                        self.state["config"].pop("rf", None)
-                        await self._post_result("Risk is now reset to default")
+                if factor > 0:
+                    self.config.update(rf=factor)
+                    self.outbox.post(f"Risk is now set to {factor * Signal.DEFAULT_RISK * 100}%")
+                else:
+                    self.config.update(rf=None)
+                    self.outbox.post("Risk is now reset to default")
             elif args[1] == "rr":
                 rr = float(args[2])
-                async with self.lock:
-                    if rr > 0:
-                        self.state["config"]["rr"] = rr
-                        await self._post_result(f"RR is now set to {rr}")
-                    else:
-                        self.state["config"].pop("rr", None)
-                        await self._post_result("RR is now reset to default")
+                if rr > 0:
+                    self.config.update(rr=rr)
+                    self.outbox.post(f"RR is now set to {rr}")
+                else:
+                    self.config.update(rr=None)
+                    self.outbox.post("RR is now reset to default")
+            elif args[1] == "age":
+                max_age = float(args[2])
+                if max_age > 0:
+                    self.config.update(max_age=max_age)
+                    self.outbox.post(f"Signals older than {max_age}s are now ignored")
+                else:
+                    self.config.update(max_age=None)
+                    self.outbox.post("Signal age limit is now reset to default")
+            elif args[1] == "route":
+                chat_id = int(args[2])
+                routed = tuple(c for c in self.config.current.routed if c != chat_id)
+                if args[3] == "on":
+                    self.config.update(routed=routed + (chat_id,))
+                    self.outbox.post(f"Routing messages from {chat_id}")
+                else:
+                    self.config.update(routed=routed)
+                    self.outbox.post(f"Stopped routing messages from {chat_id}")
@@ -0,0 +1,53 @@
+import json
+import os
+import unittest
+
+from .bench import ACCEPTED, DEFAULT_BASELINE, REJECTED, compare, load_corpus, percentile, samples, tokenizer
+
+
+class TestBench(unittest.TestCase):
+    def test_corpus(self):
+        corpus = load_corpus()
+        self.assertGreater(len(corpus), 100)
+        self.assertIn("RESULTS", {name for name, _ in corpus})
+        self.assertNotIn("chat_id", {name for name, _ in corpus})
+        self.assertTrue(all(text == text.lower() for _, text in corpus))
+
+        res = samples([item for item in corpus if item[0] in ("BK", "SS")])
+        self.assertTrue(res["BK"][ACCEPTED] and res["BK"][REJECTED])
+
+    def test_percentile(self):
+        self.assertEqual(percentile([5, 1, 4, 2, 3], 50), 3)
+        self.assertEqual(percentile(list(range(1, 101)), 99), 99)
+        self.assertEqual(percentile([], 99), 0.0)
+
+    def test_compare(self):
+        def report(cal, p50, count=30):
+            return {"calibration_us": cal, "total": {ACCEPTED: {"p50_us": p50, "count": 300}},
+                    "channels": {"BK": {REJECTED: {"p50_us": p50, "count": count}}}}
+
+        self.assertEqual(compare(report(100, 10), report(100, 10)), [])
+        self.assertEqual(compare(report(200, 20), report(100, 10)), [])
+        self.assertEqual(compare(report(100, 15), report(100, 10)),
+                         [("total", ACCEPTED, 10, 15), ("BK", REJECTED, 10, 15)])
+        # too few samples to gate the channel on, the total still counts
+        self.assertEqual(compare(report(100, 15, count=5), report(100, 10, count=5)), [("total", ACCEPTED, 10, 15)])
+        # nor are channels below a few us
+        self.assertEqual(compare(report(100, 15), report(100, 10), min_us=12), [("total", ACCEPTED, 10, 15)])
+
+    def test_baseline(self):
+        self.assertEqual(os.path.dirname(DEFAULT_BASELINE), os.path.dirname(os.path.abspath(__file__)))
+        self.assertTrue(os.path.exists(DEFAULT_BASELINE))
+        with open(DEFAULT_BASELINE) as fd:
+            baseline = json.load(fd)
+        self.assertIn(ACCEPTED, baseline["total"])
+        self.assertGreater(baseline["calibration_us"], 0)
+
+    def test_tokenizer(self):
+        res = tokenizer(load_corpus()[:10], 1)
+        self.assertEqual(set(res), {"inline_us", "parsed_us"})
+
+        base = {"calibration_us": 100, "total": {}, "channels": {}}
+        self.assertEqual(compare(dict(base, tokenizer={"inline_us": 4, "parsed_us": 5}), base), [])
+        self.assertEqual(compare(dict(base, tokenizer={"inline_us": 4, "parsed_us": 8}), base),
+                         [("tokenizer", "parsed", 4, 8)])
@@ -0,0 +1,17 @@
+import unittest
+
+from .config import Config, ConfigStore
+
+
+class TestConfig(unittest.TestCase):
+    def test_update(self):
+        state = {"config": {"rf": 2, "routed": [-1001]}}
+        store = ConfigStore(state)
+        before = store.current
+        self.assertEqual(before, Config(rf=2, routed=(-1001,)))
+
+        store.update(rr=1.5, rf=None, max_age=60)
+        self.assertEqual(before.rf, 2)  # snapshots taken earlier don't change
+        self.assertEqual(store.current, Config(rr=1.5, routed=(-1001,), max_age=60))
+        self.assertEqual(state["config"], {"rr": 1.5, "routed": [-1001], "max_age": 60})
+        self.assertEqual(ConfigStore(state).current, store.current)
@@ -0,0 +1,53 @@
+import io
+import json
+import unittest
+from unittest import mock
+
+from . import history
+from .history import parse_message, read_export, read_jsonl
+
+TCA_TEXT = """Asset: EOS/USDT
+Position: #LONG
+Entry: 5.850 - 5.950
+Targets: 6.000 - 6.100 - 6.300 - 6.500
+Stop loss: 5.600
+Leverage: 75x"""
+
+
+class TestHistory(unittest.TestCase):
+    EXPORT = {
+        "about": "export",
+        "chats": {"list": [
+            {"name": "tca", "type": "private_channel", "id": 1239897393, "messages": [
+                {"id": 1, "type": "message", "date": "2021-05-01T10:00:00", "text": TCA_TEXT},
+                {"id": 2, "type": "service", "date": "2021-05-01T10:00:01", "action": "pin_message"},
+                {"id": 3, "type": "message", "date": "2021-05-01T10:00:02",
+                 "text": ["Closing ", {"type": "bold", "text": "all positions"}]},
+            ]},
+            {"name": "other", "type": "private_channel", "id": 42, "messages": [
+                {"id": 7, "type": "message", "date": "2021-05-02T10:00:00", "text": "hello ]"},
+            ]},
+        ]},
+    }
+
+    def test_read_export(self):
+        raw = json.dumps(self.EXPORT, indent=1)
+        for size in (3, 64, 1 << 20):
+            with mock.patch.object(history, "CHUNK_SIZE", size):
+                msgs = list(read_export(io.StringIO(raw)))
+            self.assertEqual([(m[0], m[1]) for m in msgs], [(-1001239897393, 1), (-1001239897393, 3), (-10042, 7)])
+            self.assertEqual(msgs[1][3], "Closing all positions")
+
+    def test_read_jsonl(self):
+        raw = '{"chat_id": -1001239897393, "id": 1, "date": "x", "text": "hi"}\n\n'
+        self.assertEqual(list(read_jsonl(io.StringIO(raw))), [(-1001239897393, 1, "x", "hi")])
+
+    def test_parse_message(self):
+        res = parse_message(-1001239897393, 1, "x", TCA_TEXT)
+        self.assertEqual(res["status"], "signal")
+        self.assertEqual(res["signal"]["entries"], [5.85, 5.95])
+        self.assertEqual(parse_message(-1001239897393, 3, "x", "Closing all positions")["status"], "close")
+        self.assertEqual(parse_message(-1001239897393, 4, "x", "good morning")["status"], "filtered")
+        self.assertEqual(parse_message(-10042, 7, "x", "hello")["status"], "unknown_channel")
+        res = parse_message(-1001239897393, 5, "x", "EOS/USDT leverage 20x\nentry 1 2\ntargets 3 4")
+        self.assertEqual((res["status"], res["reason"]), ("rejected", "extract: assert all(fields.get(f) for f in cls.REQUIRED)"))
@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+
+from .messages import MessageCache
+from .signal import Signal
+
+
+class TestMessageCache(unittest.TestCase):
+    def test_parent(self):
+        cache = MessageCache(maxsize=2)
+        sig = Signal("EOS", [5.85, 5.95], [6, 6.1], 5.6, 75, tag="TCA")
+        cache.put(-100, 1, sig)
+        sig.tag += "-3"  # tagged by the trader once queued
+        sig.correct(595)
+        parent, tag = cache.parent(-100, 1)
+        self.assertEqual(parent.entries, [5.85, 5.95])
+        self.assertEqual(tag, "TCA-3")
+        self.assertIsNone(cache.parent(-100, 2))
+
+        cache.put(-100, 2, Signal("BTC", [38500], [39000], 37300, 20))
+        cache.put(-100, 3, Signal("ETH", [2144], [2100], 2250, 20))
+        self.assertIsNone(cache.parent(-100, 1))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        cache.replace(-100, 3, Signal("ETH", [2144], [2100, 2000], 2250, 20))
+        self.assertEqual(cache.parent(-100, 3)[0].targets, [2100, 2000])
+
+    def test_spill(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "messages")
+            cache = MessageCache(maxsize=1, path=path, spill_size=2)
+            for k, coin in enumerate(("EOS", "BTC", "ETH", "XRP")):
+                cache.put(-100, k, Signal(coin, [1], [2], 0.5, 20, tag=f"TCA-{k}"))
+            self.assertIsNone(cache.parent(-100, 0))
+            self.assertEqual(cache.parent(-100, 1)[0].coin, "BTC")
+            cache.close()
+
+            cache = MessageCache(maxsize=1, path=path, spill_size=2)
+            sig, tag = cache.parent(-100, 3)
+            self.assertEqual(sig.to_dict(), Signal("XRP", [1], [2], 0.5, 20, tag="TCA-3").to_dict())
+            self.assertEqual(tag, "TCA-3")
+            self.assertIsNone(cache.parent(-100, 1))
+            cache.close()
@@ -0,0 +1,69 @@
+import asyncio
+import unittest
+
+from telethon.errors import FloodWaitError
+
+from .outbox import MAX_MESSAGE_LENGTH, Outbox
+
+
+class TestOutbox(unittest.TestCase):
+    def _run(self, outbox, count):
+        async def _main():
+            outbox.start()
+            while outbox.sent + outbox.failed < count:
+                await asyncio.sleep(0.01)
+            await outbox.stop()
+        asyncio.run(_main())
+
+    def test_digest(self):
+        sent = []
+
+        async def send(text):
+            sent.append(text)
+
+        outbox = Outbox(send, linger=0.01)
+        for k in range(3):
+            outbox.post(f"message {k}")
+        outbox.post("x" * MAX_MESSAGE_LENGTH)
+        self._run(outbox, 4)
+        self.assertEqual(sent, ["message 0\n\nmessage 1\n\nmessage 2", "x" * MAX_MESSAGE_LENGTH])
+        self.assertEqual(outbox.metrics()["digests"], 1)
+        self.assertEqual(outbox.metrics()["max_depth"], 4)
+
+    def test_flood_wait(self):
+        sent = []
+
+        async def send(text):
+            if not outbox.flood_waits:
+                raise FloodWaitError(request=None, capture=0)
+            sent.append(text)
+
+        outbox = Outbox(send, max_pending=2, linger=0)
+        for k in range(3):
+            outbox.post(f"message {k}")
+        self._run(outbox, 2)
+        self.assertEqual(sent, ["message 1\n\nmessage 2"])
+        self.assertEqual(outbox.metrics()["dropped"], 1)
+        self.assertEqual(outbox.metrics()["flood_waits"], 1)
+
+    def test_stop(self):
+        sent = []
+
+        async def send(text):
+            await asyncio.sleep(0.01)
+            sent.append(text)
+
+        async def _main():
+            outbox = Outbox(send, linger=0.01)
+            outbox.start()
+            outbox.post("entry")
+            await outbox.stop()  # sends what's pending first
+            self.assertEqual(sent, ["entry"])
+
+            stuck = Outbox(lambda text: asyncio.sleep(60), linger=0)
+            stuck.start()
+            stuck.post("entry")
+            await stuck.stop(timeout=0.05)
+            self.assertEqual(stuck.sent, 0)
+
+        asyncio.run(_main())
@@ -0,0 +1,88 @@
+import asyncio
+import time
+import unittest
+
+from .errors import PriceUnavailableException
+from .prices import PriceFeed, TradeRing
+
+
+class TestPriceFeed(unittest.TestCase):
+    def test_wait(self):
+        async def _main():
+            feed = PriceFeed()
+            loop = asyncio.get_event_loop()
+            loop.call_later(0.01, feed.update, "EOS", 5.9)
+            start = time.perf_counter()
+            prices = await asyncio.gather(feed.wait("EOS", 1), feed.wait("EOS", 1))
+            self.assertEqual(prices, [5.9, 5.9])
+            self.assertLess(time.perf_counter() - start, 0.5)
+            self.assertEqual(await feed.wait("EOS", 0), 5.9)
+            with self.assertRaises(PriceUnavailableException):
+                await feed.wait("BTC", 0.01)
+
+        asyncio.run(_main())
+
+    def test_table(self):
+        feed = PriceFeed(["BTC", "ETH"])
+        self.assertEqual(len(feed.values), 2)
+        self.assertIsNone(feed.get("BTC"))
+        feed.update("ETH", 2144.5, now=100)
+        feed.update("XRP", 0.5)
+        self.assertEqual((feed.get("ETH"), feed.times[feed.slots["ETH"]]), (2144.5, 100))
+        self.assertEqual(feed.pop("ETH"), 2144.5)
+        self.assertIsNone(feed.get("ETH"))
+        self.assertEqual((feed.get("XRP"), len(feed.values)), (0.5, 3))
+
+    def test_snapshot(self):
+        async def _main():
+            feed = PriceFeed()
+            calls = []
+
+            async def fetch():
+                calls.append(1)
+                await asyncio.sleep(0.01)
+                return [("BTC", 38500.0, time.time()), ("ETH", 2100.0, time.time() - 60)]
+
+            feed.update("ETH", 2144.0)
+            await asyncio.gather(*(feed.refresh(fetch) for _ in range(5)))
+            await feed.refresh(fetch)  # within the TTL
+            self.assertEqual(len(calls), 1)
+            self.assertEqual((feed.get("BTC"), feed.source("BTC")), (38500.0, "snapshot"))
+            self.assertEqual((feed.get("ETH"), feed.source("ETH")), (2144.0, "stream"))
+
+            feed.update("XRP", 0.5, now=time.time() - 60)
+            self.assertLess(feed.age("BTC"), 1)
+            self.assertIsNone(feed.get("XRP", max_age=30))
+            with self.assertRaises(PriceUnavailableException):
+                await feed.wait("XRP", 0.01, max_age=30)
+
+            # quiet coins: their last trade was long before the snapshot, the price is current
+            async def quiet():
+                return [("ADA", 1.2, time.time() - 120), ("XRP", 0.5, time.time() - 90)]
+
+            feed.refreshed = 0
+            await feed.refresh(quiet)
+            self.assertEqual((await feed.wait("ADA", 0.01, max_age=30), feed.source("ADA")), (1.2, "snapshot"))
+            self.assertEqual((await feed.wait("XRP", 0.01, max_age=30), feed.source("XRP")), (0.5, "stream"))
+
+        asyncio.run(_main())
+
+    def test_ring(self):
+        ring = TradeRing(size=4)
+        self.assertIsNone(ring.last())
+        for i in range(6):
+            ring.append(10.0 + i, 1.0, 99.5 + i, 100.0 + i)
+        self.assertEqual((len(ring), ring.last(), ring.age(now=106)), (4, 15.0, 1.0))
+        self.assertEqual(ring.latency(), 0.5)
+        self.assertEqual(ring.range(window=2, now=105), (13.0, 15.0))
+        self.assertEqual(ring.range(window=60, now=105), (12.0, 15.0))  # only 4 kept
+        self.assertIsNone(ring.range(window=1, now=200))
+
+        feed = PriceFeed()
+        feed.update("EOS", 5.9, now=100)
+        self.assertIsNone(feed.range("EOS"))  # not a trade
+        feed.update("EOS", 6.1, qty=10.0, at=time.time())
+        feed.update("EOS", 6.0, qty=5.0)
+        self.assertEqual((feed.range("EOS"), feed.get("EOS")), ((6.0, 6.1), 6.0))
+        feed.pop("EOS")
+        self.assertNotIn("EOS", feed.rings)
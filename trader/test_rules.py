@@ -0,0 +1,58 @@
+import unittest
+
+from .errors import ParseBudgetException
+from .rules import APPEND, BUDGET_STRIDE, FIRST, Budget, Pattern, Rule, RuleSet, Symbol, last, listing, number
+from .tokenizer import ParsedMessage
+
+
+class TestRuleSet(unittest.TestCase):
+    def _scan(self, rules, text):
+        return RuleSet(rules).scan(ParsedMessage.of(text).content)
+
+    def test_overlapping_keywords(self):
+        rules = (
+            Rule("lev", "a", number),
+            Rule("leverage", "b", number),
+            Rule("take-profit target", "c", number),
+            Rule("target ", "d", last),
+            Rule(Pattern(r"sto..loss"), "e", number),
+        )
+        f = self._scan(rules, """leverage 20x
+take-profit target 1) 2.5
+stop-loss 1.2""")
+        self.assertEqual((f["a"], f["b"], f["c"], f["d"], f["e"]), (20, 20, 1, 2.5, 1.2))
+
+    def test_symbol_and_modes(self):
+        rules = (
+            Rule(Symbol(None), "c", mode=FIRST),
+            Rule("tp", "t", last, mode=APPEND),
+            Rule("targets", "l", listing(1)),
+        )
+        f = self._scan(rules, """eth/usdt long
+btcusdt
+tp1 10
+tp2 11
+targets
+1) 12
+2) 13""")
+        self.assertEqual(f, {"c": "eth", "t": [10, 11], "l": [12, 13]})
+
+    def test_conditions(self):
+        rules = (
+            Rule(Symbol(), "c", when="⚡"),
+            Rule(Symbol(None), "c", unless="⚡"),
+            Rule("buy", "er", mode=FIRST, orelse=Rule("buy", "t")),
+        )
+        self.assertEqual(self._scan(rules, "⚡ #link/usdt\nbuy 1\nbuy 2"), {"c": "link", "er": [1], "t": [2]})
+        self.assertEqual(self._scan(rules, "link/usdt"), {"c": "link"})
+
+    def test_budget_stride(self):
+        rules = RuleSet((Rule("buy", "er"),))
+        budget = Budget(1, 10, 1000)
+        self.assertEqual(rules.scan(["buy 1"] * 3, budget), {"er": [1]})
+        self.assertEqual(budget.steps, 4)  # charged once, at the end
+
+        budget = Budget(1, 10, 1000)
+        with self.assertRaises(ParseBudgetException):
+            rules.scan(["chatter"] * (3 * BUDGET_STRIDE), budget)
+        self.assertEqual(budget.steps, 10 - BUDGET_STRIDE)  # stopped at the first check
@@ -0,0 +1,103 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from . import shard
+from .config import ConfigStore
+from .shard import FRAME, RemoteTrader, TradeServer, owner
+from .signal import RESULTS_CHANNEL, Signal
+
+
+class FakeTrader:
+    def __init__(self):
+        self.calls = []
+        self.count = 0
+
+    async def queue_signal(self, signal):
+        signal.tag = f"{signal.tag}-{self.count}"
+        self.count += 1
+        self.calls.append(("signal", signal.coin))
+
+    async def close_trades(self, tag, coin=None):
+        self.calls.append(("close", tag, coin))
+
+    async def update_trade(self, tag, sl=None, targets=None):
+        await asyncio.sleep(sl)  # stands in for a wait on the orders lock
+        self.calls.append(("update", tag, sl))
+
+
+class TestShard(unittest.TestCase):
+    def test_owner(self):
+        self.assertEqual(owner(RESULTS_CHANNEL, 3), 0)
+        self.assertEqual({owner(c, 3) for c in range(-1001000000000, -1000999999990)}, {0, 1, 2})
+
+    def test_remote(self):
+        async def _main(path):
+            trader = FakeTrader()
+            config = ConfigStore({"config": {"rf": 2}})
+            server = TradeServer(trader, config, path)
+            await server.start()
+
+            remote = RemoteTrader(path)
+            await remote.init(state={})
+            for _ in range(2):  # second one is a duplicate from another shard
+                sig = Signal("EOS", [5.85], [6], 5.6, 75, tag="TCA")
+                await remote.queue_signal(sig, origin=(-100, 7, 0))
+                self.assertEqual(sig.tag, "TCA-0")
+            await remote.close_trades("TCA", "EOS", origin=(-100, 8, 0))
+            await remote.close_trades("TCA", "EOS", origin=(-100, 9, 0))  # same content, new message
+            await remote.close_trades("TCA", "EOS", origin=(-100, 9, 0))
+            self.assertEqual(trader.calls, [("signal", "EOS"), ("close", "TCA", "EOS"), ("close", "TCA", "EOS")])
+            self.assertEqual(server.duplicates, 2)
+
+            self.assertEqual(remote.config.current.rf, 2)
+            config.update(rr=1.5)
+            for _ in range(10):
+                await asyncio.sleep(0.01)
+            self.assertEqual(remote.config.current.rr, 1.5)
+            await server.stop()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(_main(os.path.join(tmp, "trader.sock")))
+
+    def test_concurrent(self):
+        async def _main(path):
+            trader = FakeTrader()
+            server = TradeServer(trader, ConfigStore({}), path)
+            await server.start()
+            remote = RemoteTrader(path)
+            await remote.init(state={})
+            # the slow request is answered last, the one behind it doesn't wait for it
+            await asyncio.gather(remote.update_trade("TCA-0", sl=0.2, origin=(-100, 7, 0)),
+                                 remote.update_trade("TCA-0", sl=0.2, origin=(-100, 7, 0)),
+                                 remote.close_trades("TCA", "EOS", origin=(-100, 8, 0)))
+            self.assertEqual(trader.calls, [("close", "TCA", "EOS"), ("update", "TCA-0", 0.2)])
+            self.assertEqual(server.duplicates, 1)
+            await server.stop()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(_main(os.path.join(tmp, "trader.sock")))
+
+    def test_reconnect(self):
+        async def _main(path):
+            trader = FakeTrader()
+            server = TradeServer(trader, ConfigStore({}), path)
+            await server.start()
+            remote = RemoteTrader(path)
+            await remote.init(state={})
+            while not server.writers:
+                await asyncio.sleep(0.01)
+            broken = list(server.writers)
+            for writer in broken:
+                writer.write(FRAME.pack(3) + b"{x}")  # not JSON
+            for _ in range(20):
+                await asyncio.sleep(0.01)
+            await remote.close_trades("TCA", "EOS", origin=(-100, 8, 0))
+            self.assertEqual(trader.calls, [("close", "TCA", "EOS")])
+            self.assertTrue(server.writers and server.writers.isdisjoint(broken))  # on a new connection
+            await server.stop()
+
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(shard, "RECONNECT_SLEEP", 0.01):
+            asyncio.run(_main(os.path.join(tmp, "trader.sock")))
@@ -1,9 +1,12 @@
+import math
 import unittest
 
-from .errors import CloseTradeException, MoveStopLossException, ModifyTargetsException
+from .errors import CloseTradeException, MoveStopLossException, ModifyTargetsException, ParseBudgetException
 from .signal import (AS, BAW, BFP, BFP2, BK, BPS, BVIP, C, CC, CCC, CCS, CEP, CY, E, EBS, FWP,
                      FXVIP, HBTCV, JMP, JPC, KBV, KCE, KSP, KVIP, LVIP, MCVIP, MVIP, PBF, PHVIP, PVIP, RM, RWS, SLVIP,
-                     SPP, SS, TCA, TVIPAW, VIPBB, VIPBS, VIPCC, VIPCS, W, YCP, RESULTS, Signal)
+                     SPP, SS, TCA, TVIPAW, VIPBB, VIPBS, VIPCC, VIPCS, W, YCP, RESULTS, BUDGET_VIOLATIONS, ParseCache, Signal, prefilter_stats, router, snap)
+from .rules import Budget
+from .tokenizer import ParsedMessage
 
 
 class TestSignal(unittest.TestCase):
@@ -78,6 +81,19 @@ t 5.3""", Signal("1INCH", [2.5], [5.3]))
         self._assert_signal(RESULTS, "long chr 0.25 sl 0.23 tp 0.27 0.29",
                             Signal("CHR", [0.25], [0.27, 0.29], 0.23, is_long=True))
 
+    def test_replies(self):
+        # no tag, they're about the trade of the message replied to
+        with self.assertRaises(MoveStopLossException) as ctx:
+            RESULTS.parse("change sl 25.45")
+        self.assertEqual((ctx.exception.tag, ctx.exception.price), (None, 25.45))
+        with self.assertRaises(ModifyTargetsException) as ctx:
+            RESULTS.parse("change tp 25 30")
+        self.assertEqual((ctx.exception.tag, ctx.exception.targets), (None, [25, 30]))
+        for text in ("close", "cancel"):
+            with self.assertRaises(CloseTradeException) as ctx:
+                RESULTS.parse(text)
+            self.assertIsNone(ctx.exception.tag)
+
 
 class TestBFP(TestSignal):
     def test_1(self):
@@ -2002,3 +2018,198 @@ class TestKVIP(TestSignal):
 ✅ Capital %: 3
 
 by @CRR""", Signal("ETH", [2144, 2190], [2100, 2060, 2000, 1950, 1850], 2250))
+
+
+class TestPrefilter(unittest.TestCase):
+    def test_chatter(self):
+        chat_id = -1001239897393  # TCA
+        dropped = prefilter_stats()["TCA"]["dropped"]
+        self.assertIsNone(Signal.parse(chat_id, "Great profits today guys, more coming soon!"))
+        self.assertIsNone(Signal.parse(chat_id, "EOS/USDT leverage 20x"))
+        self.assertEqual(prefilter_stats()["TCA"]["dropped"], dropped + 2)
+
+        self.assertRaises(CloseTradeException, Signal.parse, chat_id, "Closing all positions")
+        sig = Signal.parse(chat_id, """Asset: EOS/USDT
+Position: #LONG
+Entry: 5.850 - 5.950
+Targets: 6.000 - 6.100 - 6.300 - 6.500
+Stop loss: 5.600
+Leverage: 75x""")
+        self.assertEqual(sig.coin, "EOS")
+
+    def test_fallbacks(self):
+        # FXVIP has no "binance future" keyword but delegates to PBF which needs it
+        self.assertTrue(FXVIP.prefilter().matches(ParsedMessage("binance futures\n#eth/usdt\nentry 1 2\ntarget 3")))
+        self.assertFalse(PBF.prefilter().matches(ParsedMessage("#eth/usdt leverage 20x")))
+        self.assertTrue(RESULTS.prefilter().matches(ParsedMessage("cancel my_tag")))
+
+
+class TestRouter(unittest.TestCase):
+    def test_routed(self):
+        text = """Asset: EOS/USDT
+Position: #LONG
+Entry: 5.850 - 5.950
+Targets: 6.000 - 6.100 - 6.300 - 6.500
+Stop loss: 5.600
+Leverage: 75x"""
+        self.assertIsNone(Signal.parse(-1001, text))
+
+        sig = Signal.parse(-1001, text, routed=(-1001,))
+        self.assertEqual((sig.coin, sig.entries, sig.targets, sig.sl), ("EOS", [5.85, 5.95], [6, 6.1, 6.3, 6.5], 5.6))
+        self.assertTrue(sig.tag.endswith("@1001"))
+        self.assertGreater(router().routed[sig.tag.split("@")[0]], 0)
+
+        unrouted = router().routed[None]
+        self.assertIsNone(Signal.parse(-1001, "Great profits today guys, more coming soon!", routed=(-1001,)))
+        self.assertIsNone(Signal.parse(-1001, "Closing all positions", routed=(-1001,)))
+        self.assertEqual(router().routed[None], unrouted + 2)
+
+    def test_corpus(self):
+        # Every signal of the test suite sent from an unregistered chat: a routed signal must
+        # match what the channel's own parser makes of it, anything else is a wrong order
+        from . import signal
+        from .bench import load_corpus
+
+        fields = ("coin", "entries", "targets", "sl")
+        total, wrong, unrouted = 0, [], 0
+        for name, text in load_corpus():
+            if name == "RESULTS":
+                continue
+            try:
+                expected = getattr(signal, name).parse(text)
+            except Exception:
+                continue
+            if not isinstance(expected, Signal) or expected.is_partial:
+                continue
+            total += 1
+            sig = Signal.parse(-1001, text, routed=(-1001,))
+            if sig is None:
+                unrouted += 1
+            elif expected.diff(sig).keys() & set(fields):
+                wrong.append((name, sig.tag, text))
+        self.assertGreater(total, 100)
+        self.assertEqual(wrong, [])
+        self.assertLess(unrouted / total, 0.1)
+
+
+class TestParseCache(unittest.TestCase):
+    TEXT = """Asset: EOS/USDT
+Position: #LONG
+Entry: 5.850 - 5.950
+Targets: 6.000 - 6.100 - 6.300 - 6.500
+Stop loss: 5.600
+Leverage: 75x"""
+
+    def test_hits(self):
+        now = [0]
+        cache = ParseCache(maxsize=10, ttl=60, timer=lambda: now[0])
+        sig = cache.parse(TCA, ParsedMessage(self.TEXT))
+        sig.correct(5.9)
+        again = cache.parse(TCA, ParsedMessage(self.TEXT.upper()))
+        self.assertIsNot(again, sig)
+        self.assertEqual(again.entries, [5.85, 5.95])
+        self.assertEqual(again.sl, 5.6)
+
+        self.assertRaises(AssertionError, cache.parse, TCA, ParsedMessage("eos/usdt leverage 20x"))
+        self.assertRaises(AssertionError, cache.parse, TCA, ParsedMessage("eos/usdt leverage 20x"))
+        self.assertEqual(cache.stats(), {"size": 2, "hits": 2, "misses": 2, "hit_rate": 0.5})
+
+        now[0] = 61
+        cache.parse(TCA, ParsedMessage(self.TEXT))
+        self.assertEqual(cache.stats()["misses"], 3)
+
+
+class TestBudget(unittest.TestCase):
+    def test_limits(self):
+        chat_id = -1001239897393  # TCA
+        violations = BUDGET_VIOLATIONS[("TCA", "length")]
+        with self.assertRaises(ParseBudgetException) as ctx:
+            Signal.parse(chat_id, "leverage 20x " * 1000)
+        self.assertEqual(ctx.exception.reason, "length")
+        self.assertEqual(BUDGET_VIOLATIONS[("TCA", "length")], violations + 1)
+
+        with self.assertRaises(ParseBudgetException) as ctx:
+            Signal.parse(chat_id, "leverage 20x eos/usdt" + "\n1" * 300)
+        self.assertEqual(ctx.exception.reason, "lines")
+
+    def test_steps(self):
+        msg = ParsedMessage(TestParseCache.TEXT)
+        msg.budget = Budget(1, 5, 100)
+        with self.assertRaises(ParseBudgetException) as ctx:
+            TCA.parse(msg)
+        self.assertEqual(ctx.exception.reason, "steps")
+
+        # fallbacks don't swallow it
+        msg = ParsedMessage("binance futures\n" * 10 + TestParseCache.TEXT)
+        msg.budget = Budget(1, 5, 100)
+        self.assertRaises(ParseBudgetException, RWS.parse, msg)
+
+
+class TestSignalRecord(unittest.TestCase):
+    def test_roundtrip(self):
+        sig = Signal("eth", [1830, 1740], [1850, 1870, 1920], 1650, 75, tag="TCA")
+        partial = Signal("akro", is_long=False, sl=0.05)
+        corrected = sig.copy()
+        corrected.correct(1.8)
+        for s in (sig, partial, corrected):
+            for restored in (Signal.from_dict(s.to_dict()), Signal.from_bytes(s.to_bytes())):
+                self.assertEqual(restored.to_dict(), s.to_dict())
+                self.assertEqual(type(restored.leverage), type(s.leverage))
+        self.assertEqual(sig.entries, [1740, 1830])
+        self.assertEqual(corrected.entries, [1.74, 1.83])
+        self.assertIsNone(Signal.from_bytes(partial.to_bytes()).tag)
+        self.assertFalse(Signal.from_bytes(partial.to_bytes()).is_long)
+
+    def test_slots(self):
+        sig = Signal("eth", [1830], [1850], 1650)
+        with self.assertRaises(AttributeError):
+            sig.extra = 1
+        sig.targets = [1860, 1900]
+        self.assertEqual(repr(sig.targets), "[1860.0, 1900.0]")
+
+    def test_diff(self):
+        sig = Signal("eth", [1830, 1740], [1850, 1870, 1920], 1650, 75, tag="TCA")
+        self.assertEqual(sig.diff(sig.copy()), {})
+        edited = Signal("eth", [1740, 1830], [1850, 1880, 1920], 1600, 75)
+        self.assertEqual(sig.diff(edited), {"targets": [1850, 1880, 1920], "sl": 1600})
+
+
+class TestCorrect(unittest.TestCase):
+    def test_factor(self):
+        sig = Signal("scale", [1830], [1850], 1650)
+        Signal.SCALES.pop("SCALE", None)
+        self.assertEqual(sig.factor(1830, 1.8), 0.001)
+        self.assertEqual(Signal.SCALES["SCALE"], 3)
+        self.assertEqual(sig.factor(18.3, 0.0183), 0.001)
+        self.assertEqual(sig.factor(1830, 1830), 1)
+        self.assertAlmostEqual(sig.factor(1, 10 ** 9), 10 ** 5)  # clamped to the largest scale
+
+    def test_ticks(self):
+        sig = Signal("eth", [2475, 2431], [2500, 2555.55], 2399.99)
+        sig.correct(2.45, tick=0.05)
+        self.assertEqual(sig.entries, [2.45, 2.5])
+        # away from the entry, the first one was on it
+        self.assertEqual(sig.targets, [2.55, 2.6])
+        self.assertTrue(all(t > sig.entry for t in sig.targets))
+        self.assertEqual(sig.sl, 2.35)
+
+        sig = Signal("eth", [1000], [990], 1000.01)
+        sig.correct(1000, tick=0.1)
+        self.assertEqual((sig.entry, sig.sl), (1000, 1000.1))
+
+        sig = Signal("eth", [2.5], [2.5, 2.42, 2.3], 2.6, is_long=False)
+        sig.correct(2.5, tick=0.05)
+        self.assertEqual(sig.targets, [2.45, 2.4, 2.3])
+        self.assertTrue(all(t < sig.entry for t in sig.targets))
+
+    def test_snap(self):
+        self.assertEqual(snap(0.3, 0.1), 0.3)
+        self.assertEqual(snap(1.2345, 0.05), 1.25)
+        self.assertEqual(snap(0.39, 0.1, math.floor), 0.3)
+        self.assertEqual(snap(0.31, 0.1, math.ceil), 0.4)
+        self.assertEqual(snap(0.75, 0.25), 0.75)
+        self.assertEqual(snap(0.0075, 0.0025), 0.0075)
+        self.assertEqual(snap(0.0081, 0.0025, math.floor), 0.0075)
+        self.assertEqual(snap(12.3, 0.00001), 12.3)
+        self.assertEqual(snap(2.425, 0.05), 2.45)  # halves go up, not to the even tick
+        self.assertEqual(snap(0.25, 0.1), 0.3)
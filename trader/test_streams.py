@@ -0,0 +1,123 @@
+import asyncio
+import json
+import unittest
+
+import websockets
+
+from .prices import PriceFeed
+from .streams import BOOK_TICKER, MARK_PRICE, PriceStream, StreamConnection, StreamManager
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.frames = []
+
+    async def send(self, frame):
+        self.frames.append(frame)
+
+
+class ClosedWebSocket:
+    async def send(self, frame):
+        raise websockets.ConnectionClosed(1006, "")
+
+
+class FakeManager(StreamManager):
+    def _connection(self):
+        conn = StreamConnection(self.url, self.handler)
+        conn.ws = FakeWebSocket()
+        conn.start = lambda: None
+        return conn
+
+
+class TestStreamManager(unittest.TestCase):
+    def test_refcounts(self):
+        async def _main():
+            manager = FakeManager(None, max_streams=2)
+            for stream in ("a", "a", "b", "c"):
+                await manager.subscribe(stream)
+            self.assertEqual(len(manager.connections), 2)
+            first, second = manager.connections
+            self.assertEqual((first.streams, second.streams), ({"a", "b"}, {"c"}))
+            self.assertEqual(len(first.ws.frames), 2)
+
+            await manager.unsubscribe("a")
+            self.assertEqual(len(first.ws.frames), 2)  # still used once
+            await manager.unsubscribe("a")
+            self.assertIn('"UNSUBSCRIBE"', first.ws.frames[-1])
+            await manager.subscribe("d")  # takes the free room on the first connection
+            self.assertEqual(first.streams, {"b", "d"})
+
+        asyncio.run(_main())
+
+    def test_reset(self):
+        async def _main():
+            manager = FakeManager(None)
+            await manager.reset({"a": 2, "b": 1})
+            conn = manager.connections[0]
+            frames = len(conn.ws.frames)
+            await manager.reset({"a": 1, "b": 1})
+            self.assertEqual(len(conn.ws.frames), frames)
+            await manager.reset({"b": 1, "c": 1})
+            self.assertEqual(conn.streams, {"b", "c"})
+            self.assertEqual(dict(manager.refs), {"b": 1, "c": 1})
+            self.assertEqual(len(conn.ws.frames), frames + 2)
+
+        asyncio.run(_main())
+
+    def test_batches(self):
+        async def _main():
+            manager = FakeManager(None, max_streams=3)
+            await manager.reset({stream: 1 for stream in "abcde"})
+            first, second = manager.connections
+            self.assertEqual([json.loads(f)["params"] for f in first.ws.frames], [["a", "b", "c"]])
+            self.assertEqual([json.loads(f)["params"] for f in second.ws.frames], [["d", "e"]])
+
+            await manager.reset({stream: 1 for stream in "cdefg"})
+            self.assertEqual([(f["method"], f["params"]) for f in map(json.loads, first.ws.frames[1:])],
+                             [("UNSUBSCRIBE", ["a", "b"]), ("SUBSCRIBE", ["f", "g"])])
+            self.assertEqual(len(second.ws.frames), 1)
+            self.assertEqual(len(manager.connections), 2)
+
+        asyncio.run(_main())
+
+    def test_closed(self):
+        async def _main():
+            manager = FakeManager(None)
+            await manager.subscribe("a")
+            conn = manager.connections[0]
+            conn.ws = ClosedWebSocket()
+            await manager.subscribe("b")  # doesn't raise, subscribed again on reconnect
+            self.assertEqual(conn.streams, {"a", "b"})
+
+        asyncio.run(_main())
+
+
+class TestPriceStream(unittest.TestCase):
+    def test_conflate(self):
+        async def _main():
+            feed = PriceFeed()
+            stream = PriceStream(feed)
+            name = stream.stream("eos")
+            self.assertEqual(name, "eosusdt@aggTrade")
+            for price in ("5.9", "6.0", "6.1"):
+                stream(name, {"p": price, "q": "10", "T": 1620000000000})
+            stream("btcusdt@aggTrade", {"p": "38500", "q": "1", "T": 1620000000000})  # not named
+            self.assertIsNone(feed.get("EOS"))
+            await asyncio.sleep(0)
+            self.assertEqual((feed.get("EOS"), stream.received, stream.applied), (6.1, 4, 1))
+            ring = feed.rings["EOS"]
+            self.assertEqual(len(ring), 3)  # every trade, only the last price is published
+            self.assertEqual(ring.range(), (5.9, 6.1))
+
+        asyncio.run(_main())
+
+    def test_sources(self):
+        feed = PriceFeed()
+        book = PriceStream(feed, BOOK_TICKER, conflate=False)
+        book(book.stream("EOS"), {"b": "5.9", "a": "6.1", "T": 1620000000000})
+        mark = PriceStream(feed, MARK_PRICE, conflate=False)
+        self.assertEqual(mark.stream("BTC"), "btcusdt@markPrice@1s")
+        mark("btcusdt@markPrice@1s", {"p": "38500.5", "E": 1620000000000})
+        mark("btcusdt@markPrice@1s", {"E": 1620000000000})  # logged and skipped
+        self.assertEqual((feed.get("EOS"), feed.get("BTC")), (6.0, 38500.5))
+        self.assertEqual((feed.rings, mark.applied), ({}, 1))
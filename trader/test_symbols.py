@@ -0,0 +1,72 @@
+import math
+import os
+import tempfile
+import unittest
+
+from .errors import InvalidOrderException
+from .symbols import SymbolSpec, SymbolTable, decimals, load_exchange_info, save_exchange_info
+
+INFO = {
+    "symbol": "BTCUSDT",
+    "pricePrecision": 2,
+    "quantityPrecision": 3,
+    "filters": [
+        {"filterType": "PRICE_FILTER", "minPrice": "556.72", "maxPrice": "4529764", "tickSize": "0.10"},
+        {"filterType": "LOT_SIZE", "stepSize": "0.001", "maxQty": "1000", "minQty": "0.001"},
+        {"filterType": "MARKET_LOT_SIZE", "stepSize": "0.001", "maxQty": "300", "minQty": "0.001"},
+        {"filterType": "MIN_NOTIONAL", "notional": "5"},
+    ],
+}
+
+
+class TestSymbolSpec(unittest.TestCase):
+    def test_from_info(self):
+        self.assertEqual((decimals("0.00100000"), decimals("1"), decimals("10.0")), (3, 0, 0))
+        spec = SymbolSpec.from_info(INFO)
+        self.assertEqual(spec, SymbolSpec("BTCUSDT", 0.1, 0.001, 0.001, 1000.0, 5.0, 1, 3))
+        self.assertFalse(SymbolSpec.from_info(dict(INFO, status="SETTLING")).trading)
+
+    def test_snap(self):
+        spec = SymbolSpec.from_info(INFO)
+        self.assertEqual(spec.price(38512.37), 38512.4)
+        self.assertEqual(spec.price(0.3, math.floor), 0.3)
+        self.assertEqual(spec.price(38512.37, math.floor), 38512.3)
+        self.assertEqual(spec.qty(0.0126), 0.013)
+        self.assertEqual(spec.qty(0.0126, math.floor), 0.012)
+        self.assertEqual(SymbolSpec("XUSDT").price(1.123456789), 1.12345679)
+        quarter = SymbolSpec.from_info({"symbol": "XUSDT",
+                                        "filters": [{"filterType": "PRICE_FILTER", "tickSize": "0.25"}]})
+        self.assertEqual(quarter.price(0.75), 0.75)
+
+    def test_validate(self):
+        spec = SymbolSpec.from_info(INFO)
+        spec.validate(0.013, 38512.4)
+        spec.validate(0.013, 38512.37, market=True)
+        spec.validate(0.001, 1000.0, reduce=True)  # notional doesn't apply
+        for qty, price in ((0.0126, 38512.4), (0.013, 38512.37), (0.0, 38512.4), (2000.0, 38512.4),
+                           (0.001, 1000.0)):
+            with self.assertRaises(InvalidOrderException):
+                spec.validate(qty, price)
+
+    def test_table(self):
+        table = SymbolTable()
+        eth = dict(INFO, symbol="ETHUSDT")
+        self.assertEqual(table.sync([INFO, eth]), (["BTCUSDT", "ETHUSDT"], [], []))
+        spec = table["ETHUSDT"]
+        moved = dict(INFO, filters=[{"filterType": "PRICE_FILTER", "tickSize": "0.01"}] + INFO["filters"][1:])
+        self.assertEqual(table.sync([moved, eth, dict(INFO, symbol="XRPUSDT")]),
+                         (["XRPUSDT"], ["BTCUSDT"], []))
+        self.assertIs(table["ETHUSDT"], spec)  # not rebuilt
+        self.assertEqual(table["BTCUSDT"].tick, 0.01)
+        self.assertEqual(table.sync([eth]), ([], [], ["BTCUSDT", "XRPUSDT"]))
+        self.assertEqual(list(table), ["ETHUSDT"])
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "exchange_info.json")
+            self.assertIsNone(load_exchange_info(path))
+            save_exchange_info(path, [INFO], fetched=100)
+            self.assertEqual(load_exchange_info(path), ([INFO], 100))
+            with open(path, "w") as fd:
+                fd.write("{")
+            self.assertIsNone(load_exchange_info(path))
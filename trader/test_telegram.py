@@ -0,0 +1,149 @@
+import asyncio
+import datetime
+import time
+import unittest
+
+from telethon import types
+from telethon.extensions import markdown
+
+from .signal import RESULTS_CHANNEL
+from .telegram import MAX_SIGNAL_AGE, STALE_SIGNAL_AGE, TeleTrader, Update
+
+
+class TestUpdate(unittest.TestCase):
+    def test_text(self):
+        message = types.Message(
+            id=7, peer_id=types.PeerChannel(1), date=datetime.datetime(2021, 5, 1), message="EOS/USDT LONG",
+            entities=[types.MessageEntityBold(offset=0, length=8)])
+        self.assertEqual(Update(-1001, message, markdown).text, "**EOS/USDT** LONG")  # as event.text had it
+        self.assertEqual(Update(-1001, message).text, "EOS/USDT LONG")
+        self.assertEqual(Update(-1001, message).origin, (-1001, 7, 0))
+
+
+TCA_CHAT = -1001437351757
+TCA_SIGNAL = """Asset: EOS/USDT
+Position: #LONG
+Entry: 5.850 - 5.950
+Targets: 6.000 - 6.100 - 6.300 - 6.500
+Stop loss: 5.600
+Leverage: 75x"""
+
+
+class FakeTrader:
+    def __init__(self):
+        self.calls = []
+
+    async def queue_signal(self, signal, origin=None):
+        signal.tag = f"{signal.tag or signal.coin.lower()}-{len(self.calls)}"  # as FuturesTrader tags them
+        self.calls.append(("signal", signal.coin))
+
+    async def close_trades(self, tag, coin=None, origin=None):
+        self.calls.append(("close", tag, coin))
+
+    async def update_trade(self, tag, sl=None, targets=None, origin=None):
+        self.calls.append(("update", tag, sl, targets))
+
+    async def amend_trade(self, tag, sig, fields, origin=None):
+        self.calls.append(("amend", tag, tuple(fields)))
+
+
+class FakeClient(TeleTrader):
+    # Nothing is sent anywhere: fetched history comes from `history`, fetches are recorded
+    def __init__(self, state):
+        super().__init__(1, "hash", state=state, trader=FakeTrader())
+        self.history = []
+        self.fetches = []
+
+    async def iter_messages(self, entity, min_id=0, max_id=0, limit=None):
+        self.fetches.append((min_id, max_id))
+        for message in sorted(self.history, key=lambda m: -m.id):
+            if message.id > min_id and (not max_id or message.id < max_id):
+                yield message
+
+
+def message(id, text, age=0, chat_id=TCA_CHAT, service=False, reply_to=None):
+    date = datetime.datetime.fromtimestamp(time.time() - age, datetime.timezone.utc)
+    peer = types.PeerChannel(int(str(chat_id)[4:]))
+    if service:
+        return types.MessageService(id=id, peer_id=peer, date=date, action=types.MessageActionPinMessage())
+    reply = types.MessageReplyHeader(reply_to_msg_id=reply_to) if reply_to is not None else None
+    return types.Message(id=id, peer_id=peer, date=date, message=text, reply_to=reply)
+
+
+class TestTeleTrader(unittest.TestCase):
+    def _run(self, main):
+        async def _main():
+            client = FakeClient({"last_seen": {str(TCA_CHAT): 10}})
+            await main(client)
+            for _ in range(5):  # background catch-ups
+                await asyncio.sleep(0)
+        asyncio.run(_main())
+
+    def test_pin(self):
+        async def _main(client):
+            await client._raw_handler(types.UpdateNewChannelMessage(message(11, None, service=True), 0, 0))
+            await client._raw_handler(types.UpdateNewChannelMessage(message(12, TCA_SIGNAL), 0, 0))
+            await asyncio.sleep(0)
+            self.assertEqual(client.fetches, [])
+            self.assertEqual(client.trader.calls, [("signal", "EOS")])
+            self.assertEqual(client.state["last_seen"][str(TCA_CHAT)], 12)
+        self._run(_main)
+
+    def test_gap(self):
+        async def _main(client):
+            client.history = [message(11, TCA_SIGNAL.replace("EOS", "ADA"), age=60)]
+            await client._raw_handler(types.UpdateNewChannelMessage(message(12, TCA_SIGNAL), 0, 0))
+            self.assertEqual(client.trader.calls, [("signal", "EOS")])  # the live message goes first
+            for _ in range(5):
+                await asyncio.sleep(0)
+            self.assertEqual(client.fetches, [(10, 12)])
+            self.assertEqual(client.trader.calls, [("signal", "EOS"), ("signal", "ADA")])
+            self.assertEqual(client.state["last_seen"][str(TCA_CHAT)], 12)
+        self._run(_main)
+
+    def test_old(self):
+        async def _main(client):
+            client.history = [message(11, TCA_SIGNAL.replace("EOS", "ADA"), age=MAX_SIGNAL_AGE + 60),
+                              message(12, "Closing ada at entry", age=MAX_SIGNAL_AGE + 30)]
+            live = message(13, TCA_SIGNAL, age=STALE_SIGNAL_AGE + 5)  # still traded, with a limit order
+            await client._raw_handler(types.UpdateNewChannelMessage(live, 0, 0))
+            for _ in range(5):
+                await asyncio.sleep(0)
+            self.assertEqual(client.fetches, [(10, 13)])
+            self.assertEqual(client.trader.calls, [("signal", "EOS")])
+            self.assertEqual(client.caught_up, 2)
+        self._run(_main)
+
+    def test_edit(self):
+        async def _main(client):
+            await client._raw_handler(types.UpdateNewChannelMessage(message(11, TCA_SIGNAL), 0, 0))
+            edit = message(11, TCA_SIGNAL.replace("5.850", "5.800").replace("5.600", "5.500"))
+            edit.edit_date = edit.date
+            await client._raw_handler(types.UpdateEditChannelMessage(edit, 0, 0))
+            self.assertEqual(client.trader.calls, [("signal", "EOS"), ("amend", "TCA-0", ("sl",))])
+            # the entry change wasn't applied, the next edit is compared against the old entries
+            sig, tag = client.messages.parent(TCA_CHAT, 11)
+            self.assertEqual((sig.entries, sig.sl, tag), ([5.85, 5.95], 5.5, "TCA-0"))
+        self._run(_main)
+
+    def test_replies(self):
+        async def _main(client):
+            async def post(id, text, chat_id=TCA_CHAT, reply_to=None):
+                await client._raw_handler(types.UpdateNewChannelMessage(
+                    message(id, text, chat_id=chat_id, reply_to=reply_to), 0, 0))
+
+            await post(11, TCA_SIGNAL)
+            await post(12, TCA_SIGNAL.replace("EOS", "ADA"))
+            await post(13, "Closing eos at entry", reply_to=11)  # the trade of the message replied to
+            await post(14, "Closing ada at entry")
+            await post(1, "long akro 0.05 sl 0.045 tp 0.055", chat_id=RESULTS_CHANNEL)
+            await post(2, "change sl 0.048", chat_id=RESULTS_CHANNEL, reply_to=1)
+            await post(3, "change tp 0.06 0.07", chat_id=RESULTS_CHANNEL, reply_to=1)
+            await post(4, "change tca-1 sl 1.1", chat_id=RESULTS_CHANNEL, reply_to=1)  # named, the reply is moot
+            await post(5, "close", chat_id=RESULTS_CHANNEL, reply_to=1)
+            await post(6, "change sl 0.048", chat_id=RESULTS_CHANNEL)  # neither named nor a reply
+            self.assertEqual(client.trader.calls, [
+                ("signal", "EOS"), ("signal", "ADA"), ("close", "TCA-0", "EOS"), ("close", "TCA", "ADA"),
+                ("signal", "AKRO"), ("update", "akro-4", 0.048, None), ("update", "akro-4", None, [0.06, 0.07]),
+                ("update", "tca-1", 1.1, None), ("close", "akro-4", "AKRO")])
+        self._run(_main)
@@ -0,0 +1,29 @@
+import unittest
+
+from .tokenizer import ParsedMessage, extract_numbers, extract_optional_number, extract_symbol, symbol_pattern
+
+
+class TestParsedMessage(unittest.TestCase):
+    def test_lines(self):
+        msg = ParsedMessage.of("""  #ETH/USDT Long
+
+Entry 2,475 - 2425
+""")
+        self.assertEqual(msg.lines, ["#eth/usdt long", "", "entry 2,475 - 2425", ""])
+        self.assertEqual(msg.content, ["#eth/usdt long", "entry 2,475 - 2425"])
+        self.assertIs(ParsedMessage.of(msg), msg)
+        self.assertTrue("entry" in msg)
+        self.assertFalse("stop" in msg)
+
+    def test_lines_are_plain(self):
+        msg = ParsedMessage.of("buy 1inch 1.5 - 1.7")
+        self.assertIs(type(msg.lines[0]), str)
+        self.assertEqual(extract_numbers(msg.lines[0]), [1, 1.5, 1.7])
+        self.assertEqual(extract_numbers(msg.lines[0], "1inch"), [1.5, 1.7])
+        self.assertEqual(extract_optional_number(msg.lines[0]), 1)
+
+    def test_symbol(self):
+        line = ParsedMessage.of("#LINK / USDT").lines[0]
+        self.assertEqual(extract_symbol(line)[1], "link")
+        self.assertIsNone(extract_symbol(line, prefix=r"\$"))
+        self.assertIs(symbol_pattern(None, "usdt"), symbol_pattern(None, "usdt"))
@@ -0,0 +1,136 @@
+import asyncio
+import time
+import unittest
+
+from . import FuturesTrader, OrderID
+from .signal import Signal
+
+
+class FakeClient:
+    # Records the orders placed and cancelled, all of them succeed
+    def __init__(self):
+        self.created = []
+        self.cancelled = []
+
+    async def futures_create_order(self, **params):
+        self.created.append(params)
+        return {"orderId": len(self.created), "origQty": params["quantity"]}
+
+    async def futures_cancel_order(self, symbol, origClientOrderId):
+        self.cancelled.append(origClientOrderId)
+        return {}
+
+    async def futures_symbol_ticker(self):
+        # EOS last traded two minutes ago
+        return [{"symbol": "EOSUSDT", "price": "5.9", "time": int((time.time() - 120) * 1000)},
+                {"symbol": "BTCUSD_PERP", "price": "38500", "time": int(time.time() * 1000)}]
+
+
+def trader(filled=False):
+    # an EOS long tagged TCA-0 with 4 TPs, of which the first is hit when `filled`
+    res = FuturesTrader()
+    res.client = FakeClient()
+    res.results_handler = lambda text: None
+    parent = OrderID.wait()
+    t_ord = [OrderID.target() for _ in range(4)]
+    res.state = {"orders": {
+        parent: {"id": 1, "qty": 100.0, "sym": "EOSUSDT", "side": "BUY", "ent": 5.9, "sl": 5.6,
+                 "tgt": [6.0, 6.1, 6.3, 6.5], "rr": 2, "fnd": 10, "lev": 20, "tag": "TCA-0", "crt": 0,
+                 "t_ord": t_ord, "t_q": [20.0] * 4, "s_ord": "stop-1"},
+        "stop-1": {"parent": parent, "filled": False},
+    }}
+    for i, tid in enumerate(t_ord):
+        res.state["orders"][tid] = {"parent": parent, "filled": filled and i == 0}
+    return res, res.state["orders"][parent]
+
+
+class TestUpdateTrade(unittest.TestCase):
+    def test_sl(self):
+        async def _main():
+            t, odata = trader()
+            await t.update_trade("TCA-0", sl=5.7)
+            self.assertEqual(odata["sl"], 5.7)
+            self.assertEqual(t.client.cancelled, ["stop-1"])
+            self.assertEqual([(p["type"], p["stopPrice"]) for p in t.client.created], [("STOP_MARKET", 5.7)])
+            self.assertEqual(len(odata["t_ord"]), 4)
+
+            t, odata = trader(filled=True)
+            await t.update_trade("TCA-0", sl=5.7)  # the SL is at entry once a TP is hit
+            self.assertEqual(t.client.created, [])
+        asyncio.run(_main())
+
+    def test_targets(self):
+        async def _main():
+            t, odata = trader()
+            placed = list(odata["t_ord"])
+            await t.update_trade("TCA-0", targets=[6.0, 6.2, 6.3, 6.5])
+            self.assertEqual(t.client.cancelled, [placed[1]])
+            self.assertEqual([p["price"] for p in t.client.created], [6.2])
+            self.assertEqual(odata["tgt"], [6.0, 6.2, 6.3, 6.5])
+            self.assertEqual(odata["t_ord"][1], t.client.created[0]["newClientOrderId"])
+            self.assertNotIn(placed[1], t.state["orders"])
+        asyncio.run(_main())
+
+    def test_fewer_targets(self):
+        async def _main():
+            t, odata = trader(filled=True)
+            placed = list(odata["t_ord"])
+            await t.update_trade("TCA-0", targets=[6.0, 6.2])
+            # the hit TP stays, the 60 left on the three open ones goes to the new second one
+            self.assertEqual(t.client.cancelled, placed[1:])
+            self.assertEqual([(p["price"], p["quantity"]) for p in t.client.created], [(6.2, 60.0)])
+            self.assertEqual(odata["tgt"], [6.0, 6.2])
+            self.assertEqual(odata["t_q"], [20.0, 60.0])
+            self.assertEqual(odata["t_ord"][0], placed[0])
+            self.assertEqual(len(odata["t_ord"]), 2)
+            self.assertTrue(all(tid not in t.state["orders"] for tid in placed[1:]))
+
+            t, odata = trader()
+            await t.update_trade("TCA-0", targets=[6.0, 6.1, 6.3, 6.5, 6.8])
+            self.assertEqual(len(t.client.cancelled), 4)
+            self.assertEqual([p["quantity"] for p in t.client.created], [16.0] * 5)
+            self.assertEqual(odata["tgt"], [6.0, 6.1, 6.3, 6.5, 6.8])
+        asyncio.run(_main())
+
+    def test_before_fill(self):
+        async def _main():
+            t, odata = trader()
+            odata["t_ord"], odata["t_q"], odata["s_ord"] = [], [], None
+            await t.amend_trade("TCA-0", Signal("EOS", [5.85, 5.95], [6, 6.2], 5.7, 20), ("sl", "targets"))
+            self.assertEqual(t.client.created, [])
+            self.assertEqual(odata["sl"], 5.7)
+            self.assertEqual(len(odata["tgt"]), 2)
+        asyncio.run(_main())
+
+
+class TestTags(unittest.TestCase):
+    def test_find(self):
+        t, odata = trader()
+        first = t._find_order("TCA-0")
+        t.state["orders"]["wait-2"] = dict(odata, tag="TCA-1", t_ord=[], t_q=[], s_ord=None)
+        self.assertEqual(t._find_order("tca-0"), first)
+        self.assertEqual(t._find_order("TCA"), "wait-2")  # the channel's newest
+        self.assertIsNone(t._find_order("BK"))
+
+    def test_close(self):
+        async def _main():
+            t, odata = trader()
+            t.state["orders"]["wait-2"] = dict(odata, tag="TCA-1", t_ord=[], t_q=[], s_ord=None)
+            await t.close_trades("tca-1", "EOS")  # that order only, in any case
+            self.assertNotIn("wait-2", t.state["orders"])
+            self.assertIsNotNone(t._find_order("TCA-0"))
+            await t.close_trades("tca", "EOS")
+            self.assertIsNone(t._find_order("TCA"))
+        asyncio.run(_main())
+
+
+class TestPrice(unittest.TestCase):
+    def test_quiet(self):
+        async def _main():
+            t = FuturesTrader()
+            t.client = FakeClient()
+            t.price_timeout = 0.05
+            self.assertEqual(await t._price("EOS"), 5.9)  # no trade streamed, the snapshot has it
+            self.assertEqual(t.prices.source("EOS"), "snapshot")
+            self.assertLess(t.prices.age("EOS"), 1)
+        asyncio.run(_main())
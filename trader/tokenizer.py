@@ -0,0 +1,77 @@
+import re
+
+NUMBER_PATTERN = re.compile(r"(\.?\d+(?:\.\d+)?)")
+OPTIONAL_NUMBER_PATTERN = re.compile(r"(\d+(?:\.\d+)?)")
+DIGIT_PATTERN = re.compile(r"\d")
+
+_symbol_patterns = {}
+
+
+def symbol_pattern(prefix="#", suffix="usdt"):
+    key = (prefix, suffix)
+    pattern = _symbol_patterns.get(key)
+    if pattern is None:
+        pattern = re.compile(symbol_regex(prefix, suffix))
+        _symbol_patterns[key] = pattern
+    return pattern
+
+
+def symbol_regex(prefix="#", suffix="usdt"):
+    return (prefix if prefix else "") + r"([a-z0-9]+)[ ]*(?:(\/|\|)[ ]*)?" + (suffix if suffix else "")
+
+
+def extract_numbers(line: str, symbol=""):
+    res = list(map(float, NUMBER_PATTERN.findall(line.replace(",", "."))))
+    if symbol and DIGIT_PATTERN.search(symbol):
+        res.pop(0)
+    return res
+
+
+def extract_symbol(line: str, prefix="#", suffix="usdt"):
+    return symbol_pattern(prefix, suffix).search(line)
+
+
+def extract_optional_number(line: str):
+    res = OPTIONAL_NUMBER_PATTERN.search(line.replace(",", "."))
+    return float(res[1]) if res else None
+
+
+class ParsedMessage:
+    # Lowered text of a message and its stripped lines, shared by every parser (and fallback
+    # parser) looking at it. Lines are plain strings: tokens are extracted where a rule needs
+    # them as most lines are only looked at once.
+    __slots__ = ("text", "budget", "_lines", "_content")
+
+    def __init__(self, text: str):
+        self.text = text.lower()
+        self.budget = None  # set for live messages, see `Signal.parse`
+        self._lines = None
+        self._content = None
+
+    # Split on first use, the keyword checks of the prefilter only need the text
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            self._lines = list(map(str.strip, self.text.split("\n")))
+        return self._lines
+
+    @property
+    def content(self):
+        if self._content is None:
+            lines = self._lines if self._lines is not None else map(str.strip, self.text.split("\n"))
+            self._content = [line for line in lines if line]
+        return self._content
+
+    @classmethod
+    def of(cls, text):
+        return text if isinstance(text, cls) else cls(text)
+
+    def __contains__(self, keyword: str):
+        return keyword in self.text
+
+    def search(self, pattern: str):
+        return re.search(pattern, self.text)
+
+    def __repr__(self):
+        return repr(self.text)